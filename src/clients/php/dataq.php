@@ -33,9 +33,23 @@ class Dataq {
 	public $port;
 	public $username;
 	public $password;
+	public $persistent;
+	public $timeout;
 
+	// The connection in persistent mode, and whether it has been switched to
+	// session mode (KEEPALIVE) yet.
+	private $fp = NULL;
+	private $session = false;
+
+	// Number of response bytes read by the last doRequests.
+	private $received = 0;
+
+	// With $persistent, one connection is kept open in session mode and used
+	// for all requests. It's opened with pfsockopen, so it's reused by the
+	// next requests served by the same PHP process.
 	public function __construct($address = "", $port = 0, $username = "", 
-		                        $password = "") {
+		                        $password = "", $persistent = false,
+		                        $timeout = 30) {
 
 		if ($address === "") {
 			$address = "127.0.0.1";
@@ -49,60 +63,241 @@ class Dataq {
 		$this->port = $port;
 		$this->username = $username;
 		$this->password = $password;
+		$this->persistent = $persistent;
+		$this->timeout = $timeout;
 
 		// Try the connection to see if the DataQ server is there.
-		$fp = @fsockopen($this->address, $this->port, $errno, $errstr, 30);
+		if ($this->persistent) {
+			$this->connect();
+		} else {
+			fclose($this->open());
+		}
+	}
+
+	private function open() {
+		if ($this->persistent) {
+			$fp = @pfsockopen($this->address, $this->port, $errno, $errstr, 
+			                  $this->timeout);
+		} else {
+			$fp = @fsockopen($this->address, $this->port, $errno, $errstr, 
+			                 $this->timeout);
+		}
 		if (!$fp) {
 			throw new DataqException(
 				"Couldn't open a connection to the DataQ server.", 
 				2);
 		}
 
-		fclose($fp);
+		stream_set_timeout($fp, $this->timeout);
+
+		return($fp);
+	}
+
+	// Open the persistent connection, unless it's open already.
+	private function connect() {
+		if ($this->fp === NULL) {
+			$this->fp = $this->open();
+			$this->session = false;
+		}
+	}
+
+	// Check whether the server has closed a connection while it was idle,
+	// without blocking.
+	private function isOpen($fp) {
+		stream_set_blocking($fp, false);
+		$data = fread($fp, 1);
+		$open = ($data === "" || $data === false) && !feof($fp);
+		stream_set_blocking($fp, true);
+
+		return($open);
+	}
+
+	private function disconnect() {
+		if ($this->fp !== NULL) {
+			fclose($this->fp);
+			$this->fp = NULL;
+		}
 	}
 
 	private function buildQueueURI($queueName = "") {
 		$queueURI = $queueName;
 
-		if ($this->password != "") {
-			$queueURI = $this->password."@".$queueURI;
-		}
-		if ($this->username != "") {
-			$queueURI = $this->username.":".$queueURI;
+		// The server takes everything up to the first '@' as the
+		// authentication, and everything before the first ':' in it as the
+		// username. The username is always given, even if it's empty, so a
+		// ':' in the password isn't taken for the end of the username.
+		if ($this->username != "" || $this->password != "") {
+			$queueURI = $this->username.":".$this->password."@".$queueURI;
 		}
 
 		return($queueURI);
 
 	}
-	
-	private function doRequest($request) {
-		$fp = NULL;
+
+	// Read a response in session mode: a line with the length of the
+	// response, followed by the response. Returns false if the connection
+	// was closed.
+	private function readFramed($fp) {
+		$line = fgets($fp);
+		if ($line === false) {
+			return(false);
+		}
+		$this->received += strlen($line);
+
+		$length = intval($line);
 		$response = "";
-		$retResponse = array();
+		while (strlen($response) < $length) {
+			$data = fread($fp, $length - strlen($response));
+			if ($data === false || $data === "") {
+				return(false);
+			}
+			$this->received += strlen($data);
+			$response .= $data;
+		}
 
-		// Requests should always end in a newline so the server knows when
-		// to respond.
-		if ($request[strlen($request) - 1] != "\n") {
-			$request .= "\n";
+		return($response);
+	}
+
+	// fwrite may write only part of the data to a socket.
+	private function writeAll($fp, $data) {
+		while (strlen($data) > 0) {
+			$written = fwrite($fp, $data);
+			if ($written === false || $written === 0) {
+				return(false);
+			}
+			$data = substr($data, $written);
 		}
 
-		$fp = @fsockopen($this->address, $this->port, $errno, $errstr, 30);
-		if (!$fp) {
+		return(true);
+	}
+
+	// Requests that can safely be sent again if it's unknown whether the
+	// server processed them.
+	private function isIdempotent($request) {
+		$name = strtoupper(strtok($request, " \n"));
+
+		return($name === "PEEK" || $name === "STAT");
+	}
+
+	// Send a number of requests in a single write and return their
+	// responses (unparsed), using session mode to tell them apart. In
+	// persistent mode this uses the persistent connection, otherwise a new
+	// connection that is closed afterwards.
+	private function doRequests($requests, $retry = true) {
+		$retResponses = array();
+
+		if ($this->persistent) {
+			// The server closes idle sessions, so a persistent connection
+			// reused from an earlier PHP request may have been closed.
+			$this->connect();
+			if (!$this->isOpen($this->fp)) {
+				$this->disconnect();
+				$this->connect();
+			}
+			$fp = $this->fp;
+		} else {
+			$fp = $this->open();
+		}
+
+		// A new (or reused persistent) connection is switched to session
+		// mode by sending KEEPALIVE along with the requests.
+		$data = "";
+		$keepalive = !$this->persistent || !$this->session;
+		if ($keepalive) {
+			$data .= "KEEPALIVE\n";
+		}
+		foreach ($requests as $request) {
+			$data .= rtrim($request, "\n")."\n";
+		}
+		if (!$this->persistent) {
+			$data .= "QUIT\n";
+		}
+
+		$this->received = 0;
+		$ok = $this->writeAll($fp, $data);
+		if ($ok && $keepalive) {
+			$ok = ($this->readFramed($fp) === "OK\n");
+		}
+		if ($ok) {
+			foreach ($requests as $request) {
+				$response = $this->readFramed($fp);
+				if ($response === false) {
+					$ok = false;
+					break;
+				}
+				$retResponses[] = $response;
+			}
+		}
+
+		if (!$this->persistent) {
+			fclose($fp);
+		} else if (!$ok) {
+			// After a timeout or a partial response the connection is out
+			// of step with the server, so it's never used again.
+			$meta = stream_get_meta_data($fp);
+			$this->disconnect();
+
+			// The connection may still have been closed between the check
+			// above and sending the requests. Retry once on a new
+			// connection, but only if the server can't have processed
+			// anything that isn't safe to repeat.
+			$retry = $retry && $this->received == 0 && !$meta["timed_out"];
+			foreach ($requests as $request) {
+				$retry = $retry && $this->isIdempotent($request);
+			}
+			if ($retry) {
+				return($this->doRequests($requests, false));
+			}
+		} else {
+			$this->session = true;
+		}
+
+		if (!$ok) {
 			throw new DataqException(
-				"Couldn't open a connection to the DataQ server.", 
+				"Lost the connection to the DataQ server.", 
 				2);
 		}
 
-		fwrite($fp, $request);
-		while(!feof($fp)) {
-			$response .= fgets($fp, 128);
-		}
-		fclose($fp);
+		return($retResponses);
+	}
 
+	private function checkError($response) {
 		if (substr($response, 0, 5) === "ERROR") {
-			$errorInfo = explode(" ", $response, 3);
+			$errorInfo = explode(" ", rtrim($response, "\n"), 3);
+
+			return(new DataqException($errorInfo[2], $errorInfo[1]));
+		}
+
+		return(NULL);
+	}
+	
+	private function doRequest($request) {
+		$fp = NULL;
+		$response = "";
+		$retResponse = array();
+
+		if ($this->persistent) {
+			$responses = $this->doRequests(array($request));
+			$response = $responses[0];
+		} else {
+			// Requests should always end in a newline so the server knows
+			// when to respond.
+			if ($request[strlen($request) - 1] != "\n") {
+				$request .= "\n";
+			}
+
+			$fp = $this->open();
+
+			fwrite($fp, $request);
+			while(!feof($fp)) {
+				$response .= fgets($fp, 128);
+			}
+			fclose($fp);
+		}
 
-			throw new DataqException($errorInfo[2], $errorInfo[1]);
+		$error = $this->checkError($response);
+		if ($error !== NULL) {
+			throw $error;
 		}
 
 		$retResponse = explode("\n", $response);
@@ -142,20 +337,41 @@ class Dataq {
 		return($retQueueInfo);
 	}
 
-	public function push($queueName, $message) {
+	// $priority can only be given for priority queues. With a $delay (in
+	// seconds), the message only becomes visible once it is due.
+	public function push($queueName, $message, $priority = NULL, $delay = NULL, $ttl = NULL) {
 		$queueURI = $this->buildQueueURI($queueName);
+		$options = array();
+		if ($priority !== NULL) {
+			$options[] = "priority=".intval($priority);
+		}
+		if ($delay !== NULL) {
+			$options[] = "delay=".floatval($delay);
+		}
+		if ($ttl !== NULL) {
+			$options[] = "ttl=".floatval($ttl);
+		}
+		if (count($options) > 0) {
+			$queueURI .= "?".implode("&", $options);
+		}
 		$response = $this->doRequest("PUSH ".$queueURI." ".$message);
 	}
 
-	public function pop($queueName) {
+	public function pop($queueName, $subscriber = NULL) {
 		$queueURI = $this->buildQueueURI($queueName);
+		if ($subscriber !== NULL) {
+			$queueURI .= "?subscriber=".$subscriber;
+		}
 		$response = $this->doRequest("POP ".$queueURI);
 
 		return($response[0]);
 	}
 
-	public function peek($queueName) {
+	public function peek($queueName, $subscriber = NULL) {
 		$queueURI = $this->buildQueueURI($queueName);
+		if ($subscriber !== NULL) {
+			$queueURI .= "?subscriber=".$subscriber;
+		}
 		$response = $this->doRequest("PEEK ".$queueURI);
 
 		return($response[0]);
@@ -165,6 +381,74 @@ class Dataq {
 		$queueURI = $this->buildQueueURI($queueName);
 		$response = $this->doRequest("CLEAR ".$queueURI);
 	}
+
+	// Send several commands in a single write (one round trip). $commands
+	// is a list of commands, each an array of the command name and its
+	// arguments:
+	//
+	//   array("push", $queueName, $message)
+	//   array("pop", $queueName)
+	//   array("peek", $queueName)
+	//   array("clear", $queueName)
+	//
+	// Returns a list with the result of each command, in order: NULL for
+	// push and clear, the message for pop and peek. A command that failed
+	// has a DataqException as its result; the other commands are still
+	// executed.
+	public function batch($commands) {
+		$requests = array();
+		$retResults = array();
+
+		foreach ($commands as $command) {
+			$name = strtoupper($command[0]);
+			$queueURI = $this->buildQueueURI($command[1]);
+
+			if ($name === "PUSH") {
+				$requests[] = "PUSH ".$queueURI." ".$command[2];
+			} else if ($name === "POP" || $name === "PEEK" || 
+			           $name === "CLEAR") {
+				$requests[] = $name." ".$queueURI;
+			} else {
+				throw new DataqException("Unknown request type", 102);
+			}
+		}
+
+		if (count($requests) == 0) {
+			return($retResults);
+		}
+
+		$responses = $this->doRequests($requests);
+
+		foreach ($responses as $i => $response) {
+			$name = strtoupper($commands[$i][0]);
+			$error = $this->checkError($response);
+
+			if ($error !== NULL) {
+				$retResults[] = $error;
+			} else if ($name === "POP" || $name === "PEEK") {
+				$retResults[] = $response;
+			} else {
+				$retResults[] = NULL;
+			}
+		}
+
+		return($retResults);
+	}
+
+	// Push several messages onto a queue in one round trip.
+	public function pushMany($queueName, $messages) {
+		$commands = array();
+
+		foreach ($messages as $message) {
+			$commands[] = array("push", $queueName, $message);
+		}
+
+		foreach ($this->batch($commands) as $result) {
+			if ($result !== NULL) {
+				throw $result;
+			}
+		}
+	}
 }
 
 class DataqException extends Exception {
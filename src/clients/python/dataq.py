@@ -0,0 +1,508 @@
+#
+# dataq.py v0.3
+#
+# A client library for the DataQ message queueing server.
+#
+# Copyright (C), 2005 Ferry Boender.
+#
+# Released under the Lesser General Public License (LGPL):
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation; either version 2.1 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+A client library for the DataQ message queueing server.
+
+Connections are kept open (in binary mode, see doc/PROTOCOL) and reused
+through a thread-safe connection pool, so a Dataq instance can be shared by
+all threads of a program. Many requests can be sent at once with a pipeline:
+
+	client = Dataq("127.0.0.1", 50000, "john", "johnspw")
+	client.push("backup", "message")
+	print client.pop("backup")
+
+	pipeline = client.pipeline()
+	pipeline.push("backup", "first")
+	pipeline.push("backup", "second")
+	pipeline.getQueueInfo("backup")
+	print pipeline.execute()      # [None, None, {'name': 'backup', ...}]
+
+Errors returned by the server raise a DataqException with the server's error
+code and message.
+"""
+
+import socket
+import struct
+import threading
+import time
+
+class DataqException(Exception):
+
+	"""
+	An error returned by the server (with its error code, see doc/ERRORS), or
+	a problem talking to it (code 2).
+	"""
+
+	def __init__(self, message, code = 0):
+		Exception.__init__(self, message)
+		self.message = message
+		self.code = code
+
+	def getMessage(self):
+		return(self.message)
+
+	def getCode(self):
+		return(self.code)
+
+	def __str__(self):
+		return("ERROR " + str(self.code) + " " + self.message)
+
+def buildQueueURI(queueName = "", username = "", password = "", options = None):
+	"""
+	Build a queue URI, [[username:]password@]queue_name[?options], as the
+	server parses it: everything up to the first '@' is the authentication,
+	of which everything up to the first ':' is the username. options is a
+	list of (name, value) tuples.
+	"""
+	if " " in queueName or "\n" in queueName or "?" in queueName:
+		raise ValueError, "Queue name can't contain spaces, '?' or newlines"
+	if "@" in username or ":" in username or " " in username or "\n" in username:
+		raise ValueError, "Username can't contain '@', ':', spaces or newlines"
+	if "@" in password or " " in password or "\n" in password:
+		raise ValueError, "Password can't contain '@', spaces or newlines"
+
+	retQueueURI = queueName
+
+	# The username is always given, even if it's empty, so a ':' in the
+	# password isn't taken for the end of the username.
+	if username != "" or password != "":
+		retQueueURI = username + ":" + password + "@" + retQueueURI
+	elif "@" in queueName:
+		# Otherwise the queue name would be taken for the authentication.
+		retQueueURI = "@" + retQueueURI
+
+	if options:
+		retQueueURI += "?" + "&".join(["%s=%s" % (name, value) for name, value in options])
+
+	return(retQueueURI)
+
+class Connection:
+
+	"""
+	A single connection to the server in binary mode. Requests are sent as a
+	4 byte length followed by the request; responses are a status byte ('+'
+	or '-'), a 4 byte length and the response itself.
+	"""
+
+	def __init__(self, address, port, timeout = 30):
+		self.timeout = timeout
+		self.lastUsed = time.time()
+		self.broken = False
+
+		# Number of response bytes read since the last send, and whether the
+		# last send failed because the connection was closed before any
+		# response arrived (so the server can't have received the requests).
+		self.received = 0
+		self.unanswered = False
+
+		try:
+			self.sock = socket.create_connection((address, port), timeout)
+			self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			self.file = self.sock.makefile("rb")
+
+			self.sock.sendall("BINARY\n")
+			self.readResponse()
+		except (socket.error, EOFError), e:
+			raise DataqException("Couldn't open a connection to the DataQ server: " + str(e), 2)
+
+	def close(self):
+		self.broken = True
+		try:
+			self.file.close()
+			self.sock.close()
+		except socket.error:
+			pass
+
+	def frame(self, data):
+		return(struct.pack('>L', len(data)) + data)
+
+	def send(self, requests, timeout = None):
+		"""
+		Send a list of requests (each a list of frames: the request followed
+		by any MPUSH messages) at once. Returns the (status, response) tuples,
+		in order.
+		"""
+		retResponses = []
+
+		if timeout == None:
+			timeout = self.timeout
+
+		self.received = 0
+		self.unanswered = False
+		try:
+			self.sock.settimeout(timeout)
+			self.sock.sendall("".join([self.frame(frame) for request in requests for frame in request]))
+			for request in requests:
+				retResponses.append(self.readResponse())
+		except (socket.error, EOFError), e:
+			# After a timeout or a partial response, the server may have
+			# processed (some of) the requests.
+			self.unanswered = not isinstance(e, socket.timeout) and self.received == 0
+			self.close()
+			raise DataqException("Lost the connection to the DataQ server: " + str(e), 2)
+
+		self.lastUsed = time.time()
+
+		return(retResponses)
+
+	def read(self, length):
+		data = self.file.read(length)
+		self.received += len(data)
+		if len(data) < length:
+			raise EOFError, "Connection closed by server"
+		return(data)
+
+	def readResponse(self):
+		header = self.read(5)
+		length = struct.unpack('>L', header[1:])[0]
+		return(header[0] == "+", self.read(length))
+
+class ConnectionPool:
+
+	"""
+	Thread-safe pool of connections to a server. Connections are handed out
+	to one thread at a time and reused afterwards. At most maxIdle
+	connections are kept open; connections that have been idle for more than
+	idleTimeout seconds are closed, before the server's session timeout does
+	so.
+	"""
+
+	def __init__(self, address, port, timeout = 30, maxIdle = 8, idleTimeout = 240):
+		self.address = address
+		self.port = port
+		self.timeout = timeout
+		self.maxIdle = maxIdle
+		self.idleTimeout = idleTimeout
+
+		self.idle = []
+		self.lock = threading.Lock()
+
+	def get(self):
+		"""
+		Return an idle connection, or a new one if there is none. Returns a
+		(connection, reused) tuple.
+		"""
+		self.lock.acquire()
+		try:
+			while len(self.idle) > 0:
+				connection = self.idle.pop()
+				if connection.lastUsed >= time.time() - self.idleTimeout:
+					return(connection, True)
+				connection.close()
+		finally:
+			self.lock.release()
+
+		return(self.connect(), False)
+
+	def connect(self):
+		"""
+		Open a new connection.
+		"""
+		return(Connection(self.address, self.port, self.timeout))
+
+	def put(self, connection):
+		"""
+		Give a connection back to the pool after use.
+		"""
+		if connection.broken:
+			return
+
+		self.lock.acquire()
+		try:
+			if len(self.idle) < self.maxIdle:
+				self.idle.append(connection)
+				connection = None
+		finally:
+			self.lock.release()
+
+		if connection != None:
+			connection.close()
+
+	def close(self):
+		"""
+		Close all idle connections.
+		"""
+		self.lock.acquire()
+		try:
+			idle = self.idle
+			self.idle = []
+		finally:
+			self.lock.release()
+
+		for connection in idle:
+			connection.close()
+
+def parseNone(response):
+	return(None)
+
+def parseMessage(response):
+	return(response)
+
+def parseMessages(response):
+	"""
+	Parse an MPOP response: messages, each preceded by its 4 byte length.
+	"""
+	retMessages = []
+
+	offset = 0
+	while offset + 4 <= len(response):
+		length = struct.unpack('>L', response[offset:offset + 4])[0]
+		retMessages.append(response[offset + 4:offset + 4 + length])
+		offset += 4 + length
+
+	return(retMessages)
+
+def parseQueues(response):
+	"""
+	Parse a STAT response for the server: a 'queue:name' line per queue.
+	"""
+	return([line.split(":", 1)[1] for line in response.split("\n") if line != ""])
+
+def parseInfo(response):
+	"""
+	Parse a STAT or METRICS response: 'key:value' lines.
+	"""
+	retInfo = {}
+
+	for line in response.split("\n"):
+		if line != "":
+			key, value = line.split(":", 1)
+			retInfo[key] = value
+
+	return(retInfo)
+
+class Dataq:
+
+	"""
+	Client for a DataQ server. Safe to use from multiple threads; each
+	request uses a connection from the pool.
+	"""
+
+	def __init__(self, address = "127.0.0.1", port = 50000, username = "", password = "", timeout = 30, maxIdle = 8):
+		self.username = username
+		self.password = password
+		self.pool = ConnectionPool(address, port, timeout, maxIdle)
+
+	def queueURI(self, queueName = "", options = None):
+		return(buildQueueURI(queueName, self.username, self.password, options))
+
+	def pushURI(self, queueName, priority = None, delay = None, at = None, ttl = None):
+		"""
+		Return the queue URI for pushing onto queueName with a priority (for
+		priority queues), a delay in seconds or a Unix timestamp before
+		which the message stays invisible, and a ttl in seconds after which
+		it expires. None means the default.
+		"""
+		options = []
+		if priority != None:
+			options.append(("priority", int(priority)))
+		if delay != None:
+			options.append(("delay", repr(float(delay))))
+		if at != None:
+			options.append(("at", repr(float(at))))
+		if ttl != None:
+			options.append(("ttl", repr(float(ttl))))
+
+		return(self.queueURI(queueName, options))
+
+	def popURI(self, queueName, subscriber = None):
+		"""
+		Return the queue URI for popping from (or peeking at) queueName as
+		subscriber (for subscribe queues). None means no subscriber.
+		"""
+		options = []
+		if subscriber != None:
+			options.append(("subscriber", subscriber))
+
+		return(self.queueURI(queueName, options))
+
+	def execute(self, requests, timeout = None):
+		"""
+		Send a list of (frames, parser) requests over a single connection and
+		return the parsed responses. Failed requests are returned as
+		DataqException instances.
+
+		A connection from the pool may have been closed by the server in the
+		meantime. If it turns out to have been closed before any response
+		arrived, the other idle connections probably are too, so they are
+		closed and the requests are retried once on a new connection. The
+		requests are never retried after a timeout or a partial response,
+		as the server may already have processed them.
+		"""
+		retResults = []
+
+		connection, reused = self.pool.get()
+		try:
+			responses = connection.send([frames for frames, parser in requests], timeout)
+		except DataqException:
+			if not reused or not connection.unanswered:
+				raise
+			self.pool.close()
+			connection = self.pool.connect()
+			responses = connection.send([frames for frames, parser in requests], timeout)
+		self.pool.put(connection)
+
+		for i in range(len(requests)):
+			success, response = responses[i]
+			if success:
+				retResults.append(requests[i][1](response))
+			else:
+				code, message = response.rstrip("\n").split(" ", 2)[1:]
+				retResults.append(DataqException(message, int(code)))
+
+		return(retResults)
+
+	def request(self, frames, parser, timeout = None):
+		retResult = self.execute([(frames, parser)], timeout)[0]
+
+		if isinstance(retResult, DataqException):
+			raise retResult
+
+		return(retResult)
+
+	def pipeline(self):
+		return(Pipeline(self))
+
+	def close(self):
+		self.pool.close()
+
+	def getQueues(self):
+		return(self.request(["STAT " + self.queueURI()], parseQueues))
+
+	def getQueueInfo(self, queueName):
+		return(self.request(["STAT " + self.queueURI(queueName)], parseInfo))
+
+	def getMetrics(self):
+		return(self.request(["METRICS " + self.queueURI()], parseInfo))
+
+	def push(self, queueName, message, priority = None, delay = None, at = None, ttl = None):
+		"""
+		Push a message. A priority can only be given for priority queues. With
+		a delay (in seconds) or at (a Unix timestamp), the message only
+		becomes visible once it is due. With a ttl (in seconds; 0 means
+		never), the message expires that long after it becomes visible,
+		instead of after the queue's ttl.
+		"""
+		self.request(["PUSH " + self.pushURI(queueName, priority, delay, at, ttl) + " " + message], parseNone)
+
+	def mpush(self, queueName, messages, priority = None, delay = None, at = None, ttl = None):
+		"""
+		Push a list of messages at once. Either all or none are pushed.
+		"""
+		self.request(["MPUSH " + self.pushURI(queueName, priority, delay, at, ttl) + " " + str(len(messages))] + list(messages), parseNone)
+
+	def pop(self, queueName, subscriber = None):
+		"""
+		Pop a message. Returns an empty string if the queue is empty.
+		"""
+		return(self.request(["POP " + self.popURI(queueName, subscriber)], parseMessage))
+
+	def mpop(self, queueName, count, subscriber = None):
+		"""
+		Pop up to count messages. Returns a list.
+		"""
+		return(self.request(["MPOP " + self.popURI(queueName, subscriber) + " " + str(count)], parseMessages))
+
+	def bpop(self, queueName, timeout, subscriber = None):
+		"""
+		Pop a message, waiting at most timeout seconds for one if the queue
+		is empty. Returns an empty string if none arrived in time.
+		"""
+		return(self.request(["BPOP " + self.popURI(queueName, subscriber) + " " + str(timeout)], parseMessage, self.pool.timeout + timeout))
+
+	def peek(self, queueName, subscriber = None):
+		return(self.request(["PEEK " + self.popURI(queueName, subscriber)], parseMessage))
+
+	def clear(self, queueName):
+		self.request(["CLEAR " + self.queueURI(queueName)], parseNone)
+
+class Pipeline:
+
+	"""
+	Collects requests and sends them all at once over a single connection
+	when execute() is called, which returns the results in order. Used as a
+	context manager, the requests are executed at the end of the block.
+	"""
+
+	def __init__(self, client):
+		self.client = client
+		self.requests = []
+		self.results = None
+
+	def __enter__(self):
+		return(self)
+
+	def __exit__(self, type, value, traceback):
+		if type == None:
+			self.execute()
+
+	def add(self, frames, parser):
+		self.requests.append((frames, parser))
+		return(self)
+
+	def execute(self, raiseOnError = True):
+		"""
+		Send the collected requests. Returns a list with the result of each
+		request. If raiseOnError is False, failed requests are returned as
+		DataqException instances; otherwise the first error is raised (after
+		all requests have been executed).
+		"""
+		requests = self.requests
+		self.requests = []
+
+		self.results = []
+		if len(requests) > 0:
+			self.results = self.client.execute(requests)
+
+		if raiseOnError:
+			for result in self.results:
+				if isinstance(result, DataqException):
+					raise result
+
+		return(self.results)
+
+	def getQueues(self):
+		return(self.add(["STAT " + self.client.queueURI()], parseQueues))
+
+	def getQueueInfo(self, queueName):
+		return(self.add(["STAT " + self.client.queueURI(queueName)], parseInfo))
+
+	def push(self, queueName, message, priority = None, delay = None, at = None, ttl = None):
+		return(self.add(["PUSH " + self.client.pushURI(queueName, priority, delay, at, ttl) + " " + message], parseNone))
+
+	def mpush(self, queueName, messages, priority = None, delay = None, at = None, ttl = None):
+		return(self.add(["MPUSH " + self.client.pushURI(queueName, priority, delay, at, ttl) + " " + str(len(messages))] + list(messages), parseNone))
+
+	def pop(self, queueName, subscriber = None):
+		return(self.add(["POP " + self.client.popURI(queueName, subscriber)], parseMessage))
+
+	def mpop(self, queueName, count, subscriber = None):
+		return(self.add(["MPOP " + self.client.popURI(queueName, subscriber) + " " + str(count)], parseMessages))
+
+	def peek(self, queueName, subscriber = None):
+		return(self.add(["PEEK " + self.client.popURI(queueName, subscriber)], parseMessage))
+
+	def clear(self, queueName):
+		return(self.add(["CLEAR " + self.client.queueURI(queueName)], parseNone))
@@ -45,6 +45,7 @@ usageStr =\
 #  -4 Import error; missing python package
 #  -5 Daemon starting error
 #  -6 Couldn't create spool dir 
+#  -7 All worker processes exited (workers > 1)
 
 import sys
 import signal
@@ -55,6 +56,18 @@ import socket
 import select
 import struct
 import math
+import threading
+import mmap
+import glob
+import time
+import errno
+import heapq
+import bisect
+import itertools
+import zlib
+import fcntl
+import atexit
+from collections import deque
 from xml.dom.ext.reader import Sax
 from xml import xpath
 try:
@@ -62,6 +75,10 @@ try:
 except ImportError:
 	sys.stderr.write("Error while importing xmlproc. Is python-xml installed? Aborting.\n");
 	sys.exit(-4);
+try:
+	import syslog
+except ImportError:
+	syslog = None
 
 def str2bool(string):
 	retBool = None
@@ -84,11 +101,17 @@ class DataqError(Exception):
 		# Syntactic request errors
 		101: "Bad syntax in request",
 		102: "Unknown request type",
+		103: "Request too long",
 
 		# Data errors
 		201: "Unknown queue",
 		202: "Access denied",
 		203: "Queue is full",
+		204: "Option not supported by queue",
+		205: "Unknown subscriber",
+
+		# Server errors
+		301: "Worker unavailable",
 	}
 
 	def __init__(self, value):
@@ -125,9 +148,28 @@ class ConfigError(Exception):
 		202: "Wrong value for size",
 		203: "Wrong value for overflow",
 		204: "Queue name is requird",
+		205: "Wrong value for storage",
+		206: "Wrong value for method",
+		207: "Wrong value for subscriber",
+		208: "Wrong value for ttl",
+		209: "Wrong value for segment",
 
 		# Queue Pool definition errors
 		301: "Wrong value for spool event",
+		302: "Wrong value for spool flush policy",
+		303: "Wrong value for spool compaction threshold",
+
+		# Server definition errors
+		401: "Wrong value for server",
+		402: "Wrong value for workers",
+		403: "Wrong value for maxline",
+
+		# Logging definition errors
+		501: "Wrong value for log level",
+		502: "Wrong value for syslog facility",
+
+		# Metrics definition errors
+		601: "Wrong value for metrics port",
 
 		999: "Undefined exception",
 	}
@@ -174,31 +216,457 @@ class DaemonError(Exception):
 class Log:
 
 	""" 
-	Console, verbose and system log logger.
+	Leveled logger. Log calls only queue the message and its arguments; a
+	background writer thread formats them and writes them to the sinks
+	(console, file, syslog), so logging never blocks on I/O in a request
+	handler. The methods for disabled levels are replaced by a no-op, so
+	disabled log calls don't build any strings.
+
+	Usage: Log.debug("Pushing to %s: %s", queueName, message)
 	"""
 
-	def verbose(type, msg):
-		global verbose
+	DEBUG = 10
+	INFO = 20
+	WARNING = 30
+	ERROR = 40
+	OFF = 100
+
+	levels = {
+		"debug": DEBUG,
+		"info": INFO,
+		"warning": WARNING,
+		"error": ERROR,
+		"off": OFF,
+	}
+
+	names = {
+		DEBUG: "DEBUG",
+		INFO: "INFO",
+		WARNING: "WARNING",
+		ERROR: "ERROR",
+	}
 
-		if verbose:
-			print "[" + type + "] " + msg
-		
-	def verboseMsg(msg):
-		Log.verbose("m", msg)
-			
-	def verboseWarn(msg):
-		Log.verbose("w", msg)
+	level = OFF
+	sinks = []
+	maxRecords = 100000  # Records queued beyond this are dropped
+	flushTimeout = 5
+
+	writerPid = None
+	lock = None
+	pending = None
+	idle = None
+	records = None
+	dropped = 0
+	writing = False
+
+	def discard(msg, *args):
+		pass
+
+	def emitter(level):
+		def emit(msg, *args):
+			Log.emit(level, msg, args)
+		return(emit)
+
+	def setLevel(level):
+		"""
+		Enable all log methods of `level` and higher, and replace the others
+		by a no-op.
+		"""
+		Log.level = level
+		for name, methodLevel in [("debug", Log.DEBUG), ("info", Log.INFO), ("warning", Log.WARNING), ("error", Log.ERROR)]:
+			if methodLevel >= level and len(Log.sinks) > 0:
+				setattr(Log, name, staticmethod(Log.emitter(methodLevel)))
+			else:
+				setattr(Log, name, staticmethod(Log.discard))
+
+	def addSink(sink):
+		Log.sinks.append(sink)
+		Log.setLevel(Log.level)
+
+	def startWriter():
+		# Called on the first message of each process. The lock and thread
+		# of a parent process don't survive a fork, so they're created anew.
+		# The lock is reentrant because the signal handlers log too, and may
+		# interrupt the main thread while it's queueing a message.
+		Log.lock = threading.RLock()
+		Log.pending = threading.Condition(Log.lock)
+		Log.idle = threading.Condition(Log.lock)
+		Log.records = deque()
+		Log.dropped = 0
+		Log.writing = False
+		Log.writerPid = os.getpid()
+
+		thread = threading.Thread(target=Log.write)
+		thread.setDaemon(True)
+		thread.start()
+
+	def emit(level, msg, args):
+		if Log.writerPid != os.getpid():
+			Log.startWriter()
+
+		Log.lock.acquire()
+		try:
+			if len(Log.records) >= Log.maxRecords:
+				Log.dropped += 1
+			else:
+				Log.records.append((time.time(), level, msg, args))
+				Log.pending.notify()
+		finally:
+			Log.lock.release()
+
+	def format(msg, args):
+		retMsg = msg
+		if args:
+			try:
+				retMsg = msg % args
+			except (TypeError, ValueError):
+				retMsg = msg + " " + repr(args)
+		return(retMsg)
+
+	def write():
+		while True:
+			Log.lock.acquire()
+			try:
+				while len(Log.records) == 0:
+					Log.pending.wait()
+				records = Log.records
+				Log.records = deque()
+				dropped = Log.dropped
+				Log.dropped = 0
+				Log.writing = True
+			finally:
+				Log.lock.release()
+
+			if dropped > 0:
+				records.append((time.time(), Log.WARNING, "Log queue full. Dropped %i messages", (dropped, )))
+
+			for sink in Log.sinks:
+				try:
+					for timestamp, level, msg, args in records:
+						sink.write(timestamp, level, Log.format(msg, args))
+					sink.flush()
+				except (IOError, OSError):
+					pass
+
+			Log.lock.acquire()
+			try:
+				Log.writing = False
+				Log.idle.notifyAll()
+			finally:
+				Log.lock.release()
+
+	def flush():
+		"""
+		Wait (at most flushTimeout seconds) until all queued messages of this
+		process have been written.
+		"""
+		if Log.writerPid != os.getpid():
+			return
+
+		deadline = time.time() + Log.flushTimeout
+		Log.lock.acquire()
+		try:
+			while len(Log.records) > 0 or Log.writing:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					break
+				Log.idle.wait(remaining)
+		finally:
+			Log.lock.release()
+
+	discard = staticmethod(discard)
+	emitter = staticmethod(emitter)
+	setLevel = staticmethod(setLevel)
+	addSink = staticmethod(addSink)
+	startWriter = staticmethod(startWriter)
+	emit = staticmethod(emit)
+	format = staticmethod(format)
+	write = staticmethod(write)
+	flush = staticmethod(flush)
+
+	debug = discard
+	info = discard
+	warning = discard
+	error = discard
+
+class ConsoleLogSink:
+
+	"""
+	Writes log messages to stdout (-V).
+	"""
+
+	prefixes = {
+		Log.DEBUG: "d",
+		Log.INFO: "i",
+		Log.WARNING: "w",
+		Log.ERROR: "e",
+	}
+
+	def write(self, timestamp, level, msg):
+		sys.stdout.write("[" + self.prefixes[level] + "] " + msg + "\n")
+
+	def flush(self):
+		sys.stdout.flush()
+
+class FileLogSink:
+
+	"""
+	Appends timestamped log messages to a file.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.f = open(path, "a")
+
+	def write(self, timestamp, level, msg):
+		self.f.write(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)) + " dataq[" + str(os.getpid()) + "] " + Log.names[level] + ": " + msg + "\n")
+
+	def flush(self):
+		self.f.flush()
+
+class SyslogLogSink:
+
+	"""
+	Sends log messages to the system logger.
+	"""
+
+	priorities = {
+		Log.DEBUG: "LOG_DEBUG",
+		Log.INFO: "LOG_INFO",
+		Log.WARNING: "LOG_WARNING",
+		Log.ERROR: "LOG_ERR",
+	}
 
-	def verboseErr(msg):
-		Log.verbose("e", msg)
+	def __init__(self, facility):
+		syslog.openlog("dataq", syslog.LOG_PID, getattr(syslog, "LOG_" + facility.upper()))
 
-	verbose = staticmethod(verbose)
-	verboseMsg = staticmethod(verboseMsg)
-	verboseWarn = staticmethod(verboseWarn)
-	verboseErr = staticmethod(verboseErr)
+	def write(self, timestamp, level, msg):
+		syslog.syslog(getattr(syslog, self.priorities[level]), msg)
+
+	def flush(self):
+		pass
 	
+class Histogram:
+
+	"""
+	Latency histogram with fixed log-scale buckets. Bucket i counts the
+	durations of at least 2**(i-1) and less than 2**i microseconds (bucket 0
+	those of less than 1 microsecond); the last bucket also counts anything
+	longer.
+	"""
+
+	bucketCount = 32
+
+	def __init__(self):
+		self.buckets = [0] * self.bucketCount
+		self.count = 0
+		self.total = 0.0
+
+	def add(self, duration):
+		"""
+		Add a duration in seconds.
+		"""
+		bucket = int(duration * 1000000).bit_length()
+		if bucket >= self.bucketCount:
+			bucket = self.bucketCount - 1
+
+		self.buckets[bucket] += 1
+		self.count += 1
+		self.total += duration
+
+	def percentile(self, fraction):
+		"""
+		Return the upper bound in microseconds of the bucket that contains the
+		duration below which `fraction` of all durations fall.
+		"""
+		threshold = fraction * self.count
+		seen = 0
+
+		for bucket in range(self.bucketCount):
+			seen += self.buckets[bucket]
+			if seen > 0 and seen >= threshold:
+				return(2 ** bucket)
+
+		return(0)
+
+	def report(self, prefix):
+		retResponse = ""
+
+		retResponse += prefix + ".count:" + str(self.count) + "\n"
+		if self.count > 0:
+			retResponse += prefix + ".mean:" + str(int(self.total * 1000000 / self.count)) + "\n"
+		retResponse += prefix + ".p50:" + str(self.percentile(0.5)) + "\n"
+		retResponse += prefix + ".p99:" + str(self.percentile(0.99)) + "\n"
+		retResponse += prefix + ".p999:" + str(self.percentile(0.999)) + "\n"
+		retResponse += prefix + ".histogram:" + " ".join([str(2 ** bucket) + "=" + str(self.buckets[bucket]) for bucket in range(self.bucketCount) if self.buckets[bucket] > 0]) + "\n"
+
+		return(retResponse)
+
+class Metrics:
+
+	"""
+	Performance counters of the server (this process, when running multiple
+	workers): requests, errors and latency per command, operations per queue,
+	bytes received and sent, denied access and the time spent writing spool
+	files and journals. Latencies are in microseconds.
+
+	Rates are calculated over the last rateWindow seconds, from snapshots of
+	the counters that are taken at most every rateInterval seconds.
+	"""
+
+	rateWindow = 60
+	rateInterval = 10
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.time()
+
+		# Counters by name (e.g. "command.PUSH", "queue.test.POP").
+		self.counts = {}
+		# Latency histograms by command, and "spool" and "journal" timings.
+		self.latencies = {}
+		self.timings = {}
+
+		self.errors = {}
+		self.bytesIn = 0
+		self.bytesOut = 0
+		self.denied = 0
+
+		# (time, counts) snapshots for calculating rates.
+		self.snapshots = deque([(self.started, {})])
+		self.nextSnapshot = self.started + self.rateInterval
+
+	def request(self, command, duration, error = False):
+		"""
+		Count a request for command that took duration seconds.
+		"""
+		self.lock.acquire()
+		try:
+			key = "command." + command
+			self.counts[key] = self.counts.get(key, 0) + 1
+
+			try:
+				histogram = self.latencies[command]
+			except KeyError:
+				histogram = self.latencies[command] = Histogram()
+			histogram.add(duration)
+
+			if error:
+				self.errors[command] = self.errors.get(command, 0) + 1
+
+			now = time.time()
+			if now >= self.nextSnapshot:
+				self.snapshot(now)
+		finally:
+			self.lock.release()
+
+	def queueOp(self, queueName, command):
+		"""
+		Count an operation on a queue.
+		"""
+		self.lock.acquire()
+		try:
+			key = "queue." + queueName + "." + command
+			self.counts[key] = self.counts.get(key, 0) + 1
+		finally:
+			self.lock.release()
+
+	def timing(self, name, duration):
+		"""
+		Record the duration of a spool or journal write.
+		"""
+		self.lock.acquire()
+		try:
+			try:
+				histogram = self.timings[name]
+			except KeyError:
+				histogram = self.timings[name] = Histogram()
+			histogram.add(duration)
+		finally:
+			self.lock.release()
+
+	def received(self, count):
+		self.lock.acquire()
+		try:
+			self.bytesIn += count
+		finally:
+			self.lock.release()
+
+	def sent(self, count):
+		self.lock.acquire()
+		try:
+			self.bytesOut += count
+		finally:
+			self.lock.release()
+
+	def deny(self):
+		self.lock.acquire()
+		try:
+			self.denied += 1
+		finally:
+			self.lock.release()
+
+	def snapshot(self, now):
+		"""
+		Remember the current counters for calculating rates. Must be called
+		with the lock held.
+		"""
+		self.snapshots.append((now, self.counts.copy()))
+		while len(self.snapshots) > 1 and self.snapshots[1][0] <= now - self.rateWindow:
+			self.snapshots.popleft()
+		self.nextSnapshot = now + self.rateInterval
+
+	def report(self):
+		"""
+		Return all metrics as 'name:value' lines.
+		"""
+		retResponse = ""
+
+		self.lock.acquire()
+		try:
+			now = time.time()
+			if now >= self.nextSnapshot:
+				self.snapshot(now)
+			since, oldCounts = self.snapshots[0]
+
+			retResponse += "pid:" + str(os.getpid()) + "\n"
+			retResponse += "uptime:" + str(int(now - self.started)) + "\n"
+			retResponse += "bytes.in:" + str(self.bytesIn) + "\n"
+			retResponse += "bytes.out:" + str(self.bytesOut) + "\n"
+			retResponse += "denied:" + str(self.denied) + "\n"
+
+			keys = self.counts.keys()
+			keys.sort()
+			for key in keys:
+				rate = 0.0
+				if now > since:
+					rate = (self.counts[key] - oldCounts.get(key, 0)) / (now - since)
+				retResponse += key + ".count:" + str(self.counts[key]) + "\n"
+				retResponse += key + ".rate:" + ("%.2f" % rate) + "\n"
+				if key.startswith("command."):
+					command = key[len("command."):]
+					retResponse += key + ".errors:" + str(self.errors.get(command, 0)) + "\n"
+					retResponse += self.latencies[command].report(key + ".latency")
+
+			for name in ["spool", "journal"]:
+				if name in self.timings:
+					retResponse += self.timings[name].report(name)
+		finally:
+			self.lock.release()
+
+		return(retResponse)
+
+# The metrics of this process.
+metrics = Metrics()
+
 class Net:
 
+	# Number of bits in an address, per address family.
+	addressBits = {
+		4: 32,
+		6: 128,
+	}
+
 	def dot2long(dot):
 	
 		"""
@@ -251,8 +719,63 @@ class Net:
 
 		return (ip_long & nm_long == na_long)
 
+	def addr2long(address):
+		"""
+		Convert an IPv4 or IPv6 address to a tuple of its address family (4 or
+		6) and the address as a long integer. Returns None if address isn't
+		an IP address.
+		addr2long("192.168.1.5") -> (4, 3232235781)
+		addr2long("::1") -> (6, 1)
+		"""
+		try:
+			return((4, Net.dot2long(address)))
+		except (socket.error, ValueError):
+			pass
+
+		try:
+			high, low = struct.unpack('>QQ', socket.inet_pton(socket.AF_INET6, address))
+		except (socket.error, ValueError):
+			return(None)
+
+		return((6, (high << 64) | low))
+
+	def clientAddress(host):
+		"""
+		Convert the address of a client like addr2long, treating IPv4-mapped
+		IPv6 addresses (::ffff:a.b.c.d) as IPv4 addresses.
+		"""
+		address = Net.addr2long(host)
+
+		if address != None and address[0] == 6 and address[1] >> 32 == 0xffff:
+			address = (4, address[1] & 0xffffffffL)
+
+		return(address)
+
+	def mask2prefix(mask, bits):
+		"""
+		Return the prefix length of a netmask, or None if the netmask isn't a
+		prefix (contiguous ones followed by zeros).
+		mask2prefix(4294967040, 32) -> 24
+		"""
+		for prefixLength in range(bits, -1, -1):
+			if mask == Net.prefix2mask(prefixLength, bits):
+				return(prefixLength)
+
+		return(None)
+
+	def prefix2mask(prefixLength, bits):
+		"""
+		Convert a prefix length to a netmask of bits bits.
+		prefix2mask(24, 32) -> 4294967040
+		"""
+		return(((1L << bits) - 1) ^ ((1L << (bits - prefixLength)) - 1))
+
 	dot2long = staticmethod(dot2long)
 	long2dot = staticmethod(long2dot)
+	addr2long = staticmethod(addr2long)
+	clientAddress = staticmethod(clientAddress)
+	mask2prefix = staticmethod(mask2prefix)
+	prefix2mask = staticmethod(prefix2mask)
 	nm_dot2bit = staticmethod(nm_dot2bit)
 	nm_bit2dot = staticmethod(nm_bit2dot)
 	inNet = staticmethod(inNet)
@@ -274,547 +797,4398 @@ class Access:
 		self.host = host
 		self.netmask = netmask
 
-		if self.netmask != "" and not '.' in self.netmask:
+		if self.netmask != "" and not '.' in self.netmask and not ':' in self.host:
 			# Netmask in bit form, convert.
 			self.netmask = Net.nm_bit2dot(int(self.netmask))
 
-class Queue:
+		# The host in integer form, so matching a client's address takes a
+		# single AND: the address family (4 or 6), network and netmask, and
+		# the netmask's prefix length if it has one. IPv6 netmasks are always
+		# given as a prefix length.
+		self.family = None
+		self.network = None
+		self.mask = None
+		self.prefixLength = None
+
+		address = Net.addr2long(self.host)
+		if address != None:
+			self.family, self.network = address
+			bits = Net.addressBits[self.family]
+
+			if self.netmask == "":
+				self.mask = (1L << bits) - 1
+			elif self.family == 6:
+				self.mask = Net.prefix2mask(int(self.netmask), bits)
+			else:
+				self.mask = Net.dot2long(self.netmask)
+
+			self.prefixLength = Net.mask2prefix(self.mask, bits)
+
+	def matches(self, password, username, host, address = None):
+		"""
+		Check if this rule applies to a client at host (address is the
+		client's address as returned by Net.clientAddress) that sent username
+		and password.
+		"""
+		if self.host != "" and host != self.host:
+			if self.mask == None or address == None or address[0] != self.family or address[1] & self.mask != self.network:
+				return(False)
+		if self.username != "" and username != self.username:
+			return(False)
+		if self.password != "" and password != self.password:
+			return(False)
 
-	""" 
-	Base queue class that handles generic actions on queues. Derive new queue
-	types (FILO, FIFO, etc) from this class.
-	"""
+		return(True)
 
-	def __init__(self, name, type, size, overflow, spooldir):
-		if type != "filo" and type != "fifo":
-			raise UserWarning, "Wrong value for type"
-		if size < 1:
-			raise UserWarning, "Wrong value for size"
-		if overflow != "deny" and overflow != "pop":
-			raise UserWarning, "Wrong value for overflow"
-			
-		self.name = name
-		self.type = type
-		self.size = size
-		self.overflow = overflow
-		self.spooldir = spooldir
+class CidrTrie:
 
-		Log.verboseMsg("Registered new queue '" + self.name + "' (type:" + self.type + ", size: " + str(self.size) + ", overflow: " + self.overflow + ")")
+	"""
+	Binary trie of network prefixes. Finds all the networks that contain an
+	address by walking the bits of the address once, so the cost of a lookup
+	depends on the length of the address instead of on the number of
+	networks.
+	"""
 
-		self.readSpool()
+	def __init__(self, bits):
+		self.bits = bits
 
-	def __len__(self):
-		return(len(self.queue))
+		# A node is a list of the child for a 0 bit, the child for a 1 bit
+		# and the values stored for the prefix leading to the node.
+		self.root = [None, None, []]
 
-	def push(self, message):
-		retResponse = ""
-		
-		if len(self.queue) == self.size:
-			if self.overflow == "pop":
-				self.pop()
-			elif self.overflow == "deny":
-				raise DataqError, 203 # Queue is full
-				
-		Log.verboseMsg("Pushing to " + self.name + ": " + message)
+	def insert(self, network, prefixLength, value):
+		node = self.root
 
-		self.queue.append(message)
+		for i in range(prefixLength):
+			bit = int((network >> (self.bits - 1 - i)) & 1)
+			if node[bit] == None:
+				node[bit] = [None, None, []]
+			node = node[bit]
 
-		return(retResponse)
-				
-	def stat(self):
-		retResponse = ""
+		node[2].append(value)
 
-		Log.verboseMsg("Statistics for " + self.name)
+	def lookup(self, address):
+		"""
+		Return the values stored for all the networks that contain address,
+		from the shortest to the longest prefix.
+		"""
+		retValues = []
 
-		retResponse += "name:" + self.name + "\n"
-		retResponse += "type:" + self.type + "\n"
-		retResponse += "size:" + str(self.size) + "\n"
-		retResponse += "overflow:" + self.overflow + "\n"
-		retResponse += "messages:" + str(len(self.queue)) + "\n"
+		node = self.root
+		shift = self.bits - 1
 
-		return(retResponse)
+		while node != None:
+			if len(node[2]) > 0:
+				retValues.extend(node[2])
+			if shift < 0:
+				break
+			node = node[int((address >> shift) & 1)]
+			shift -= 1
 
-	def clear(self):
+		return(retValues)
 
-		retResponse = ""
-		self.queue = []
+class AccessList:
 
-		return(retResponse)
+	"""
+	An ordered list of access rules. The first rule that applies to a client
+	decides whether it is allowed or denied access.
 
-	def addAccess(self, access):
+	Rules for an IP network are indexed in a CidrTrie per address family,
+	rules for a hostname in a dictionary. Only the rules found through the
+	indexes (and rules for any host) have to be checked, in the order of
+	their position in the list.
+	"""
 
-		Log.verboseMsg("Adding '" + (access.sense) + "' access for P:" + str(access.password) + " U:" + str(access.username) + " H: " + str(access.host) + " (NM: " + str(access.netmask) + ") to queue '" + self.name + "'")
-		access.queuename = self.name
-		self.accessList.append(access)
-
-	def hasAccess(self, password, username, host):
-
-		for access in self.accessList:
-
-			matchHost = False
-			matchUsername = False
-			matchPassword = False
-
-			if access.host != "" and access.netmask != "" and Net.inNet(host, access.host, access.netmask):
-				matchHost = True
-			if access.host != "" and host == access.host:
-				matchHost = True
-			if access.username != "" and username == access.username:
-				matchUsername = True
-			if access.password != "" and password == access.password:
-				matchPassword = True
-
-			if (access.host == "" or matchHost) and (access.username == "" or matchUsername) and (access.password == "" or matchPassword):
-				if access.sense == "deny":
-					return(False)
-				if access.sense == "allow" or access.sense == "":
-					return(True)
-				
-		return(None)
+	def __init__(self):
+		self.rules = []
 
-	def writeSpool(self):
-		
-		Log.verboseMsg("Writing queue '" + self.name + "' to "+self.spooldir+self.name+".")
+		# Indexes of the rules (positions in self.rules)
+		self.anyHost = []
+		self.byHost = {}
+		self.tries = {
+			4: CidrTrie(Net.addressBits[4]),
+			6: CidrTrie(Net.addressBits[6]),
+		}
 
-		try:
-			f = open(self.spooldir+self.name, 'w')
-			for data in self.queue:
-				f.write(data+'\n')
-			f.close()
-		except IOError, e:
-			Log.verboseErr("Couldn't write '"+self.name+"' queue's data to "+self.spooldir+self.name)
-		
-	def readSpool(self):
-		
-		Log.verboseMsg("Reading queue '"+self.name+"' from "+self.spooldir+self.name)
+	def __len__(self):
+		return(len(self.rules))
+
+	def add(self, access):
+		ordinal = len(self.rules)
+		self.rules.append(access)
+
+		if access.host == "":
+			self.anyHost.append(ordinal)
+		elif access.prefixLength != None and access.network & access.mask == access.network:
+			self.tries[access.family].insert(access.network, access.prefixLength, ordinal)
+		elif access.mask == None or access.network & access.mask != access.network:
+			# A hostname, or a network address with bits outside of its
+			# netmask, which only matches the host itself.
+			if not access.host in self.byHost:
+				self.byHost[access.host] = []
+			self.byHost[access.host].append(ordinal)
+		else:
+			# A netmask that isn't a prefix can't be indexed.
+			self.anyHost.append(ordinal)
 
-		try:
-			f = open(self.spooldir+self.name, 'r')
-			self.queue = f.readlines()
-		except IOError, e:
-			Log.verboseWarn("Couldn't read '"+self.name+"' queue's data from "+self.spooldir+self.name)
+	def hasAccess(self, password, username, host, address = None):
+		"""
+		Returns True if the first matching rule allows access, False if it
+		denies access and None if no rule matches.
+		"""
+		candidates = self.anyHost[:]
+		if host in self.byHost:
+			candidates.extend(self.byHost[host])
+		if address != None:
+			candidates.extend(self.tries[address[0]].lookup(address[1]))
+		candidates.sort()
+
+		for ordinal in candidates:
+			access = self.rules[ordinal]
+			if access.matches(password, username, host, address):
+				return(access.sense == "allow")
 
-class FifoQueue(Queue):
+		return(None)
+
+class Waiter:
 
 	"""
-	FIFO Queue: First message in is the first message out. (Queue)
+	A client waiting on an empty queue for a message to arrive (BPOP). The
+	queue hands a pushed message directly to the first waiting client,
+	along with its priority, so it can be put back as it was if the client
+	is gone.
 	"""
-		
-	def __init__(self, name, size, overflow, spooldir):
-		self.queue = []
-		self.accessList = []
-
-		Queue.__init__(self, name, "fifo", size, overflow, spooldir)
-
-	def pop(self):
-		retResponse = ""
 
-		Log.verboseMsg("POPing from " + self.name)
+	def __init__(self):
+		self.message = None
+		self.priority = 0
+		self.queue = None
+		self.event = threading.Event()
 
-		if len(self.queue) > 0:
-			retResponse = self.queue.pop(0)
+	def deliver(self, message, priority = 0):
+		self.message = message
+		self.priority = priority
+		self.event.set()
 
-		return(retResponse)
-
-	def peek(self):
-		retResponse = ""
+	def wait(self, timeout):
+		self.event.wait(timeout)
 
-		Log.verboseMsg("PEEKing at " + self.name)
-
-		if len(self.queue) > 0:
-			retResponse = self.queue[0]
-
-		return(retResponse)
+		return(self.message)
 
-class FiloQueue(Queue):
+class Scheduler:
 
 	"""
-	FILO Queue: First message in is the first out. (Stack)
+	Wakes up queues at the times they ask for, by calling the queue's method
+	named action with the time of the wake-up. The method returns the time
+	of the queue's next wake-up, or None.
+
+	The scheduler pushes delayed messages onto their queues when they are
+	due (see Queue.releaseDue). Every queue keeps its delayed messages in a
+	heap ordered by due time, and schedules a single wake-up here for the
+	first of them. The wake-ups of all queues are kept in a heap as well, so
+	delaying a message and releasing it both take O(log n) time, and nothing
+	is ever scanned. The sweeper removes expired messages from queues that
+	nobody reads from (see Queue.sweep).
+
+	The thread that handles the wake-ups is started when the first one is
+	scheduled (again after a fork).
 	"""
 
-	def __init__(self, name, size, overflow, spooldir):
-		self.queue = []
-		self.accessList = []
-		Queue.__init__(self, name, "filo", size, overflow, spooldir)
+	def __init__(self, action):
+		self.action = action
+		# (time, queue)
+		self.wakeups = []
+		self.condition = threading.Condition()
+		self.pid = None
+		self.thread = None
+		self.stopped = False
 
-	def pop(self):
-		retResponse = ""
+	def schedule(self, queue, due):
+		"""
+		Wake up queue at time due.
+		"""
+		self.condition.acquire()
+		try:
+			if self.pid != os.getpid():
+				self.pid = os.getpid()
+				self.thread = threading.Thread(target=self.run)
+				self.thread.setDaemon(True)
+				self.thread.start()
+
+			heapq.heappush(self.wakeups, (due, queue))
+			if self.wakeups[0][0] == due:
+				self.condition.notify()
+		finally:
+			self.condition.release()
+
+	def run(self):
+		while True:
+			self.condition.acquire()
+			try:
+				while True:
+					now = time.time()
+					if self.stopped:
+						return
+					if len(self.wakeups) == 0:
+						self.condition.wait()
+					elif self.wakeups[0][0] > now:
+						self.condition.wait(self.wakeups[0][0] - now)
+					else:
+						break
+
+				due, queue = heapq.heappop(self.wakeups)
+			finally:
+				self.condition.release()
+
+			nextDue = getattr(queue, self.action)(due)
+			if nextDue != None:
+				self.schedule(queue, nextDue)
+
+	def stop(self):
+		"""
+		Stop waking up queues (when the server shuts down; delayed messages
+		are kept in the spool file).
+		"""
+		self.condition.acquire()
+		try:
+			self.stopped = True
+			self.condition.notify()
+		finally:
+			self.condition.release()
 
-		Log.verboseMsg("POPing from " + self.name)
+		if self.thread != None and self.pid == os.getpid():
+			self.thread.join(1)
 
-		if len(self.queue) > 0:
-			retResponse = self.queue.pop()
+# Releases the delayed messages of the queues in this process.
+scheduler = Scheduler("releaseDue")
 
-		return(retResponse)
+# Removes the expired messages from idle queues in this process. Separate
+# from the scheduler, so sweeping a large queue never holds up releasing
+# delayed messages.
+sweeper = Scheduler("sweep")
 
-	def peek(self):
-		retResponse = ""
+class Flusher:
 
-		Log.verboseMsg("PEEKing at " + self.name)
+	"""
+	Writes the journal records of queues to disk according to a flush policy:
 
-		if len(self.queue) > 0:
-			retResponse = self.queue[-1]
+	  every-op      Write and fsync the records of each operation right away.
+	  every N ms    Write and fsync the records of all changed queues every N
+	                milliseconds.
+	  every N ops   Write and fsync the records of all changed queues after N
+	                operations.
 
-		return(retResponse)
+	With the last two policies, all the records of a queue that were added
+	since the previous flush share a single write and fsync.
 
-class QueuePool:
-	
-	"""
-	Intermediary class between queues and the server's request handler.  This
-	class takes care of creation, communication and access checking for queues.
+	Once a queue's journal holds more than compactOps records or compactSize
+	bytes, the queue is compacted: its complete contents are written to the
+	spool file and the journal is emptied. A value of 0 disables the
+	threshold.
 	"""
 
-	def __init__(self, spoolDir, spoolEvents):
-		self.queues = {}
-		self.accessList = []
-
-		self.spoolDir = spoolDir
-		self.spoolEvents = spoolEvents
+	def __init__(self, policy = "every-op", compactOps = 0, compactSize = 0):
+		self.everyOp, self.interval, self.ops = Flusher.parsePolicy(policy)
+		self.compactOps = compactOps
+		self.compactSize = compactSize
 
-		if self.spoolDir[-1] != '/':
-			self.spoolDir += '/'
+		# Queues with journal records that haven't been flushed yet.
+		self.dirtyQueues = {}
+		self.opCount = 0
+		self.condition = threading.Condition()
 
-	def createQueue(self, name, type, size, overflow):
-		if type == "fifo":
-			newQueue = FifoQueue(name, size, overflow, self.spoolDir)
-		elif type == "filo":
-			newQueue = FiloQueue(name, size, overflow, self.spoolDir)
-		else:
-			raise UserWarning, "Wrong value for type"
+		if not self.everyOp:
+			thread = threading.Thread(target=self.run)
+			thread.setDaemon(True)
+			thread.start()
 
-		self.queues[name] = newQueue
+	def parsePolicy(policy):
+		"""
+		Parse a flush policy. Returns a tuple (everyOp, interval, ops) where
+		interval is in seconds. Unused values are None.
+		"""
+		words = policy.split()
 
-		return(newQueue)
+		try:
+			if words == ["every-op"]:
+				return(True, None, None)
+			if len(words) == 3 and words[0] == "every" and int(words[1]) > 0:
+				if words[2] == "ms":
+					return(False, int(words[1]) / 1000.0, None)
+				if words[2] == "ops":
+					return(False, None, int(words[1]))
+		except ValueError:
+			pass
 
-	def addAccess(self, access):
-		Log.verboseMsg("Adding '" + (access.sense) + "' access for P:" + str(access.password) + " U:" + str(access.username) + " H: " + str(access.host) + " (NM: " + str(access.netmask) + ") to queuePool")
-		#Log.verboseMsg("Adding '" + str(access.sense) + "' access for P:" + str(access.password) + " U:" + str(access.username) + " H: " + str(access.host) + " to queuePool")
-		self.accessList.append(access)
-
-	def hasAccess(self, password, username, host):
-
-		for access in self.accessList:
-
-			matchHost = False
-			matchUsername = False
-			matchPassword = False
-
-			if access.host != "" and access.netmask != "" and Net.inNet(host, access.host, access.netmask):
-				matchHost = True
-			if access.host != "" and host == access.host:
-				matchHost = True
-			if access.username != "" and username == access.username:
-				matchUsername = True
-			if access.password != "" and password == access.password:
-				matchPassword = True
-
-			if (access.host == "" or matchHost) and (access.username == "" or matchUsername) and (access.password == "" or matchPassword):
-				if access.sense == "deny":
-					return(False)
-				if access.sense == "allow" or access.sense == "":
-					return(True)
-				
-		return(None)
+		raise UserWarning, "Wrong value for flush policy"
 
-	def checkAccess(self, password, username, host, queue = None):
-		qpAccess = queuePool.hasAccess(password, username, host)
-		Log.verboseMsg("QueuePoolAccess = " + str(qpAccess))
+	parsePolicy = staticmethod(parsePolicy)
+
+	def dirty(self, queue):
+		"""
+		Register that queue has new journal records.
+		"""
+		if self.everyOp:
+			queue.flushJournal()
+			return
+
+		self.condition.acquire()
+		try:
+			self.dirtyQueues[queue] = True
+			self.opCount += 1
+			if self.ops != None and self.opCount >= self.ops:
+				self.condition.notify()
+		finally:
+			self.condition.release()
+
+	def run(self):
+		while True:
+			self.condition.acquire()
+			try:
+				if self.interval != None:
+					self.condition.wait(self.interval)
+				else:
+					while self.opCount < self.ops:
+						self.condition.wait()
+			finally:
+				self.condition.release()
+
+			self.flush()
+
+	def flush(self):
+		"""
+		Flush the journals of all queues that have changed.
+		"""
+		self.condition.acquire()
+		try:
+			queues = self.dirtyQueues.keys()
+			self.dirtyQueues = {}
+			self.opCount = 0
+		finally:
+			self.condition.release()
+
+		for queue in queues:
+			queue.flushJournal()
+
+class SegmentStore:
+
+	"""
+	Disk-backed storage for the messages of a queue, for queues that may grow
+	larger than would fit in memory. It behaves like the deque that normally
+	holds a queue's messages.
+
+	Only the messages at the head (oldest) and the tail (newest) of the queue
+	are kept in memory. When the tail grows too large, its oldest messages
+	are moved to a segment file in the spool directory. Segments hold
+	segmentSize messages each, and are read back (memory-mapped) as soon as
+	the messages in them are needed again.
+
+	Segment files don't change once they've been written, so they are part
+	of the persistent state of the queue: the spool file refers to them
+	instead of holding their messages (see snapshot). A segment that has
+	been read back is released. If the queue has a journal, the spool file
+	on disk may still refer to it, so its file is only deleted after the
+	next spool file has been written (see purge).
+	"""
+
+	segmentSize = 10000
+
+	def __init__(self, path, journaled = False, segmentSize = None):
+		self.path = path
+		self.journaled = journaled
+		if segmentSize != None:
+			self.segmentSize = segmentSize
+		self.head = deque()
+		# The segment the messages in the head were read from, as (number,
+		# index of the first message in the head), or None if the head
+		# wasn't read from a segment.
+		self.headSegment = None
+		# Segments holding the messages between the head and the tail, as
+		# (number, index of the first message, number of messages).
+		self.segments = deque()
+		self.tail = deque()
+		self.length = 0
+		# Numbers of the released segments whose files haven't been deleted
+		# yet.
+		self.released = []
+
+		# Number new segments after the ones left by a previous run.
+		self.segmentNr = 0
+		for segmentPath in glob.glob(self.path + ".seg.*"):
+			try:
+				self.segmentNr = max(self.segmentNr, int(segmentPath[len(self.path) + 5:]))
+			except ValueError:
+				pass
+
+	def __len__(self):
+		return(self.length)
+
+	def __iter__(self):
+		for message in self.head:
+			yield message
+		for segment in self.segments:
+			for message in self.readSegment(segment):
+				yield message
+		for message in self.tail:
+			yield message
+
+	def __getitem__(self, index):
+		if self.length == 0:
+			raise IndexError, "SegmentStore index out of range"
+
+		if index == 0:
+			if len(self.head) == 0 and len(self.segments) > 0:
+				self.loadHead()
+			if len(self.head) > 0:
+				return(self.head[0])
+			return(self.tail[0])
+		elif index == -1:
+			if len(self.tail) == 0 and len(self.segments) > 0:
+				self.tail = self.loadSegment(self.segments.pop())
+			if len(self.tail) > 0:
+				return(self.tail[-1])
+			return(self.head[-1])
+
+		raise IndexError, "SegmentStore only supports index 0 and -1"
+
+	def append(self, message):
+		self.tail.append(message)
+		self.length += 1
+
+		if len(self.tail) >= 2 * self.segmentSize:
+			self.spill(self.segmentSize)
+
+	def extend(self, messages):
+		for message in messages:
+			self.append(message)
+
+	def popleft(self):
+		if self.length == 0:
+			raise IndexError, "pop from an empty SegmentStore"
+
+		if len(self.head) == 0:
+			if len(self.segments) > 0:
+				self.loadHead()
+			else:
+				self.head.append(self.tail.popleft())
+
+		self.length -= 1
+		message = self.head.popleft()
+
+		if self.headSegment != None:
+			number, first = self.headSegment
+			self.headSegment = (number, first + 1)
+			self.releaseHead()
+
+		return(message)
+
+	def pop(self):
+		if self.length == 0:
+			raise IndexError, "pop from an empty SegmentStore"
+
+		if len(self.tail) == 0:
+			if len(self.segments) > 0:
+				self.tail = self.loadSegment(self.segments.pop())
+			else:
+				self.tail.append(self.head.pop())
+				self.releaseHead()
+
+		self.length -= 1
+		return(self.tail.pop())
+
+	def clear(self):
+		if self.headSegment != None:
+			self.release(self.headSegment[0])
+		for number, first, count in self.segments:
+			self.release(number)
+
+		self.head.clear()
+		self.headSegment = None
+		self.segments.clear()
+		self.tail.clear()
+		self.length = 0
+
+	def addSegment(self, number, first, count):
+		"""
+		Add count messages of the existing segment file number, starting at
+		message first, after the messages in the store (when reading a spool
+		file).
+		"""
+		if not os.path.exists(self.segmentPath(number)):
+			Log.error("Segment %s is missing, skipping its %i messages", self.segmentPath(number), count)
+			return
+
+		if len(self.tail) > 0:
+			# Keep the messages in order.
+			self.spill(len(self.tail))
+
+		self.segments.append((number, first, count))
+		self.length += count
+
+	def snapshot(self):
+		"""
+		Yield the contents of the store in order, for writing the spool file:
+		(number, first, count) tuples for messages in segment files, and the
+		messages that are only in memory.
+		"""
+		if self.headSegment != None:
+			yield (self.headSegment[0], self.headSegment[1], len(self.head))
+		else:
+			for message in self.head:
+				yield message
+		for segment in self.segments:
+			yield segment
+		for message in self.tail:
+			yield message
+
+	def spill(self, count):
+		"""
+		Move the oldest count messages in the tail to a new segment file.
+		Each message is stored as a 4 byte length followed by the message
+		itself. The file is synced, as the spool file may refer to it.
+		"""
+		self.segmentNr += 1
+
+		records = []
+		for i in range(count):
+			message = self.tail.popleft()
+			records.append(struct.pack('>L', len(message)))
+			records.append(message)
+
+		f = open(self.segmentPath(self.segmentNr), 'wb')
+		f.write("".join(records))
+		f.flush()
+		os.fsync(f.fileno())
+		f.close()
+
+		self.segments.append((self.segmentNr, 0, count))
+
+	def segmentPath(self, number):
+		return(self.path + ".seg." + str(number))
+
+	def readSegment(self, segment):
+		number, first, count = segment
+		messages = deque()
+
+		f = open(self.segmentPath(number), 'rb')
+		m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			offset = 0
+			index = 0
+			while offset < len(m) and index < first + count:
+				length = struct.unpack('>L', m[offset:offset + 4])[0]
+				if index >= first:
+					messages.append(m[offset + 4:offset + 4 + length])
+				offset += 4 + length
+				index += 1
+		finally:
+			m.close()
+			f.close()
+
+		return(messages)
+
+	def loadSegment(self, segment):
+		"""
+		Read the messages in a segment back into memory and release the
+		segment.
+		"""
+		messages = self.readSegment(segment)
+		self.release(segment[0])
+
+		return(messages)
+
+	def loadHead(self):
+		"""
+		Read the first segment into the head. The segment is released once
+		all its messages have been removed from the head.
+		"""
+		segment = self.segments.popleft()
+		self.head = self.readSegment(segment)
+		self.headSegment = (segment[0], segment[1])
+
+	def releaseHead(self):
+		if len(self.head) == 0 and self.headSegment != None:
+			self.release(self.headSegment[0])
+			self.headSegment = None
+
+	def release(self, number):
+		if self.journaled:
+			self.released.append(number)
+		else:
+			self.remove(number)
+
+	def purge(self):
+		"""
+		Delete the files of the released segments. Called after writing a
+		spool file, which no longer refers to them.
+		"""
+		for number in self.released:
+			self.remove(number)
+		self.released = []
+
+	def removeUnused(self):
+		"""
+		Delete the segment files that the store doesn't use, such as the ones
+		written by a previous run after its last spool file (their messages
+		are replayed from the journal).
+		"""
+		used = [self.segmentPath(number) for number, first, count in self.segments]
+		used.extend([self.segmentPath(number) for number in self.released])
+		if self.headSegment != None:
+			used.append(self.segmentPath(self.headSegment[0]))
+
+		for segmentPath in glob.glob(self.path + ".seg.*"):
+			if not segmentPath in used:
+				os.remove(segmentPath)
+
+	def remove(self, number):
+		try:
+			os.remove(self.segmentPath(number))
+		except OSError:
+			Log.error("Couldn't remove segment %s", self.segmentPath(number))
+
+class PriorityStore:
+
+	"""
+	Storage for the messages of a priority queue. Messages are kept in a
+	deque per priority, in the order in which they were pushed, so messages
+	with the same priority come out first in, first out. The priorities
+	that have messages are kept in a sorted list, so both the highest and
+	the lowest priority can be found directly.
+
+	This is used instead of a single heap of all messages, which would take
+	O(log n) time per push and pop. A heap isn't stable, so it would need
+	a sequence number per message to keep the FIFO order, and it can't
+	find the lowest priority for overflow 'pop'. Here, pushing or popping a
+	message with a priority that is already in use takes O(1) time. A new
+	priority is inserted into the sorted list, and an emptied one removed
+	from it, in O(p) time, where p is the number of distinct priorities in
+	use (usually just a few). That bound holds no matter how many messages
+	there are.
+
+	Messages added with append() or extend() (for instance when reading a
+	spool file written for another queue type) get priority 0.
+	"""
+
+	def __init__(self):
+		self.buckets = {}
+		self.priorities = []
+		self.length = 0
+
+	def __len__(self):
+		return(self.length)
+
+	def __iter__(self):
+		"""
+		Iterate over (priority, message) tuples, in the order in which they
+		would be popped.
+		"""
+		for priority in reversed(self.priorities):
+			for message in self.buckets[priority]:
+				yield (priority, message)
+
+	def push(self, priority, message):
+		try:
+			self.buckets[priority].append(message)
+		except KeyError:
+			self.buckets[priority] = deque([message])
+			bisect.insort(self.priorities, priority)
+
+		self.length += 1
+
+	def append(self, message):
+		self.push(0, message)
+
+	def extend(self, messages):
+		for message in messages:
+			self.push(0, message)
+
+	def pop(self):
+		"""
+		Remove and return the oldest message with the highest priority, as a
+		(priority, message) tuple.
+		"""
+		if self.length == 0:
+			raise IndexError, "pop from an empty PriorityStore"
+
+		return(self.remove(self.priorities[-1]))
+
+	def popLowest(self):
+		"""
+		Remove and return the oldest message with the lowest priority, as a
+		(priority, message) tuple.
+		"""
+		if self.length == 0:
+			raise IndexError, "pop from an empty PriorityStore"
+
+		return(self.remove(self.priorities[0]))
+
+	def remove(self, priority):
+		bucket = self.buckets[priority]
+		message = bucket.popleft()
+		if len(bucket) == 0:
+			del self.buckets[priority]
+			del self.priorities[bisect.bisect_left(self.priorities, priority)]
+
+		self.length -= 1
+		return((priority, message))
+
+	def peek(self):
+		"""
+		Return the message that would be popped next, as a (priority,
+		message) tuple.
+		"""
+		if self.length == 0:
+			raise IndexError, "peek at an empty PriorityStore"
+
+		priority = self.priorities[-1]
+		return((priority, self.buckets[priority][0]))
+
+	def lowest(self):
+		return(self.priorities[0])
+
+	def filter(self, function):
+		"""
+		Remove the messages for which function(message) is false, keeping the
+		others in order. Returns the number of messages removed.
+		"""
+		retRemoved = 0
+
+		for priority in self.priorities[:]:
+			bucket = self.buckets[priority]
+			kept = deque([message for message in bucket if function(message)])
+			retRemoved += len(bucket) - len(kept)
+
+			if len(kept) > 0:
+				self.buckets[priority] = kept
+			else:
+				del self.buckets[priority]
+				self.priorities.remove(priority)
+
+		self.length -= retRemoved
+		return(retRemoved)
+
+	def clear(self):
+		self.buckets.clear()
+		self.priorities = []
+		self.length = 0
+
+class MessageLog:
+
+	"""
+	Storage for the messages of a subscribe queue: a single log of messages
+	that is read by a number of readers (the subscribers), each at its own
+	position. Messages are numbered from the first message ever added, so
+	positions stay valid when old messages are removed. A message is
+	removed as soon as all readers have passed it.
+
+	The number of readers at each position is kept, so the log can tell
+	when the slowest reader moves on without looking at the other readers.
+	A reader whose position is before the first message (because messages
+	were removed on overflow or by a clear) is at the first message.
+	"""
+
+	def __init__(self, readers):
+		self.messages = []
+		# Index in self.messages of the first message, and its position.
+		self.offset = 0
+		self.first = 0
+
+		# Position -> number of readers at that position
+		self.readers = {0: readers}
+
+	def __len__(self):
+		return(len(self.messages) - self.offset)
+
+	def __iter__(self):
+		for index in xrange(self.offset, len(self.messages)):
+			yield self.messages[index]
+
+	def end(self):
+		"""
+		Return the position after the last message.
+		"""
+		return(self.first + len(self))
+
+	def get(self, position):
+		return(self.messages[self.offset + position - self.first])
+
+	def append(self, message):
+		self.messages.append(message)
+
+	def extend(self, messages):
+		self.messages.extend(messages)
+
+	def prepend(self, message):
+		"""
+		Put a removed message back in front of the first message. No reader
+		is at its position yet.
+		"""
+		if self.offset > 0:
+			self.offset -= 1
+			self.messages[self.offset] = message
+		else:
+			self.messages.insert(0, message)
+		self.first -= 1
+
+	def popleft(self):
+		"""
+		Remove and return the first message. Readers at the first message
+		move on to the next one.
+		"""
+		if len(self) == 0:
+			raise IndexError, "pop from an empty MessageLog"
+
+		message = self.messages[self.offset]
+		self.messages[self.offset] = None
+		self.offset += 1
+		self.first += 1
+
+		if self.first - 1 in self.readers:
+			self.readers[self.first] = self.readers.get(self.first, 0) + self.readers.pop(self.first - 1)
+
+		# Drop the removed messages from the list once they take up more
+		# than half of it, which keeps removing messages O(1) on average.
+		if self.offset > 1024 and self.offset * 2 > len(self.messages):
+			del self.messages[:self.offset]
+			self.offset = 0
+
+		return(message)
+
+	def move(self, old, new):
+		"""
+		Move a reader from position old to position new, and remove the
+		messages that all readers have passed.
+		"""
+		self.readers[old] -= 1
+		if self.readers[old] == 0:
+			del self.readers[old]
+		self.readers[new] = self.readers.get(new, 0) + 1
+
+		while len(self) > 0 and not self.first in self.readers:
+			self.popleft()
+
+	def clear(self):
+		readers = sum(self.readers.values())
+
+		self.first = self.end()
+		self.messages = []
+		self.offset = 0
+		self.readers = {self.first: readers}
+
+class Subscriber:
+
+	"""
+	A named subscriber of a subscribe queue. Takes the place of the queue for
+	the subscriber's POP, MPOP, BPOP and PEEK requests, which read the
+	queue's messages from the subscriber's own position (cursor).
+	"""
+
+	def __init__(self, queue, subscriber):
+		self.queue = queue
+		self.name = queue.name
+		self.subscriber = subscriber
+		self.cursor = 0
+
+		# Clients of this subscriber blocked in BPOP.
+		self.waiters = deque()
+
+	def validName(subscriber):
+		"""
+		Return whether subscriber can be used as a subscriber's name in a
+		queue URI option.
+		"""
+		for char in " \t\n@?&=":
+			if char in subscriber:
+				return(False)
+
+		return(subscriber != "")
+
+	validName = staticmethod(validName)
+
+	def pop(self):
+		retResponse = ""
+
+		messages = self.queue.read(self, 1)
+		if len(messages) > 0:
+			retResponse = messages[0]
+
+		return(retResponse)
+
+	def popMany(self, count):
+		return(self.queue.read(self, count))
+
+	def peek(self):
+		return(self.queue.peekAt(self))
+
+	def wait(self, waiter):
+		return(self.queue.waitFor(self, waiter))
+
+	def cancelWait(self, waiter):
+		return(self.queue.cancelWaitFor(self, waiter))
+
+	def returnMessage(self, waiter, message):
+		self.queue.rewind(self, message)
+
+	def bpop(self, timeout):
+		retResponse = ""
+
+		if timeout == 0:
+			return(self.pop())
+
+		waiter = Waiter()
+		message = self.wait(waiter)
+
+		if message == None:
+			waiter.wait(timeout)
+			message = self.cancelWait(waiter)
+
+		if message != None:
+			retResponse = message
+
+		return(retResponse)
+
+class ExpiringMessage(str):
+
+	"""
+	A message that expires at a given time (a Unix timestamp). Messages that
+	don't expire are kept as plain strings, which this behaves just like, so
+	the storage of the queues and the request handlers don't need to know
+	the difference.
+	"""
+
+	def __new__(cls, message, expires):
+		self = str.__new__(cls, message)
+		self.expires = expires
+
+		return(self)
+
+class Queue:
+
+	""" 
+	Base queue class that handles generic actions on queues. Derive new queue
+	types (FILO, FIFO, etc) from this class.
+
+	Messages pushed with a ttl (or onto a queue with a ttl) expire ttl
+	seconds after they become visible. Expired messages are removed when
+	they would be popped or peeked at (see expire); the sweeper removes them
+	from queues that nobody reads from (see sweep).
+	"""
+
+	# Minimum number of seconds between sweeps of a queue, and how long a
+	# queue must not have been read from before it's swept.
+	sweepInterval = 1.0
+
+	# Number of bytes read at a time from spool files and journals.
+	readSize = 65536
+
+	def __init__(self, name, type, size, overflow, spooldir, flusher = None, storage = "memory", method = "singleton", ttl = 0, segmentSize = SegmentStore.segmentSize):
+		if type != "filo" and type != "fifo" and type != "priority":
+			raise UserWarning, "Wrong value for type"
+		if size < 1:
+			raise UserWarning, "Wrong value for size"
+		if overflow != "deny" and overflow != "pop":
+			raise UserWarning, "Wrong value for overflow"
+		if storage != "memory" and storage != "disk":
+			raise UserWarning, "Wrong value for storage"
+		if storage == "disk" and type == "priority":
+			raise UserWarning, "Wrong value for storage"
+		if method != "singleton" and method != "subscribe":
+			raise UserWarning, "Wrong value for method"
+		if method == "subscribe" and (type != "fifo" or storage != "memory"):
+			raise UserWarning, "Wrong value for method"
+		if ttl < 0 or ttl != ttl or ttl == float("inf") or (ttl > 0 and storage == "disk"):
+			raise UserWarning, "Wrong value for ttl"
+		if segmentSize < 1:
+			raise UserWarning, "Wrong value for segment"
+			
+		self.name = name
+		self.type = type
+		self.size = size
+		self.overflow = overflow
+		self.spooldir = spooldir
+		self.storage = storage
+		self.method = method
+		self.ttl = ttl
+
+		if self.storage == "disk":
+			self.queue = SegmentStore(self.spooldir + self.name, flusher != None, segmentSize)
+		elif self.type == "priority":
+			self.queue = PriorityStore()
+		elif self.method == "subscribe":
+			self.queue = MessageLog(len(self.subscribers))
+		else:
+			self.queue = deque()
+
+		# Guards self.queue against concurrent access by the request handler
+		# threads. Reentrant because overflow handling pops from within push.
+		self.lock = threading.RLock()
+
+		# Clients blocked in BPOP, in the order in which they started waiting.
+		# There are only waiters while the queue is empty.
+		self.waiters = deque()
+
+		# Messages that aren't due yet: a heap of (due, sequence number,
+		# priority, message), and the time of the wake-up scheduled for the
+		# first of them.
+		self.delayed = []
+		self.delayedSeq = 0
+		self.wakeup = None
+
+		# True while releasing delayed messages, so the journal records of
+		# all released messages are flushed together.
+		self.releasing = False
+
+		# Number of messages that expired, the time of the sweep scheduled
+		# for the queue (None if none of its messages expire) and the time
+		# the queue was last read from.
+		self.expired = 0
+		self.sweepAt = None
+		self.lastRead = None
+
+		Log.info("Registered new queue '%s' (type:%s, size: %i, overflow: %s, storage: %s)", self.name, self.type, self.size, self.overflow, self.storage)
+
+		self.journalFile = None
+		self.journalRecords = []
+		self.journalOps = 0
+		self.journalSize = 0
+		self.flusher = flusher
+
+		# Generation of the spool file. The journal only applies to the spool
+		# file with the same generation.
+		self.spoolGeneration = 0
+
+		self.readSpool()
+
+		if self.flusher != None:
+			# Start with a fresh journal on top of an up-to-date spool file.
+			self.writeSpool()
+			self.openJournal()
+
+		if self.storage == "disk":
+			self.queue.removeUnused()
+
+		if len(self.delayed) > 0:
+			self.wakeup = self.delayed[0][0]
+			scheduler.schedule(self, self.wakeup)
+
+		# Messages in disk storage never expire, so there's no need to read
+		# them all.
+		if self.storage != "disk":
+			nextExpiry = self.nextExpiry()
+			if nextExpiry != None:
+				self.expireAt(nextExpiry)
+
+	def __len__(self):
+		return(len(self.queue))
+
+	def push(self, message, priority = 0):
+		"""
+		Push a message onto the queue. The priority is only used by priority
+		queues.
+		"""
+		retResponse = ""
+		
+		self.lock.acquire()
+		try:
+			if len(self.waiters) > 0:
+				Log.debug("Handing message for %s to waiting client: %s", self.name, message)
+				self.waiters.popleft().deliver(message)
+				return(retResponse)
+
+			# Delayed messages keep their room in a queue that denies new
+			# messages on overflow.
+			if len(self.queue) + len(self.delayed) >= self.size and self.overflow == "deny":
+				raise DataqError, 203 # Queue is full
+			if len(self.queue) == self.size and self.overflow == "pop":
+				self.pop()
+					
+			Log.debug("Pushing to %s: %s", self.name, message)
+
+			self.queue.append(message)
+			self.journal(Queue.messageRecord("P", message))
+		finally:
+			self.lock.release()
+
+		return(retResponse)
+
+	def pushMany(self, messages, priority = 0):
+		"""
+		Push messages onto the queue. The priority is only used by priority
+		queues.
+		"""
+		retResponse = ""
+
+		self.lock.acquire()
+		try:
+			# Messages for clients waiting in BPOP never enter the queue.
+			handOff = min(len(self.waiters), len(messages))
+
+			if len(self.queue) + len(self.delayed) + len(messages) - handOff > self.size:
+				if self.overflow == "deny":
+					raise DataqError, 203 # Queue is full
+
+			for message in messages[:handOff]:
+				self.waiters.popleft().deliver(message)
+			messages = messages[handOff:]
+
+			if len(self.queue) + len(messages) > self.size:
+				messages = self.makeRoom(messages)
+
+			Log.debug("Pushing %i messages to %s", len(messages), self.name)
+
+			self.queue.extend(messages)
+			self.journal("".join([Queue.messageRecord("P", message) for message in messages]))
+		finally:
+			self.lock.release()
+
+		return(retResponse)
+
+	def delay(self, messages, priority, due):
+		"""
+		Push messages that stay invisible until time due, when they are
+		pushed onto the queue like any other message (see releaseDue).
+		Either all messages are accepted or none are. A queue that denies
+		new messages on overflow keeps room for its delayed messages;
+		otherwise at most 'size' messages can be delayed.
+		"""
+		retResponse = ""
+		schedule = False
+
+		self.lock.acquire()
+		try:
+			if self.overflow == "deny":
+				full = len(self.queue) + len(self.delayed) + len(messages) > self.size
+			else:
+				full = len(self.delayed) + len(messages) > self.size
+			if full:
+				raise DataqError, 203 # Queue is full
+
+			Log.debug("Delaying %i messages for %s until %f", len(messages), self.name, due)
+
+			records = []
+			for message in messages:
+				self.delayedSeq += 1
+				heapq.heappush(self.delayed, (due, self.delayedSeq, priority, message))
+				records.append(Queue.messageRecord("D", message, struct.pack('>dl', due, priority)))
+			self.journal("".join(records))
+
+			if self.wakeup == None or due < self.wakeup:
+				self.wakeup = due
+				schedule = True
+		finally:
+			self.lock.release()
+
+		if schedule:
+			scheduler.schedule(self, due)
+
+		return(retResponse)
+
+	def releaseDue(self, wakeup):
+		"""
+		Push the delayed messages that are due onto the queue. Called by the
+		scheduler at time wakeup. Returns the time of the next wake-up, or
+		None if there are no delayed messages left (or if the wake-up was
+		superseded by an earlier one).
+		"""
+		retWakeup = None
+		released = 0
+
+		self.lock.acquire()
+		try:
+			if wakeup != self.wakeup:
+				return(retWakeup)
+
+			self.releasing = True
+
+			now = time.time()
+			while len(self.delayed) > 0 and self.delayed[0][0] <= now:
+				due, seq, priority, message = heapq.heappop(self.delayed)
+				self.journal(Queue.journalRecord("R", "1"))
+				released += 1
+				if Queue.hasExpired(message, now):
+					# Released too late, while the server was down.
+					self.expired += 1
+					continue
+				try:
+					self.push(message, priority)
+				except DataqError, e:
+					Log.warning("Dropping delayed message for %s: %s", self.name, e)
+
+			if len(self.delayed) > 0:
+				retWakeup = self.delayed[0][0]
+			self.wakeup = retWakeup
+		finally:
+			self.releasing = False
+			self.lock.release()
+
+		if released > 0 and self.journalFile != None:
+			self.flusher.dirty(self)
+
+		return(retWakeup)
+
+	def delayedRecords(self):
+		"""
+		Yield the journal records of the delayed messages, for writing the
+		spool file. Must be called with the queue's lock held.
+		"""
+		for due, seq, priority, message in sorted(self.delayed):
+			yield Queue.messageRecord("D", message, struct.pack('>dl', due, priority))
+
+	def hasExpired(message, now):
+		"""
+		Return whether message has expired at time now.
+		"""
+		return(isinstance(message, ExpiringMessage) and message.expires <= now)
+
+	hasExpired = staticmethod(hasExpired)
+
+	def expire(self, now = None):
+		"""
+		Remove the expired messages that would be popped next, up to the
+		first message that hasn't expired, so expired messages are never
+		handed out. Called before popping or peeking at the queue. Must be
+		called with the queue's lock held.
+		"""
+		# No sweep is scheduled only if none of the messages expire.
+		if self.sweepAt == None:
+			return
+
+		if now == None:
+			now = time.time()
+		self.lastRead = now
+
+		count = 0
+		while len(self.queue) > 0 and Queue.hasExpired(self.head(), now):
+			self.takeHead()
+			count += 1
+
+		if count > 0:
+			Log.debug("Removed %i expired messages from %s", count, self.name)
+			self.expired += count
+			self.journal(Queue.journalRecord("O", str(count)))
+
+	def expireAt(self, expires):
+		"""
+		Schedule a sweep of the queue for when a message that expires at time
+		expires has expired, unless an earlier sweep has been scheduled.
+		"""
+		# Called after the message was pushed, so a sweep that doesn't see
+		# the message can't have run after sweepAt was read here.
+		if self.sweepAt != None and expires >= self.sweepAt:
+			return
+
+		schedule = False
+
+		self.lock.acquire()
+		try:
+			sweepAt = max(expires, time.time() + Queue.sweepInterval)
+			if self.sweepAt == None or sweepAt < self.sweepAt:
+				self.sweepAt = sweepAt
+				schedule = True
+		finally:
+			self.lock.release()
+
+		if schedule:
+			sweeper.schedule(self, sweepAt)
+
+	def sweep(self, sweepAt):
+		"""
+		Remove all expired messages from the queue, unless it has been read
+		from recently (which removes the expired messages that would be
+		popped next, see expire). Called by the sweeper at time sweepAt.
+		Returns the time of the next sweep, or None if none of the messages
+		expire (or if the sweep was superseded by an earlier one).
+		"""
+		retSweepAt = None
+
+		self.lock.acquire()
+		try:
+			if sweepAt != self.sweepAt:
+				return(retSweepAt)
+
+			started = time.time()
+			if self.lastRead != None and started - self.lastRead < Queue.sweepInterval:
+				retSweepAt = started + Queue.sweepInterval
+			else:
+				count = self.removeExpired(started)
+				if count > 0:
+					Log.debug("Swept %i expired messages from %s", count, self.name)
+					self.expired += count
+					self.journal(Queue.journalRecord("X", struct.pack('>d', started)))
+
+				nextExpiry = self.nextExpiry()
+				if nextExpiry != None:
+					# Sweeping takes time in proportion to the size of the
+					# queue, so keep it to at most 1% of the time.
+					now = time.time()
+					retSweepAt = max(nextExpiry, now + Queue.sweepInterval, now + (now - started) * 100)
+
+			self.sweepAt = retSweepAt
+		finally:
+			self.lock.release()
+
+		return(retSweepAt)
+
+	def removeExpired(self, now):
+		"""
+		Remove all messages that have expired at time now from the queue.
+		Returns the number of messages removed. Must be called with the
+		queue's lock held.
+		"""
+		retRemoved = 0
+
+		# Messages in disk storage never expire.
+		if self.storage != "disk":
+			retRemoved = len(self.queue)
+			self.queue = deque([message for message in self.queue if not Queue.hasExpired(message, now)])
+			retRemoved -= len(self.queue)
+
+		return(retRemoved)
+
+	def nextExpiry(self):
+		"""
+		Return the earliest time at which one of the messages in the queue
+		(delayed or not) expires, or None if none of them expire. Must be
+		called with the queue's lock held.
+		"""
+		return(Queue.earliestExpiry(itertools.chain(self.queue, (message for due, seq, priority, message in self.delayed))))
+
+	def earliestExpiry(messages):
+		retExpiry = None
+
+		for message in messages:
+			if isinstance(message, ExpiringMessage) and (retExpiry == None or message.expires < retExpiry):
+				retExpiry = message.expires
+
+		return(retExpiry)
+
+	earliestExpiry = staticmethod(earliestExpiry)
+
+	def drop(self, count):
+		"""
+		Remove count messages from the end of the queue that is popped from,
+		as recorded in the journal (by pops or by expire).
+		"""
+		for i in range(min(count, len(self.queue))):
+			self.takeHead()
+
+	def wait(self, waiter):
+		"""
+		Pop a message from the queue, or, if the queue is empty, add waiter
+		to the clients waiting for a message. Returns the message, or None if
+		the client has to wait.
+		"""
+		self.lock.acquire()
+		try:
+			self.expire()
+			if len(self.queue) > 0:
+				waiter.priority = self.headPriority()
+				return(self.pop())
+
+			Log.debug("Waiting for a message on %s", self.name)
+
+			waiter.queue = self
+			self.waiters.append(waiter)
+		finally:
+			self.lock.release()
+
+		return(None)
+
+	def cancelWait(self, waiter):
+		"""
+		Stop waiting for a message. Returns the message delivered to waiter,
+		or None if no message was delivered.
+		"""
+		self.lock.acquire()
+		try:
+			# A message may have been delivered just before cancelling.
+			if waiter.message == None:
+				self.waiters.remove(waiter)
+		finally:
+			self.lock.release()
+
+		return(waiter.message)
+
+	def headPriority(self):
+		"""
+		Return the priority of the message that would be popped next. Must
+		be called with the queue's lock held.
+		"""
+		return(0)
+
+	def returnMessage(self, waiter, message):
+		"""
+		Put back a message that was delivered to waiter, but never reached
+		the client.
+		"""
+		self.push(message, waiter.priority)
+		if isinstance(message, ExpiringMessage):
+			self.expireAt(message.expires)
+
+	def bpop(self, timeout):
+		"""
+		Pop a message from the queue. If the queue is empty, wait at most
+		timeout seconds for a message to be pushed.
+		"""
+		retResponse = ""
+
+		if timeout == 0:
+			return(self.pop())
+
+		waiter = Waiter()
+		message = self.wait(waiter)
+
+		if message == None:
+			waiter.wait(timeout)
+			message = self.cancelWait(waiter)
+
+		if message != None:
+			retResponse = message
+
+		return(retResponse)
+
+	def stat(self):
+		retResponse = ""
+
+		Log.debug("Statistics for %s", self.name)
+
+		retResponse += "name:" + self.name + "\n"
+		retResponse += "type:" + self.type + "\n"
+		retResponse += "size:" + str(self.size) + "\n"
+		retResponse += "overflow:" + self.overflow + "\n"
+		retResponse += "messages:" + str(len(self.queue)) + "\n"
+		retResponse += "delayed:" + str(len(self.delayed)) + "\n"
+		retResponse += "expired:" + str(self.expired) + "\n"
+
+		return(retResponse)
+
+	def clear(self):
+
+		retResponse = ""
+
+		self.lock.acquire()
+		try:
+			self.queue.clear()
+			self.delayed = []
+			self.journal(Queue.journalRecord("C"))
+		finally:
+			self.lock.release()
+
+		return(retResponse)
+
+	def addAccess(self, access):
+
+		Log.info("Adding '%s' access for P:%s U:%s H: %s (NM: %s) to queue '%s'", access.sense, access.password, access.username, access.host, access.netmask, self.name)
+		access.queuename = self.name
+		self.accessList.add(access)
+
+	def setAccess(self, accessList):
+		"""
+		Replace the access rules of the queue with accessList.
+		"""
+		self.accessList = accessList
+
+	def hasAccess(self, password, username, host, address = None):
+		return(self.accessList.hasAccess(password, username, host, address))
+
+	def writeSpool(self):
+		"""
+		Write all the messages in the queue to the spool file (a snapshot of
+		the queue). Since the spool file is then up-to-date, the journal is
+		emptied.
+
+		The spool file is replaced atomically by writing it to a temporary
+		file first. It starts with a header line containing a new generation
+		number, which is also recorded at the start of the emptied journal.
+		After the header, the messages are stored as the journal records that
+		push them (see spoolRecords), so messages may contain any data and
+		keep their priority. With storage 'disk', the messages in segment
+		files stay there and the spool file only refers to them, so writing
+		it doesn't take longer as the queue grows.
+		If the server goes down before the journal has been emptied,
+		readSpool sees that the old journal belongs to a previous generation
+		and skips it.
+		"""
+		
+		Log.debug("Writing queue '%s' to %s%s.", self.name, self.spooldir, self.name)
+
+		started = time.time()
+
+		self.lock.acquire()
+		try:
+			generation = self.spoolGeneration + 1
+
+			try:
+				f = open(self.spooldir+self.name+".tmp", 'wb')
+				f.write("#dataq-spool3 " + str(generation) + "\n")
+				for record in self.spoolRecords():
+					f.write(record)
+				f.flush()
+				os.fsync(f.fileno())
+				f.close()
+				os.rename(self.spooldir+self.name+".tmp", self.spooldir+self.name)
+			except (IOError, OSError), e:
+				Log.error("Couldn't write '%s' queue's data to %s%s", self.name, self.spooldir, self.name)
+				return
+
+			self.spoolGeneration = generation
+
+			if self.storage == "disk":
+				# The new spool file no longer refers to the released
+				# segments.
+				self.queue.purge()
+
+			# Records that haven't been flushed yet are part of the spool
+			# file now.
+			self.journalRecords = []
+			self.journalOps = 0
+			self.journalSize = 0
+
+			try:
+				if self.journalFile != None:
+					self.journalFile.truncate(0)
+					self.journalFile.write(Queue.journalRecord("G", str(generation)))
+					self.journalFile.flush()
+				elif os.path.exists(self.spooldir+self.name+".journal"):
+					os.remove(self.spooldir+self.name+".journal")
+			except (IOError, OSError), e:
+				Log.error("Couldn't empty '%s' queue's journal %s%s.journal", self.name, self.spooldir, self.name)
+		finally:
+			self.lock.release()
+
+		metrics.timing("spool", time.time() - started)
+		
+	def readSpool(self):
+		"""
+		Read the messages in the spool file into the queue and then replay the
+		changes recorded in the journal since the spool file was written.
+		"""
+		
+		Log.info("Reading queue '%s' from %s%s", self.name, self.spooldir, self.name)
+
+		try:
+			f = open(self.spooldir+self.name, 'rb')
+			header = f.readline()
+			if header.startswith("#dataq-spool3 "):
+				self.spoolGeneration = int(header.split()[1])
+				self.replayRecords(f)
+			else:
+				# Spool file with a message per line, written by an older
+				# version.
+				if header != "":
+					self.queue.append(header.rstrip('\n'))
+				for data in f:
+					self.queue.append(data.rstrip('\n'))
+			f.close()
+		except IOError, e:
+			Log.warning("Couldn't read '%s' queue's data from %s%s", self.name, self.spooldir, self.name)
+
+		try:
+			f = open(self.spooldir+self.name+".journal", 'rb')
+		except IOError, e:
+			return
+
+		Log.info("Replaying journal for queue '%s' from %s%s.journal", self.name, self.spooldir, self.name)
+
+		try:
+			self.replayRecords(f)
+		finally:
+			f.close()
+
+	def spoolRecords(self):
+		"""
+		Yield the journal records that push the messages in the queue, in
+		order, for writing the spool file. Must be called with the queue's
+		lock held.
+		"""
+		if self.storage == "disk":
+			for part in self.queue.snapshot():
+				if isinstance(part, tuple):
+					yield Queue.journalRecord("F", struct.pack('>LLL', *part))
+				else:
+					yield Queue.messageRecord("P", part)
+		else:
+			for message in self.queue:
+				yield Queue.messageRecord("P", message)
+		for record in self.delayedRecords():
+			yield record
+
+	def readRecords(f):
+		"""
+		Yield the journal records in file f as (type, data) tuples. The file
+		is read in chunks of Queue.readSize bytes, so the records don't all
+		have to fit in memory. An incomplete record at the end (the server
+		went down while writing it) is left out.
+		"""
+		data = ""
+		offset = 0
+		while True:
+			if offset + 5 > len(data):
+				data = data[offset:] + f.read(Queue.readSize)
+				offset = 0
+				if len(data) < 5:
+					return
+
+			type = data[offset]
+			length = struct.unpack('>L', data[offset + 1:offset + 5])[0]
+			if offset + 5 + length > len(data):
+				# Read the rest of the record (and the next chunk) at once.
+				data = data[offset:] + f.read(5 + length - (len(data) - offset) + Queue.readSize)
+				offset = 0
+				if 5 + length > len(data):
+					return
+
+			yield (type, data[offset + 5:offset + 5 + length])
+			offset += 5 + length
+
+	readRecords = staticmethod(readRecords)
+
+	def replayRecords(self, f):
+		"""
+		Apply the journal records in file f (the journal or the spool file)
+		to the queue.
+		"""
+		# Expiry time from an E record for the message of the next record.
+		expires = None
+
+		for type, record in Queue.readRecords(f):
+			if type == "E":
+				# Messages in disk storage never expire.
+				if self.storage != "disk":
+					expires = struct.unpack('>d', record)[0]
+				continue
+			elif type == "P":
+				self.queue.append(Queue.expiring(record, expires))
+			elif type == "Q":
+				priority = struct.unpack('>l', record[:4])[0]
+				if self.type == "priority":
+					self.queue.push(priority, Queue.expiring(record[4:], expires))
+				else:
+					self.queue.append(Queue.expiring(record[4:], expires))
+			elif type == "F":
+				number, first, count = struct.unpack('>LLL', record)
+				if self.storage == "disk":
+					self.queue.addSegment(number, first, count)
+				else:
+					# The queue used storage 'disk' before.
+					self.queue.extend(SegmentStore(self.spooldir + self.name).readSegment((number, first, count)))
+			elif type == "O":
+				self.drop(int(record))
+			elif type == "L":
+				if self.type == "priority":
+					self.dropLowest(int(record))
+			elif type == "D":
+				due, priority = struct.unpack('>dl', record[:12])
+				self.delayedSeq += 1
+				heapq.heappush(self.delayed, (due, self.delayedSeq, priority, Queue.expiring(record[12:], expires)))
+			elif type == "R":
+				for i in range(min(int(record), len(self.delayed))):
+					heapq.heappop(self.delayed)
+			elif type == "S":
+				if self.method == "subscribe":
+					self.replayCursor(record[4:], struct.unpack('>l', record[:4])[0])
+			elif type == "U":
+				if self.method == "subscribe":
+					length = struct.unpack('>L', record[:4])[0]
+					self.replayUnread(record[4:4 + length], Queue.expiring(record[4 + length:], expires))
+			elif type == "X":
+				self.removeExpired(struct.unpack('>d', record)[0])
+			elif type == "C":
+				self.queue.clear()
+				self.delayed = []
+			elif type == "G":
+				if int(record) != self.spoolGeneration:
+					# Journal of an older spool file; the spool file already
+					# contains these changes.
+					Log.info("Skipping outdated journal for queue '%s'", self.name)
+					break
+
+			expires = None
+
+	def openJournal(self):
+		try:
+			self.journalFile = open(self.spooldir+self.name+".journal", 'ab')
+			if os.path.getsize(self.spooldir+self.name+".journal") == 0:
+				# A journal always starts with the generation of its spool
+				# file.
+				self.journalFile.write(Queue.journalRecord("G", str(self.spoolGeneration)))
+				self.journalFile.flush()
+		except (IOError, OSError), e:
+			Log.error("Couldn't open '%s' queue's journal %s%s.journal", self.name, self.spooldir, self.name)
+
+	def journalRecord(type, data = ""):
+		"""
+		Encode a journal record: the record type (P: push, Q: push with a
+		priority, O: pop, L: drop lowest priority, D: delayed push, R: release
+		delayed, S: move a subscriber's cursor, U: put back a removed message
+		for a subscriber, E: expiry of the next pushed message, X: remove
+		expired messages, F: messages in a segment file (spool files only),
+		C: clear, G: generation)
+		followed by the length of the data and the data.
+		"""
+		return(type + struct.pack('>L', len(data)) + data)
+
+	journalRecord = staticmethod(journalRecord)
+
+	def messageRecord(type, message, data = ""):
+		"""
+		Encode the journal record (P, Q, D or U) that pushes message, with
+		data before the message. The record of a message that expires is preceded
+		by an E record with the time at which it expires.
+		"""
+		retRecord = Queue.journalRecord(type, data + message)
+
+		if isinstance(message, ExpiringMessage):
+			retRecord = Queue.journalRecord("E", struct.pack('>d', message.expires)) + retRecord
+
+		return(retRecord)
+
+	messageRecord = staticmethod(messageRecord)
+
+	def expiring(message, expires):
+		"""
+		Return message as an ExpiringMessage if it expires at time expires,
+		or as is if expires is None.
+		"""
+		if expires == None:
+			return(message)
+
+		return(ExpiringMessage(message, expires))
+
+	expiring = staticmethod(expiring)
+
+	def journal(self, record):
+		"""
+		Add a record of a change to the queue to the journal. The flusher
+		decides when it is written to disk. Must be called with the queue's
+		lock held.
+		"""
+		if self.journalFile == None:
+			return
+
+		self.journalRecords.append(record)
+		if not self.releasing:
+			self.flusher.dirty(self)
+
+	def flushJournal(self):
+		"""
+		Write all pending journal records to disk with a single write and
+		fsync.
+		"""
+		started = time.time()
+
+		self.lock.acquire()
+		try:
+			if len(self.journalRecords) == 0:
+				return
+
+			records = "".join(self.journalRecords)
+			try:
+				self.journalFile.write(records)
+				self.journalFile.flush()
+			except IOError, e:
+				Log.error("Couldn't write to '%s' queue's journal %s%s.journal", self.name, self.spooldir, self.name)
+			self.journalOps += len(self.journalRecords)
+			self.journalSize += len(records)
+			self.journalRecords = []
+
+			compact = (self.flusher.compactOps > 0 and self.journalOps >= self.flusher.compactOps) or \
+			          (self.flusher.compactSize > 0 and self.journalSize >= self.flusher.compactSize)
+		finally:
+			self.lock.release()
+
+		# The records have been handed to the OS, so the queue doesn't need to
+		# stay locked while waiting for them to hit the disk.
+		try:
+			os.fsync(self.journalFile.fileno())
+		except OSError, e:
+			Log.error("Couldn't sync '%s' queue's journal %s%s.journal", self.name, self.spooldir, self.name)
+
+		metrics.timing("journal", time.time() - started)
+
+		if compact:
+			Log.debug("Compacting journal for queue '%s'", self.name)
+			self.writeSpool()
+
+class FifoQueue(Queue):
+
+	"""
+	FIFO Queue: First message in is the first message out. (Queue)
+	"""
+		
+	def __init__(self, name, size, overflow, spooldir, flusher = None, storage = "memory", ttl = 0, segmentSize = SegmentStore.segmentSize):
+		self.accessList = AccessList()
+
+		Queue.__init__(self, name, "fifo", size, overflow, spooldir, flusher, storage, "singleton", ttl, segmentSize)
+
+	def head(self):
+		return(self.queue[0])
+
+	def takeHead(self):
+		return(self.queue.popleft())
+
+	def pop(self):
+		retResponse = ""
+
+		Log.debug("POPing from %s", self.name)
+
+		self.lock.acquire()
+		try:
+			self.expire()
+			if len(self.queue) > 0:
+				retResponse = self.queue.popleft()
+				self.journal(Queue.journalRecord("O", "1"))
+		finally:
+			self.lock.release()
+
+		return(retResponse)
+
+	def popMany(self, count):
+		retMessages = []
+
+		Log.debug("POPing %i messages from %s", count, self.name)
+
+		self.lock.acquire()
+		try:
+			now = time.time()
+			self.expire(now)
+			while len(retMessages) < count and len(self.queue) > 0:
+				retMessages.append(self.queue.popleft())
+				self.expire(now)
+			if len(retMessages) > 0:
+				self.journal(Queue.journalRecord("O", str(len(retMessages))))
+		finally:
+			self.lock.release()
+
+		return(retMessages)
+
+	def makeRoom(self, messages):
+		"""
+		Make room for pushing messages onto a full queue with the same result
+		as pushing them one by one with overflow 'pop': only the last 'size'
+		messages of the queue and the new messages combined are kept. Returns
+		the messages that should still be pushed. Must be called with the
+		queue's lock held.
+		"""
+		messages = messages[-self.size:]
+		count = len(self.queue) + len(messages) - self.size
+		for i in range(count):
+			self.queue.popleft()
+		if count > 0:
+			self.journal(Queue.journalRecord("O", str(count)))
+
+		return(messages)
+
+	def peek(self):
+		retResponse = ""
+
+		Log.debug("PEEKing at %s", self.name)
+
+		self.lock.acquire()
+		try:
+			self.expire()
+			if len(self.queue) > 0:
+				retResponse = self.queue[0]
+		finally:
+			self.lock.release()
+
+		return(retResponse)
+
+class FiloQueue(Queue):
+
+	"""
+	FILO Queue: First message in is the first out. (Stack)
+	"""
+
+	def __init__(self, name, size, overflow, spooldir, flusher = None, storage = "memory", ttl = 0, segmentSize = SegmentStore.segmentSize):
+		self.accessList = AccessList()
+		Queue.__init__(self, name, "filo", size, overflow, spooldir, flusher, storage, "singleton", ttl, segmentSize)
+
+	def head(self):
+		return(self.queue[-1])
+
+	def takeHead(self):
+		return(self.queue.pop())
+
+	def pop(self):
+		retResponse = ""
+
+		Log.debug("POPing from %s", self.name)
+
+		self.lock.acquire()
+		try:
+			self.expire()
+			if len(self.queue) > 0:
+				retResponse = self.queue.pop()
+				self.journal(Queue.journalRecord("O", "1"))
+		finally:
+			self.lock.release()
+
+		return(retResponse)
+
+	def popMany(self, count):
+		retMessages = []
+
+		Log.debug("POPing %i messages from %s", count, self.name)
+
+		self.lock.acquire()
+		try:
+			now = time.time()
+			self.expire(now)
+			while len(retMessages) < count and len(self.queue) > 0:
+				retMessages.append(self.queue.pop())
+				self.expire(now)
+			if len(retMessages) > 0:
+				self.journal(Queue.journalRecord("O", str(len(retMessages))))
+		finally:
+			self.lock.release()
+
+		return(retMessages)
+
+	def makeRoom(self, messages):
+		"""
+		Make room for pushing messages onto a full queue with the same result
+		as pushing them one by one with overflow 'pop': once the queue is full,
+		each new message replaces the one on top. Returns the messages that
+		should still be pushed. Must be called with the queue's lock held.
+		"""
+		free = self.size - len(self.queue)
+
+		if free > 0:
+			messages = messages[:free - 1] + messages[-1:]
+		else:
+			self.queue.pop()
+			self.journal(Queue.journalRecord("O", "1"))
+			messages = messages[-1:]
+
+		return(messages)
+
+	def peek(self):
+		retResponse = ""
+
+		Log.debug("PEEKing at %s", self.name)
+
+		self.lock.acquire()
+		try:
+			self.expire()
+			if len(self.queue) > 0:
+				retResponse = self.queue[-1]
+		finally:
+			self.lock.release()
+
+		return(retResponse)
+
+class PriorityQueue(Queue):
+
+	"""
+	Priority Queue: the message with the highest priority is the first
+	message out. Messages with the same priority are FIFO. On overflow 'pop',
+	the oldest message with the lowest priority makes room for the new
+	message, unless the new message has a lower priority than all messages
+	in the queue, in which case the new message is dropped.
+	"""
+
+	def __init__(self, name, size, overflow, spooldir, flusher = None, storage = "memory", ttl = 0):
+		self.accessList = AccessList()
+		Queue.__init__(self, name, "priority", size, overflow, spooldir, flusher, storage, "singleton", ttl)
+
+	def head(self):
+		return(self.queue.peek()[1])
+
+	def headPriority(self):
+		return(self.queue.peek()[0])
+
+	def takeHead(self):
+		return(self.queue.pop()[1])
+
+	def push(self, message, priority = 0):
+		retResponse = ""
+
+		self.lock.acquire()
+		try:
+			if len(self.waiters) > 0:
+				Log.debug("Handing message for %s to waiting client: %s", self.name, message)
+				self.waiters.popleft().deliver(message, priority)
+				return(retResponse)
+
+			if len(self.queue) + len(self.delayed) >= self.size and self.overflow == "deny":
+				raise DataqError, 203 # Queue is full
+
+			Log.debug("Pushing to %s with priority %i: %s", self.name, priority, message)
+
+			self.journal(self.add(message, priority))
+		finally:
+			self.lock.release()
+
+		return(retResponse)
+
+	def pushMany(self, messages, priority = 0):
+		retResponse = ""
+
+		self.lock.acquire()
+		try:
+			# Messages for clients waiting in BPOP never enter the queue.
+			handOff = min(len(self.waiters), len(messages))
+
+			if len(self.queue) + len(self.delayed) + len(messages) - handOff > self.size:
+				if self.overflow == "deny":
+					raise DataqError, 203 # Queue is full
+
+			for message in messages[:handOff]:
+				self.waiters.popleft().deliver(message, priority)
+			messages = messages[handOff:]
+
+			Log.debug("Pushing %i messages to %s with priority %i", len(messages), self.name, priority)
+
+			self.journal("".join([self.add(message, priority) for message in messages]))
+		finally:
+			self.lock.release()
+
+		return(retResponse)
+
+	def add(self, message, priority):
+		"""
+		Add a message to the queue, first making room for it if the queue is
+		full. Returns the journal records of the changes. Must be called with
+		the queue's lock held.
+		"""
+		retRecords = ""
+
+		if len(self.queue) >= self.size:
+			if priority < self.queue.lowest():
+				Log.debug("Dropping message with priority %i for full queue %s", priority, self.name)
+				return(retRecords)
+
+			self.queue.popLowest()
+			retRecords += Queue.journalRecord("L", "1")
+
+		self.queue.push(priority, message)
+		retRecords += Queue.messageRecord("Q", message, struct.pack('>l', priority))
+
+		return(retRecords)
+
+	def dropLowest(self, count):
+		"""
+		Remove the oldest count messages with the lowest priority, as done
+		by overflow 'pop'. Used when replaying the journal.
+		"""
+		self.lock.acquire()
+		try:
+			for i in range(min(count, len(self.queue))):
+				self.queue.popLowest()
+		finally:
+			self.lock.release()
+
+	def pop(self):
+		retResponse = ""
+
+		Log.debug("POPing from %s", self.name)
+
+		self.lock.acquire()
+		try:
+			self.expire()
+			if len(self.queue) > 0:
+				retResponse = self.queue.pop()[1]
+				self.journal(Queue.journalRecord("O", "1"))
+		finally:
+			self.lock.release()
+
+		return(retResponse)
+
+	def popMany(self, count):
+		retMessages = []
+
+		Log.debug("POPing %i messages from %s", count, self.name)
+
+		self.lock.acquire()
+		try:
+			now = time.time()
+			self.expire(now)
+			while len(retMessages) < count and len(self.queue) > 0:
+				retMessages.append(self.queue.pop()[1])
+				self.expire(now)
+			if len(retMessages) > 0:
+				self.journal(Queue.journalRecord("O", str(len(retMessages))))
+		finally:
+			self.lock.release()
+
+		return(retMessages)
+
+	def peek(self):
+		retResponse = ""
+
+		Log.debug("PEEKing at %s", self.name)
+
+		self.lock.acquire()
+		try:
+			self.expire()
+			if len(self.queue) > 0:
+				retResponse = self.queue.peek()[1]
+		finally:
+			self.lock.release()
+
+		return(retResponse)
+
+	def removeExpired(self, now):
+		return(self.queue.filter(lambda message: not Queue.hasExpired(message, now)))
+
+	def nextExpiry(self):
+		return(Queue.earliestExpiry(itertools.chain((message for priority, message in self.queue), (message for due, seq, priority, message in self.delayed))))
+
+	def spoolRecords(self):
+		for priority, message in self.queue:
+			yield Queue.messageRecord("Q", message, struct.pack('>l', priority))
+		for record in self.delayedRecords():
+			yield record
+
+class SubscribeQueue(FifoQueue):
+
+	"""
+	Subscribe Queue: every message is received by each of the subscribers
+	(named in the configuration), in the order in which the messages were
+	pushed. The messages are kept once, in a single log from which every
+	subscriber reads at its own cursor (see MessageLog), and are removed
+	when all subscribers have received them. On overflow 'pop' the oldest
+	message is removed, also for subscribers that haven't received it yet.
+
+	Requests for a subscriber are handled by its Subscriber, which calls the
+	methods below. Pops on the queue itself (by overflow handling and
+	journal replay) remove the oldest message.
+
+	Expired messages are removed from the start of the log. Expired messages
+	further on, which other subscribers may still be behind, are skipped
+	when a subscriber reads them.
+	"""
+
+	def __init__(self, name, size, overflow, spooldir, flusher = None, storage = "memory", subscribers = [], ttl = 0):
+		if len(subscribers) == 0:
+			raise UserWarning, "Wrong value for subscriber"
+
+		self.accessList = AccessList()
+		self.name = name
+
+		self.subscribers = {}
+		for subscriber in subscribers:
+			self.subscribers[subscriber] = Subscriber(self, subscriber)
+
+		# Subscribers with clients waiting in BPOP.
+		self.waiting = {}
+
+		Queue.__init__(self, name, "fifo", size, overflow, spooldir, flusher, storage, "subscribe", ttl)
+
+	def head(self):
+		return(self.queue.get(self.queue.first))
+
+	def push(self, message, priority = 0):
+		retResponse = ""
+
+		self.lock.acquire()
+		try:
+			if len(self.queue) + len(self.delayed) >= self.size and self.overflow == "deny":
+				raise DataqError, 203 # Queue is full
+			if len(self.queue) == self.size and self.overflow == "pop":
+				self.pop()
+
+			Log.debug("Pushing to %s: %s", self.name, message)
+
+			self.queue.append(message)
+			self.journal(Queue.messageRecord("P", message))
+			self.deliver()
+		finally:
+			self.lock.release()
+
+		return(retResponse)
+
+	def pushMany(self, messages, priority = 0):
+		retResponse = ""
+
+		self.lock.acquire()
+		try:
+			if len(self.queue) + len(self.delayed) + len(messages) > self.size:
+				if self.overflow == "deny":
+					raise DataqError, 203 # Queue is full
+
+			if len(self.queue) + len(messages) > self.size:
+				messages = self.makeRoom(messages)
+
+			Log.debug("Pushing %i messages to %s", len(messages), self.name)
+
+			self.queue.extend(messages)
+			self.journal("".join([Queue.messageRecord("P", message) for message in messages]))
+			self.deliver()
+		finally:
+			self.lock.release()
+
+		return(retResponse)
+
+	def deliver(self):
+		"""
+		Hand new messages to the subscribers with clients waiting in BPOP.
+		Must be called with the queue's lock held.
+		"""
+		for subscriber in self.waiting.values():
+			while len(subscriber.waiters) > 0:
+				messages = self.read(subscriber, 1)
+				if len(messages) == 0:
+					break
+
+				Log.debug("Handing message for %s to waiting client of %s", self.name, subscriber.subscriber)
+				subscriber.waiters.popleft().deliver(messages[0])
+
+			if len(subscriber.waiters) == 0:
+				del self.waiting[subscriber.subscriber]
+
+	def cursor(self, subscriber):
+		"""
+		Return the position of the next message for subscriber.
+		"""
+		return(max(subscriber.cursor, self.queue.first))
+
+	def pending(self, subscriber):
+		"""
+		Return the number of messages subscriber hasn't received yet.
+		"""
+		return(self.queue.end() - self.cursor(subscriber))
+
+	def advance(self, subscriber, count):
+		"""
+		Move the cursor of subscriber count messages forward (or back, if
+		count is negative). Must be called with the queue's lock held.
+		"""
+		cursor = self.cursor(subscriber)
+		subscriber.cursor = cursor + count
+		self.queue.move(cursor, subscriber.cursor)
+
+	def read(self, subscriber, count):
+		"""
+		Return up to count messages for subscriber, and move its cursor past
+		them (and past the expired messages in between).
+		"""
+		retMessages = []
+
+		Log.debug("POPing %i messages from %s for %s", count, self.name, subscriber.subscriber)
+
+		self.lock.acquire()
+		try:
+			now = time.time()
+			self.expire(now)
+
+			cursor = self.cursor(subscriber)
+			position = cursor
+			while len(retMessages) < count and position < self.queue.end():
+				message = self.queue.get(position)
+				position += 1
+				if not Queue.hasExpired(message, now):
+					retMessages.append(message)
+
+			if position > cursor:
+				self.advance(subscriber, position - cursor)
+				self.journal(Queue.journalRecord("S", struct.pack('>l', position - cursor) + subscriber.subscriber))
+		finally:
+			self.lock.release()
+
+		return(retMessages)
+
+	def peekAt(self, subscriber):
+		retResponse = ""
+
+		Log.debug("PEEKing at %s for %s", self.name, subscriber.subscriber)
+
+		self.lock.acquire()
+		try:
+			now = time.time()
+			self.expire(now)
+
+			for position in xrange(self.cursor(subscriber), self.queue.end()):
+				message = self.queue.get(position)
+				if not Queue.hasExpired(message, now):
+					retResponse = message
+					break
+		finally:
+			self.lock.release()
+
+		return(retResponse)
+
+	def waitFor(self, subscriber, waiter):
+		"""
+		Like Queue.wait, for subscriber.
+		"""
+		self.lock.acquire()
+		try:
+			messages = self.read(subscriber, 1)
+			if len(messages) > 0:
+				return(messages[0])
+
+			Log.debug("Waiting for a message on %s for %s", self.name, subscriber.subscriber)
+
+			waiter.queue = subscriber
+			subscriber.waiters.append(waiter)
+			self.waiting[subscriber.subscriber] = subscriber
+		finally:
+			self.lock.release()
+
+		return(None)
+
+	def cancelWaitFor(self, subscriber, waiter):
+		"""
+		Like Queue.cancelWait, for subscriber.
+		"""
+		self.lock.acquire()
+		try:
+			if waiter.message == None:
+				subscriber.waiters.remove(waiter)
+				if len(subscriber.waiters) == 0 and subscriber.subscriber in self.waiting:
+					del self.waiting[subscriber.subscriber]
+		finally:
+			self.lock.release()
+
+		return(waiter.message)
+
+	def rewind(self, subscriber, message):
+		"""
+		Move the cursor of subscriber back one message, to put back message,
+		which was delivered to it but never reached the client. If all
+		subscribers had received the message, it has been removed, and is put
+		back for subscriber only.
+		"""
+		self.lock.acquire()
+		try:
+			if self.cursor(subscriber) > self.queue.first:
+				self.advance(subscriber, -1)
+				self.journal(Queue.journalRecord("S", struct.pack('>l', -1) + subscriber.subscriber))
+			elif len(self.queue) + len(self.delayed) < self.size:
+				self.unread(subscriber, message)
+				self.journal(Queue.messageRecord("U", message, struct.pack('>L', len(subscriber.subscriber)) + subscriber.subscriber))
+			else:
+				Log.warning("Couldn't return message to %s for %s", self.name, subscriber.subscriber)
+		finally:
+			self.lock.release()
+
+	def unread(self, subscriber, message):
+		"""
+		Put back a message that was removed from the log for subscriber only.
+		Must be called with the queue's lock held.
+		"""
+		subscriber.cursor = self.cursor(subscriber)
+		self.queue.prepend(message)
+		self.advance(subscriber, -1)
+
+	def replayUnread(self, subscriberName, message):
+		"""
+		Put back a message for a subscriber, as recorded in the journal.
+		Records of subscribers that are no longer configured are skipped.
+		"""
+		if subscriberName in self.subscribers:
+			self.unread(self.subscribers[subscriberName], message)
+
+	def replayCursor(self, subscriberName, count):
+		"""
+		Move the cursor of a subscriber, as recorded in the journal. Records
+		of subscribers that are no longer configured are skipped.
+		"""
+		if not subscriberName in self.subscribers:
+			return
+
+		subscriber = self.subscribers[subscriberName]
+		cursor = self.cursor(subscriber)
+		count = max(min(count, self.queue.end() - cursor), self.queue.first - cursor)
+		if count != 0:
+			self.advance(subscriber, count)
+
+	def removeExpired(self, now):
+		"""
+		Remove the expired messages at the start of the log. Expired messages
+		further on are skipped by the subscribers (see read).
+		"""
+		retRemoved = 0
+
+		while len(self.queue) > 0 and Queue.hasExpired(self.head(), now):
+			self.queue.popleft()
+			retRemoved += 1
+
+		return(retRemoved)
+
+	def nextExpiry(self):
+		"""
+		Like Queue.nextExpiry, but leaves out the messages that have expired
+		already but can't be removed yet.
+		"""
+		now = time.time()
+		messages = itertools.chain(self.queue, (message for due, seq, priority, message in self.delayed))
+
+		return(Queue.earliestExpiry(message for message in messages if not Queue.hasExpired(message, now)))
+
+	def stat(self):
+		retResponse = Queue.stat(self)
+
+		self.lock.acquire()
+		try:
+			retResponse += "method:subscribe\n"
+			names = self.subscribers.keys()
+			names.sort()
+			for name in names:
+				retResponse += "subscriber." + name + ":" + str(self.pending(self.subscribers[name])) + "\n"
+		finally:
+			self.lock.release()
+
+		return(retResponse)
+
+	def spoolRecords(self):
+		for message in self.queue:
+			yield Queue.messageRecord("P", message)
+		for subscriber in self.subscribers.values():
+			count = self.cursor(subscriber) - self.queue.first
+			yield Queue.journalRecord("S", struct.pack('>l', count) + subscriber.subscriber)
+		for record in self.delayedRecords():
+			yield record
+
+class QueuePool:
+	
+	"""
+	Intermediary class between queues and the server's request handler.  This
+	class takes care of creation, communication and access checking for queues.
+	"""
+
+	# Maximum number of cached access decisions.
+	accessCacheSize = 10000
+
+	def __init__(self, spoolDir, spoolEvents, spoolFlush = "every-op", compactOps = 0, compactSize = 0):
+		self.queues = {}
+		self.queuesLock = threading.Lock()
+		self.accessList = AccessList()
+
+		# Access decisions: (host, username, password, queue name) -> True
+		# (allowed) or False (denied)
+		self.accessCache = {}
+
+		self.spoolDir = spoolDir
+		self.spoolEvents = spoolEvents
+
+		self.flusher = None
+		if "write" in self.spoolEvents:
+			self.flusher = Flusher(spoolFlush, compactOps, compactSize)
+
+		if self.spoolDir[-1] != '/':
+			self.spoolDir += '/'
+
+	def createQueue(self, name, type, size, overflow, storage = "memory", method = "singleton", subscribers = [], ttl = 0, segmentSize = SegmentStore.segmentSize):
+		if method == "subscribe":
+			if type != "fifo":
+				raise UserWarning, "Wrong value for method"
+			newQueue = SubscribeQueue(name, size, overflow, self.spoolDir, self.flusher, storage, subscribers, ttl)
+		elif method != "singleton":
+			raise UserWarning, "Wrong value for method"
+		elif type == "fifo":
+			newQueue = FifoQueue(name, size, overflow, self.spoolDir, self.flusher, storage, ttl, segmentSize)
+		elif type == "filo":
+			newQueue = FiloQueue(name, size, overflow, self.spoolDir, self.flusher, storage, ttl, segmentSize)
+		elif type == "priority":
+			newQueue = PriorityQueue(name, size, overflow, self.spoolDir, self.flusher, storage, ttl)
+		else:
+			raise UserWarning, "Wrong value for type"
+
+		self.queuesLock.acquire()
+		try:
+			self.queues[name] = newQueue
+		finally:
+			self.queuesLock.release()
+
+		return(newQueue)
+
+	def getQueue(self, queueName):
+		"""
+		Return the queue with name queueName. Raises DataqError 201 if no
+		such queue exists.
+		"""
+		self.queuesLock.acquire()
+		try:
+			if queueName not in self.queues:
+				raise DataqError, 201 # Unknown queue
+
+			queue = self.queues[queueName]
+		finally:
+			self.queuesLock.release()
+
+		return(queue)
+
+	def getQueues(self):
+		"""
+		Return a list of all the queues in the pool.
+		"""
+		self.queuesLock.acquire()
+		try:
+			queues = self.queues.values()
+		finally:
+			self.queuesLock.release()
+
+		return(queues)
+
+	def addAccess(self, access):
+		Log.info("Adding '%s' access for P:%s U:%s H: %s (NM: %s) to queuePool", access.sense, access.password, access.username, access.host, access.netmask)
+		self.accessList.add(access)
+		self.clearAccessCache()
+
+	def setAccess(self, accessList):
+		"""
+		Replace the access rules of the pool with accessList.
+		"""
+		self.accessList = accessList
+		self.clearAccessCache()
+
+	def hasAccess(self, password, username, host, address = None):
+		return(self.accessList.hasAccess(password, username, host, address))
+
+	def clearAccessCache(self):
+		"""
+		Forget all cached access decisions. Must be called after changing the
+		access rules of the pool or of a queue.
+		"""
+		self.accessCache = {}
+
+	def checkAccess(self, password, username, host, queue = None):
+		queueName = None
+		if queue != None:
+			queueName = queue.name
+
+		key = (host, username, password, queueName)
+
+		# A decision made while the rules change ends up in the old cache.
+		accessCache = self.accessCache
+
+		try:
+			allowed = accessCache[key]
+		except KeyError:
+			allowed = self.decideAccess(password, username, host, queue)
+
+			if len(accessCache) >= self.accessCacheSize:
+				accessCache.clear()
+			accessCache[key] = allowed
+
+		if not allowed:
+			metrics.deny()
+			raise DataqError, 202 # Access denied
+
+	def decideAccess(self, password, username, host, queue = None):
+		"""
+		Decide whether a client has access to the pool or to a queue in it.
+		The queue's access rules take precedence over the pool's.
+		"""
+		address = Net.clientAddress(host)
+
+		qpAccess = self.hasAccess(password, username, host, address)
+		Log.debug("QueuePoolAccess = %s", qpAccess)
 
 		if queue != None:
-			qAccess = queue.hasAccess(password, username, host)
-			Log.verboseMsg("QueueAccess     = " + str(qAccess))
+			qAccess = queue.hasAccess(password, username, host, address)
+			Log.debug("QueueAccess     = %s", qAccess)
+
+			if qAccess != None:
+				return(qAccess)
+
+		return(qpAccess == True)
+				
+	def push(self, host, queueURI, message):
+		retResponse = ""
+		queue = None
+		username, password, queueName = self.parseQueueURI(queueURI)
+		options = self.parseQueueOptions(queueURI, ["priority", "delay", "at", "ttl"])
+		
+		queue = self.getQueue(queueName)
+
+		self.checkAccess(password, username, host, queue);
+
+		priority = self.priority(queue, options)
+		due = self.due(options)
+		expires = self.expires(queue, options, due)
+		if expires != None:
+			message = ExpiringMessage(message, expires)
+
+		if due != None:
+			retResponse = queue.delay([message], priority, due)
+		else:
+			retResponse = queue.push(message, priority)
+		metrics.queueOp(queue.name, "PUSH")
+
+		if expires != None:
+			queue.expireAt(expires)
+
+		return(retResponse)
+
+	def mpush(self, host, queueURI, messages):
+		retResponse = ""
+		queue = None
+		username, password, queueName = self.parseQueueURI(queueURI)
+		options = self.parseQueueOptions(queueURI, ["priority", "delay", "at", "ttl"])
+		
+		queue = self.getQueue(queueName)
+
+		self.checkAccess(password, username, host, queue);
+
+		priority = self.priority(queue, options)
+		due = self.due(options)
+		expires = self.expires(queue, options, due)
+		if expires != None:
+			messages = [ExpiringMessage(message, expires) for message in messages]
+
+		if due != None:
+			retResponse = queue.delay(messages, priority, due)
+		else:
+			retResponse = queue.pushMany(messages, priority)
+		metrics.queueOp(queue.name, "MPUSH")
+
+		if expires != None:
+			queue.expireAt(expires)
+
+		return(retResponse)
+
+	def checkPush(self, host, queueURI, count):
+		"""
+		Check an MPUSH of count messages before its messages are read, so
+		they aren't buffered for nothing. Raises a DataqError if the queue
+		doesn't exist, the client has no access to it, or the queue can't
+		hold that many messages.
+		"""
+		username, password, queueName = self.parseQueueURI(queueURI)
+		self.parseQueueOptions(queueURI, ["priority", "delay", "at", "ttl"])
+		
+		queue = self.getQueue(queueName)
+
+		self.checkAccess(password, username, host, queue);
+
+		if count > queue.size:
+			raise DataqError, 203 # Queue is full
+
+	def pop(self, host, queueURI):
+		retResponse = ""
+		queue = None
+		username, password, queueName = self.parseQueueURI(queueURI)
+		options = self.parseQueueOptions(queueURI, ["subscriber"])
+		
+		queue = self.getQueue(queueName)
+
+		self.checkAccess(password, username, host, queue);
+
+		retResponse = self.reader(queue, options).pop()
+		metrics.queueOp(queue.name, "POP")
+
+		return(retResponse)
+
+	def bpop(self, host, queueURI, timeout):
+		retResponse = ""
+		queue = None
+		username, password, queueName = self.parseQueueURI(queueURI)
+		options = self.parseQueueOptions(queueURI, ["subscriber"])
+		
+		queue = self.getQueue(queueName)
+
+		self.checkAccess(password, username, host, queue);
+
+		retResponse = self.reader(queue, options).bpop(timeout)
+		metrics.queueOp(queue.name, "BPOP")
+
+		return(retResponse)
+
+	def wait(self, host, queueURI, waiter):
+		retResponse = None
+		queue = None
+		username, password, queueName = self.parseQueueURI(queueURI)
+		options = self.parseQueueOptions(queueURI, ["subscriber"])
+		
+		queue = self.getQueue(queueName)
+
+		self.checkAccess(password, username, host, queue);
+
+		retResponse = self.reader(queue, options).wait(waiter)
+		metrics.queueOp(queue.name, "BPOP")
+
+		return(retResponse)
+
+	def take(self, host, queueURI, timeout):
+		"""
+		BPOP that returns the message (None if none arrived in time) and its
+		priority, so the message can be returned as it was if it never
+		reaches the client (see returnMessage). Used by the threaded server
+		and on behalf of other workers (see RemoteWait).
+		"""
+		username, password, queueName = self.parseQueueURI(queueURI)
+		options = self.parseQueueOptions(queueURI, ["subscriber"])
+		
+		queue = self.getQueue(queueName)
+
+		self.checkAccess(password, username, host, queue);
+
+		reader = self.reader(queue, options)
+		waiter = Waiter()
+		message = reader.wait(waiter)
+		if message == None:
+			waiter.wait(timeout)
+			message = reader.cancelWait(waiter)
+		metrics.queueOp(queue.name, "BPOP")
+
+		return(message, waiter.priority)
+
+	def returnMessage(self, host, queueURI, message, priority):
+		"""
+		Put back a message taken with take that never reached the client.
+		"""
+		username, password, queueName = self.parseQueueURI(queueURI)
+		options = self.parseQueueOptions(queueURI, ["subscriber"])
+		
+		queue = self.getQueue(queueName)
+
+		self.checkAccess(password, username, host, queue);
+
+		waiter = Waiter()
+		waiter.priority = priority
+		self.reader(queue, options).returnMessage(waiter, message)
+
+	def mpop(self, host, queueURI, count):
+		retMessages = []
+		queue = None
+		username, password, queueName = self.parseQueueURI(queueURI)
+		options = self.parseQueueOptions(queueURI, ["subscriber"])
+		
+		queue = self.getQueue(queueName)
+
+		self.checkAccess(password, username, host, queue);
+
+		retMessages = self.reader(queue, options).popMany(count)
+		metrics.queueOp(queue.name, "MPOP")
+
+		return(retMessages)
+
+	def peek(self, host, queueURI):
+		retResponse = ""
+		queue = None
+		username, password, queueName = self.parseQueueURI(queueURI)
+		options = self.parseQueueOptions(queueURI, ["subscriber"])
+		
+		queue = self.getQueue(queueName)
+
+		self.checkAccess(password, username, host, queue);
+
+		retResponse = self.reader(queue, options).peek()
+		metrics.queueOp(queue.name, "PEEK")
+
+		return(retResponse)
+
+	def stat(self, host, queueURI):
+		retResponse = ""
+		queue = None
+		username, password, queueName = self.parseQueueURI(queueURI)
+		
+		Log.debug("STAT %s", queueURI)
+
+		if queueName == "":
+
+			self.checkAccess(password, username, host);
+
+			retResponse = ""
+
+			for queue in self.getQueues():
+				retResponse += "queue:" + queue.name + "\n"
+		else:
+			queue = self.getQueue(queueName)
+
+			self.checkAccess(password, username, host, queue);
+
+			retResponse = queue.stat()
+			metrics.queueOp(queue.name, "STAT")
+
+		return(retResponse)
+
+	def clear(self, host, queueURI):
+		retResponse = ""
+		queue = None
+		username, password, queueName = self.parseQueueURI(queueURI)
+		
+		queue = self.getQueue(queueName)
+
+		self.checkAccess(password, username, host, queue);
+
+		retResponse = queue.clear()
+		metrics.queueOp(queue.name, "CLEAR")
+
+		return(retResponse)
+
+	def metrics(self, host, queueURI):
+		retResponse = ""
+		username, password, queueName = self.parseQueueURI(queueURI)
+
+		self.checkAccess(password, username, host);
+
+		retResponse = metrics.report()
+
+		return(retResponse)
+
+	def parseQueueURI(self, queueURI):
+		password = ""
+		username = ""
+		queueName = ""
+
+		try:
+			queueName = queueURI
+			authentication, queueName = queueURI.split("@", 1)
+			password = authentication
+			username, password = authentication.split(":", 1)
+		except ValueError:
+			pass
+
+		# Options follow the queue name, see parseQueueOptions.
+		queueName = queueName.split("?", 1)[0]
+			
+		return (username, password, queueName)
+
+	def parseQueueOptions(self, queueURI, allowed):
+		"""
+		Return the options of a request, which follow the queue name in the
+		queueURI ('queue?name=value&name=value'), as a dictionary. Raises
+		DataqError 101 if an option is malformed or not in allowed.
+		"""
+		retOptions = {}
+
+		queueName = queueURI.split("@", 1)[-1]
+		if not "?" in queueName:
+			return(retOptions)
+
+		for option in queueName.split("?", 1)[1].split("&"):
+			try:
+				name, value = option.split("=", 1)
+			except ValueError:
+				raise DataqError, 101 # Bad syntax in request
+
+			if not name in allowed or name in retOptions:
+				raise DataqError, 101 # Bad syntax in request
+
+			retOptions[name] = value
+
+		return(retOptions)
+
+	def priority(self, queue, options):
+		"""
+		Return the priority given in options for a push onto queue (0 if none
+		is given). Raises DataqError 204 if the queue isn't a priority queue.
+		"""
+		retPriority = 0
+
+		if "priority" in options:
+			if queue.type != "priority":
+				raise DataqError, 204 # Option not supported by queue
+
+			try:
+				retPriority = int(options["priority"])
+			except ValueError:
+				raise DataqError, 101 # Bad syntax in request
+
+			if retPriority < -2147483648 or retPriority > 2147483647:
+				raise DataqError, 101 # Bad syntax in request
+
+		return(retPriority)
+
+	def reader(self, queue, options):
+		"""
+		Return what a pop or peek reads from: the queue itself or, for a
+		subscribe queue, the subscriber given in options. Raises DataqError
+		204 if a subscriber is given for another queue, and 205 if no or an
+		unknown subscriber is given for a subscribe queue.
+		"""
+		if queue.method != "subscribe":
+			if "subscriber" in options:
+				raise DataqError, 204 # Option not supported by queue
+			return(queue)
+
+		try:
+			return(queue.subscribers[options["subscriber"]])
+		except KeyError:
+			raise DataqError, 205 # Unknown subscriber
+
+	def due(self, options):
+		"""
+		Return the time at which a pushed message should become visible,
+		given in options as a number of seconds from now (delay) or as a
+		Unix timestamp (at). Returns None if the message should be pushed
+		right away.
+		"""
+		retDue = None
+
+		try:
+			if "delay" in options and "at" in options:
+				raise ValueError
+			if "delay" in options:
+				delay = float(options["delay"])
+				if delay < 0 or delay != delay or delay == float("inf"):
+					raise ValueError
+				retDue = time.time() + delay
+			if "at" in options:
+				retDue = float(options["at"])
+				if retDue != retDue or retDue == float("inf"):
+					raise ValueError
+		except ValueError:
+			raise DataqError, 101 # Bad syntax in request
+
+		if retDue != None and retDue <= time.time():
+			retDue = None
+
+		return(retDue)
+
+	def expires(self, queue, options, due):
+		"""
+		Return the time at which a message pushed onto queue expires: ttl
+		seconds (given in options, or the queue's ttl) after it becomes
+		visible at time due (None: right away). Returns None if the message
+		doesn't expire (a ttl of 0). Raises DataqError 204 if a ttl is given
+		for a queue with disk storage.
+		"""
+		retExpires = None
+		ttl = queue.ttl
+
+		if "ttl" in options:
+			if queue.storage == "disk":
+				raise DataqError, 204 # Option not supported by queue
+
+			try:
+				ttl = float(options["ttl"])
+				if ttl < 0 or ttl != ttl or ttl == float("inf"):
+					raise ValueError
+			except ValueError:
+				raise DataqError, 101 # Bad syntax in request
+
+		if ttl > 0:
+			if due == None:
+				due = time.time()
+			retExpires = due + ttl
+
+		return(retExpires)
+		
+	def flushJournals(self):
+		if self.flusher != None:
+			self.flusher.flush()
+
+	def writeSpool(self, queueName = None):
+		if queueName == None:
+			for queue in self.getQueues():
+				queue.writeSpool()
+		else:
+			self.getQueue(queueName).writeSpool()
+
+class ShardedQueuePool(QueuePool):
+
+	"""
+	The part of the queue pool owned by a single worker process, when running
+	multiple workers. Every queue is owned by exactly one worker, chosen by a
+	stable hash of the queue's name. Requests for queues owned by another
+	worker are forwarded to that worker's internal socket.
+	"""
+
+	def __init__(self, worker, workers, spoolDir, spoolEvents, spoolFlush = "every-op", compactOps = 0, compactSize = 0):
+		QueuePool.__init__(self, spoolDir, spoolEvents, spoolFlush, compactOps, compactSize)
+
+		self.worker = worker
+		self.workers = workers
+
+		# Queues owned by other workers: name -> worker
+		self.remoteQueues = {}
+
+		# Each thread has its own connections to the other workers.
+		self.connections = threading.local()
+
+	def owner(queueName, workers):
+		"""
+		Return the number of the worker that owns the queue queueName.
+		"""
+		return((zlib.crc32(queueName) & 0xffffffffL) % workers)
+
+	def socketPath(spoolDir, worker):
+		"""
+		Return the path of the internal socket of worker.
+		"""
+		return(os.path.join(spoolDir, "worker-" + str(worker) + ".sock"))
+
+	owner = staticmethod(owner)
+	socketPath = staticmethod(socketPath)
+
+	def createQueue(self, name, type, size, overflow, storage = "memory", method = "singleton", subscribers = [], ttl = 0, segmentSize = SegmentStore.segmentSize):
+		"""
+		Create a new queue if it's owned by this worker. Returns None if the
+		queue is owned by another worker.
+		"""
+		worker = ShardedQueuePool.owner(name, self.workers)
+
+		if worker != self.worker:
+			self.remoteQueues[name] = worker
+			return(None)
+
+		return(QueuePool.createQueue(self, name, type, size, overflow, storage, method, subscribers, ttl, segmentSize))
+
+	def remoteWorker(self, queueURI):
+		"""
+		Return the worker that owns the queue in queueURI, or None if it is
+		owned by this worker (or doesn't exist).
+		"""
+		username, password, queueName = self.parseQueueURI(queueURI)
+
+		if queueName in self.remoteQueues:
+			return(self.remoteQueues[queueName])
+
+		return(None)
+
+	def forward(self, worker, host, request):
+		"""
+		Forward a request of client host to worker and return the response.
+		The request is a list of binary mode frames (without their length).
+		Raises a DataqError if the worker returns an error.
+		"""
+		if not hasattr(self.connections, "files"):
+			self.connections.files = {}
+		files = self.connections.files
+
+		try:
+			if worker not in files:
+				sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+				sock.connect(ShardedQueuePool.socketPath(self.spoolDir, worker))
+				files[worker] = sock.makefile("r+b")
+				sock.close()
+
+				files[worker].write("BINARY\n")
+				files[worker].flush()
+				self.readResponse(files[worker])
+
+			# The request of the client is sent in the first frame.
+			request[0] = "AS " + host + " " + request[0]
+			files[worker].write("".join([struct.pack('>L', len(part)) + part for part in request]))
+			files[worker].flush()
+			status, retResponse = self.readResponse(files[worker])
+		except (socket.error, IOError, struct.error):
+			if worker in files:
+				files[worker].close()
+				del files[worker]
+			raise DataqError, 301 # Worker unavailable
+
+		if status == "-":
+			raise DataqError, int(retResponse.split(" ", 2)[1])
+
+		return(retResponse)
+
+	def readResponse(self, file):
+		"""
+		Read a binary mode response from file. Returns the status and the
+		response.
+		"""
+		header = file.read(5)
+		if len(header) != 5:
+			raise IOError, "Connection closed"
+
+		status = header[0]
+		length = struct.unpack('>L', header[1:])[0]
+		retResponse = file.read(length)
+
+		if len(retResponse) != length:
+			raise IOError, "Connection closed"
+
+		return(status, retResponse)
+
+	def push(self, host, queueURI, message):
+		worker = self.remoteWorker(queueURI)
+		if worker == None:
+			return(QueuePool.push(self, host, queueURI, message))
+
+		return(self.forward(worker, host, ["PUSH " + queueURI + " " + message]))
+
+	def mpush(self, host, queueURI, messages):
+		worker = self.remoteWorker(queueURI)
+		if worker == None:
+			return(QueuePool.mpush(self, host, queueURI, messages))
+
+		return(self.forward(worker, host, ["MPUSH " + queueURI + " " + str(len(messages))] + messages))
+
+	def checkPush(self, host, queueURI, count):
+		worker = self.remoteWorker(queueURI)
+		if worker == None:
+			return(QueuePool.checkPush(self, host, queueURI, count))
+
+		return(self.forward(worker, host, ["CHECK " + queueURI + " " + str(count)]))
+
+	def pop(self, host, queueURI):
+		worker = self.remoteWorker(queueURI)
+		if worker == None:
+			return(QueuePool.pop(self, host, queueURI))
+
+		return(self.forward(worker, host, ["POP " + queueURI]))
+
+	def bpop(self, host, queueURI, timeout):
+		worker = self.remoteWorker(queueURI)
+		if worker == None:
+			return(QueuePool.bpop(self, host, queueURI, timeout))
+
+		return(self.forward(worker, host, ["BPOP " + queueURI + " " + str(timeout)]))
+
+	def wait(self, host, queueURI, waiter):
+		worker = self.remoteWorker(queueURI)
+		if worker == None:
+			return(QueuePool.wait(self, host, queueURI, waiter))
+
+		RemoteWait(self, worker, host, queueURI, waiter)
+
+		return(None)
+
+	def take(self, host, queueURI, timeout):
+		worker = self.remoteWorker(queueURI)
+		if worker == None:
+			return(QueuePool.take(self, host, queueURI, timeout))
+
+		# The response is empty, or the priority, the expiry time ('-' if the
+		# message doesn't expire) and the message.
+		response = self.forward(worker, host, ["TAKE " + queueURI + " " + str(timeout)])
+		if response == "":
+			return(None, 0)
+
+		priority, expires, message = response.split(" ", 2)
+		if expires != "-":
+			message = ExpiringMessage(message, float(expires))
+
+		return(message, int(priority))
+
+	def returnMessage(self, host, queueURI, message, priority):
+		worker = self.remoteWorker(queueURI)
+		if worker == None:
+			return(QueuePool.returnMessage(self, host, queueURI, message, priority))
+
+		expires = "-"
+		if isinstance(message, ExpiringMessage):
+			expires = repr(message.expires)
+
+		return(self.forward(worker, host, ["RETURN " + queueURI + " " + str(priority) + " " + expires + " " + message]))
+
+	def mpop(self, host, queueURI, count):
+		worker = self.remoteWorker(queueURI)
+		if worker == None:
+			return(QueuePool.mpop(self, host, queueURI, count))
+
+		response = self.forward(worker, host, ["MPOP " + queueURI + " " + str(count)])
+
+		retMessages = []
+		offset = 0
+		while offset < len(response):
+			length = struct.unpack('>L', response[offset:offset + 4])[0]
+			retMessages.append(response[offset + 4:offset + 4 + length])
+			offset += 4 + length
+
+		return(retMessages)
+
+	def peek(self, host, queueURI):
+		worker = self.remoteWorker(queueURI)
+		if worker == None:
+			return(QueuePool.peek(self, host, queueURI))
+
+		return(self.forward(worker, host, ["PEEK " + queueURI]))
+
+	def stat(self, host, queueURI):
+		username, password, queueName = self.parseQueueURI(queueURI)
+
+		if queueName == "":
+			retResponse = QueuePool.stat(self, host, queueURI)
+
+			for queueName in self.remoteQueues.keys():
+				retResponse += "queue:" + queueName + "\n"
+
+			return(retResponse)
+
+		worker = self.remoteWorker(queueURI)
+		if worker == None:
+			return(QueuePool.stat(self, host, queueURI))
+
+		return(self.forward(worker, host, ["STAT " + queueURI]))
+
+	def clear(self, host, queueURI):
+		worker = self.remoteWorker(queueURI)
+		if worker == None:
+			return(QueuePool.clear(self, host, queueURI))
+
+		return(self.forward(worker, host, ["CLEAR " + queueURI]))
+
+class RemoteWait:
+
+	"""
+	A BPOP of an event server connection on a queue owned by another worker.
+	The event server can't block, so the BPOP is forwarded from a separate
+	thread, which delivers the response to the waiter. Takes the place of the
+	queue for the waiter.
+	"""
+
+	def __init__(self, queuePool, worker, host, queueURI, waiter):
+		self.queuePool = queuePool
+		self.worker = worker
+		self.host = host
+		self.queueURI = queueURI
+		self.name = queuePool.parseQueueURI(queueURI)[2]
+		self.waiter = waiter
+		self.cancelled = False
+		# Whether a message was taken from the queue for the waiter.
+		self.taken = False
+		self.lock = threading.Lock()
+
+		waiter.queue = self
+
+		thread = threading.Thread(target=self.run)
+		thread.setDaemon(True)
+		thread.start()
+
+	def run(self):
+		try:
+			message, priority = self.queuePool.take(self.host, self.queueURI, self.waiter.timeout)
+		except DataqError, e:
+			message, priority = e, 0
+
+		taken = message != None and not isinstance(message, DataqError)
+		if message == None:
+			message = ""
+
+		self.lock.acquire()
+		try:
+			cancelled = self.cancelled
+			if not cancelled:
+				self.taken = taken
+				self.waiter.deliver(message, priority)
+		finally:
+			self.lock.release()
+
+		if cancelled and taken:
+			# The connection stopped waiting before the message arrived.
+			self.putBack(message, priority)
+
+	def cancelWait(self, waiter):
+		self.lock.acquire()
+		try:
+			self.cancelled = True
+		finally:
+			self.lock.release()
+
+		return(waiter.message)
+
+	def returnMessage(self, waiter, message):
+		if self.taken:
+			self.putBack(message, waiter.priority)
+
+	def putBack(self, message, priority):
+		"""
+		Put back a message through the owning worker, which returns it to
+		the queue (or subscriber) it was taken from.
+		"""
+		try:
+			self.queuePool.returnMessage(self.host, self.queueURI, message, priority)
+		except DataqError, e:
+			Log.error("Couldn't return message to %s: %s", self.name, e)
+
+class Buffer:
+
+	"""
+	Receive buffer of a connection. Data is received straight into a
+	preallocated buffer, from which requests are taken without copying the
+	rest of the buffer. The buffer remembers how far it has searched for the
+	end of a line, so every byte is examined only once.
+
+	Requests longer than maxLength bytes (0 for no limit) are rejected with
+	DataqError 103 as soon as that is known, instead of being buffered.
+	"""
+
+	initialSize = 4096
+
+	def __init__(self, maxLength = 0):
+		self.maxLength = maxLength
+		self.data = bytearray(self.initialSize)
+
+		# Received data that hasn't been processed yet is in
+		# self.data[self.start:self.end]. There is no newline in
+		# self.data[self.start:self.scan].
+		self.start = 0
+		self.end = 0
+		self.scan = 0
+
+	def __len__(self):
+		return(self.end - self.start)
+
+	def receive(self, sock):
+		"""
+		Receive data from sock into the buffer. Returns the number of bytes
+		received, which is 0 if the connection was closed.
+		"""
+		if self.end == len(self.data):
+			self.makeRoom()
+
+		count = sock.recv_into(memoryview(self.data)[self.end:])
+		self.end += count
+
+		return(count)
+
+	def makeRoom(self):
+		"""
+		Make room for receiving more data, by moving the unprocessed data to
+		the start of the buffer or, if it is more than half full, by doubling
+		its size.
+		"""
+		length = self.end - self.start
+
+		if length > len(self.data) / 2:
+			self.data.extend(bytearray(len(self.data)))
+		else:
+			self.data[0:length] = self.data[self.start:self.end]
+			self.scan -= self.start
+			self.start = 0
+			self.end = length
+
+	def consume(self, end):
+		"""
+		Mark the data up to end as processed.
+		"""
+		self.start = end
+		self.scan = end
+
+		if self.start == self.end:
+			# Empty, so start at the beginning again. Drop a buffer that has
+			# grown large for a single big request.
+			self.start = 0
+			self.end = 0
+			self.scan = 0
+			if len(self.data) > 16 * self.initialSize:
+				self.data = bytearray(self.initialSize)
+
+	def readLine(self):
+		"""
+		Return the next line (without the newline), or None if no complete
+		line has been received yet.
+		"""
+		pos = self.data.find("\n", self.scan, self.end)
+
+		if pos == -1:
+			self.scan = self.end
+			if self.maxLength > 0 and self.end - self.start > self.maxLength:
+				raise DataqError, 103 # Request too long
+			return(None)
+
+		if self.maxLength > 0 and pos - self.start > self.maxLength:
+			raise DataqError, 103 # Request too long
+
+		line = str(self.data[self.start:pos])
+		self.consume(pos + 1)
+
+		return(line)
+
+	def readFrame(self):
+		"""
+		Return the next frame (a 4 byte length followed by that many bytes),
+		or None if no complete frame has been received yet.
+		"""
+		if self.end - self.start < 4:
+			return(None)
+
+		length = struct.unpack_from('>L', self.data, self.start)[0]
+
+		if self.maxLength > 0 and length > self.maxLength:
+			raise DataqError, 103 # Request too long
+
+		if self.end - self.start < 4 + length:
+			return(None)
+
+		frame = str(self.data[self.start + 4:self.start + 4 + length])
+		self.consume(self.start + 4 + length)
+
+		return(frame)
+
+class Protocol:
+
+	"""
+	The DataQ protocol. Turns the data received on a connection into requests,
+	delegates them to the queuePool and returns the resulting responses
+	(error, popped message, etc). Shared by the threaded RequestHandler and
+	the event-loop Connection, which only differ in how they talk to the
+	client.
+	"""
+
+	# Accept requests forwarded by other workers (AS command)?
+	internal = False
+
+	def initProtocol(self):
+		# Session mode is switched on by the KEEPALIVE command. While in
+		# session mode the connection stays open and every response is framed.
+		self.session = False
+		self.quit = False
+		self.done = False
+
+		# Messages still to be read for a multi-line (MPUSH) request.
+		self.pending = None
+
+		# Set while the connection is waiting in a BPOP without blocking.
+		self.waiting = None
+
+		# Binary mode is switched on by the BINARY command. Requests and
+		# responses are then length-prefixed instead of newline-terminated.
+		self.binary = False
+
+		self.buffer = Buffer(self.server.maxLine)
+
+	def processRequests(self):
+		"""
+		Process every complete request that has been received in the buffer,
+		in order. Returns the list of responses.
+		"""
+		responses = []
+
+		while not self.quit and self.waiting == None:
+			try:
+				request = self.nextRequest()
+			except DataqError, e:
+				# The rest of the request can't be read, so the connection
+				# can't be used anymore.
+				responses.append(self.respond(str(e) + "\n", True))
+				self.done = True
+				break
+
+			if request == None:
+				break
+			
+			Log.debug("%s: Raw command '%s'", self.client_address[0], request)
+
+			error = False
+			self.started = time.time()
+			try:
+				response = self.process(request)
+			except DataqError, e:
+				response = str(e) + "\n"
+				error = True
+
+			if self.quit:
+				break
+
+			if response == None:
+				# Request isn't complete yet.
+				continue
+
+			if not self.internal:
+				metrics.request(self.command, time.time() - self.started, error)
+
+			responses.append(self.respond(response, error))
+
+		if self.quit:
+			self.done = True
+
+		return(responses)
+
+	def nextRequest(self):
+		"""
+		Take the next complete request from the buffer. In text mode that's
+		a line, in binary mode a frame: a 4 byte length followed by the
+		request. Returns None if there is no complete request yet.
+		"""
+		if self.binary:
+			return(self.buffer.readFrame())
+
+		line = self.buffer.readLine()
+		if line != None:
+			line = line.rstrip()
+
+		return(line)
+
+	def respond(self, response, error = False):
+		"""
+		Prepare a response for sending it to the client.
+		"""
+		if self.binary:
+			response = self.frameBinary(response, error)
+		elif self.session:
+			response = self.frame(response)
+
+		self.done = not self.session
+
+		if not self.internal:
+			metrics.sent(len(response))
 
-			if qAccess == False:
-				raise DataqError, 202
+		return(response)
 
-			if qAccess == None:
-				if not qpAccess == True:
-					raise DataqError, 202
+	def frame(self, response):
+		"""
+		Frame a response for session mode by prefixing it with its length on
+		a line of its own, so clients know where one reply ends.
+		"""
+		return(str(len(response)) + "\n" + response)
+
+	def frameBinary(self, response, error = False):
+		"""
+		Frame a response for binary mode: a status byte ('+' for success, '-'
+		for an error) followed by the 4 byte length of the response and the
+		response itself.
+		"""
+		if error:
+			status = "-"
 		else:
-			if not qpAccess == True:
-				raise DataqError, 202
-				
-	def push(self, host, queueURI, message):
+			status = "+"
+
+		return(status + struct.pack('>L', len(response)) + response)
+
+	def process(self, data):
+
 		retResponse = ""
-		queue = None
-		username, password, queueName = self.parseQueueURI(queueURI)
+
+		if self.pending != None:
+			return(self.processPending(data))
 		
-		if queueName not in self.queues:
-			raise DataqError, 201 # Unknown queue
+		try:
+			requestType = data
+			requestType, data = data.split(" ", 1)
+		except ValueError:
+			data = ""
+			pass
 
-		queue = self.queues[queueName]
+		# Remembered for the metrics.
+		self.command = requestType.upper()
 
-		self.checkAccess(password, username, host, queue);
+		if self.command == "PUSH":
+			retResponse = self.processPush(data)
+		elif self.command == "MPUSH":
+			retResponse = self.processMpush(data)
+		elif self.command == "POP":
+			retResponse = self.processPop(data)
+		elif self.command == "MPOP":
+			retResponse = self.processMpop(data)
+		elif self.command == "BPOP":
+			retResponse = self.processBpop(data)
+		elif self.command == "PEEK":
+			retResponse = self.processPeek(data)
+		elif self.command == "STAT":
+			retResponse = self.processStat(data)
+		elif self.command == "METRICS":
+			retResponse = self.processMetrics(data)
+		elif self.command == "CLEAR":
+			retResponse = self.processClear(data)
+		elif self.command == "KEEPALIVE":
+			retResponse = self.processKeepalive(data)
+		elif self.command == "BINARY":
+			retResponse = self.processBinary(data)
+		elif self.command == "QUIT":
+			retResponse = self.processQuit(data)
+		elif self.command == "AS" and self.internal:
+			retResponse = self.processAs(data)
+		elif self.command == "CHECK" and self.internal:
+			retResponse = self.processCheck(data)
+		elif self.command == "TAKE" and self.internal:
+			retResponse = self.processTake(data)
+		elif self.command == "RETURN" and self.internal:
+			retResponse = self.processReturn(data)
+		else:
+			self.command = "UNKNOWN"
+			raise DataqError, 102 # Unknown request type
+
+		return retResponse
+	
+	def processPush(self, data):
+		global queuePool
+		
+		retResponse = ""
+		
+		try:
+			queueURI, data = data.split(" ", 1)
+			retResponse = queuePool.push(self.client_address[0], queueURI, data)
+		except ValueError:
+			raise DataqError, 101 # Bad syntax in request
+
+		return retResponse
+
+	def processMpush(self, data):
+		global queuePool
+
+		retResponse = ""
+
+		queueURI, count = self.parseMpush(data)
+
+		# Check the request before its messages arrive. The messages of a
+		# request that is rejected are skipped instead of buffered, and the
+		# error is the response once they have all been received.
+		error = None
+		try:
+			queuePool.checkPush(self.client_address[0], queueURI, count)
+		except DataqError, e:
+			error = e
+
+		self.pending = {
+			"queueURI": queueURI,
+			"count": count,
+			"received": 0,
+			"messages": [],
+			"error": error,
+		}
+
+		# The messages follow on the next lines of the request.
+		retResponse = None
+		if count == 0:
+			retResponse = self.processPending(None)
+
+		return retResponse
+
+	def processPending(self, data):
+		global queuePool
+
+		retResponse = None
+
+		if data != None:
+			self.pending["received"] += 1
+			if self.pending["error"] == None:
+				self.pending["messages"].append(data)
+
+		if self.pending["received"] == self.pending["count"]:
+			pending = self.pending
+			self.pending = None
+
+			if pending["error"] != None:
+				raise pending["error"]
+
+			retResponse = queuePool.mpush(self.client_address[0], pending["queueURI"], pending["messages"])
+
+		return retResponse
+
+	def parseMpush(self, data):
+		try:
+			queueURI, count = data.split(" ", 1)
+			count = int(count)
+		except ValueError:
+			raise DataqError, 101 # Bad syntax in request
+
+		if count < 0:
+			raise DataqError, 101 # Bad syntax in request
+
+		return(queueURI, count)
+
+	def processPop(self, data):
+		global queuePool
+		
+		retResponse = ""
+		
+		try:
+			queueURI = data
+			retResponse = queuePool.pop(self.client_address[0], queueURI)
+		except ValueError:
+			raise DataqError, 101 # Bad syntax in request
+
+		return retResponse
+
+	def processBpop(self, data):
+		global queuePool
+		
+		retResponse = ""
+		
+		queueURI, timeout = self.parseBpop(data)
+
+		retResponse = queuePool.bpop(self.client_address[0], queueURI, timeout)
+
+		return retResponse
+
+	def parseBpop(self, data):
+		try:
+			queueURI, timeout = data.split(" ", 1)
+			timeout = float(timeout)
+		except ValueError:
+			raise DataqError, 101 # Bad syntax in request
+
+		# A timeout of nan or inf would never pass.
+		if timeout < 0 or timeout != timeout or timeout == float("inf"):
+			raise DataqError, 101 # Bad syntax in request
+
+		return(queueURI, timeout)
+
+	def processMpop(self, data):
+		global queuePool
+		
+		retResponse = ""
+		
+		try:
+			queueURI, count = data.split(" ", 1)
+			count = int(count)
+		except ValueError:
+			raise DataqError, 101 # Bad syntax in request
+
+		if count < 0:
+			raise DataqError, 101 # Bad syntax in request
+
+		messages = queuePool.mpop(self.client_address[0], queueURI, count)
+
+		if self.binary:
+			# Each message is prefixed by its 4 byte length.
+			retResponse = "".join([struct.pack('>L', len(message)) + message for message in messages])
+		else:
+			retResponse = str(len(messages)) + "\n" + "".join([message + "\n" for message in messages])
+
+		return retResponse
+
+	def processPeek(self, data):
+		global queuePool
+		
+		retResponse = ""
+		
+		try:
+			queueURI = data
+			retResponse = queuePool.peek(self.client_address[0], queueURI)
+		except ValueError:
+			raise DataqError, 101 # Bad syntax in request
+
+		return retResponse
+
+	def processStat(self, data):
+		global queuePool
+
+		retResponse = ""
+
+		queueURI = data
+
+		retResponse = queuePool.stat(self.client_address[0], queueURI)
+
+		return(retResponse)
+
+	def processMetrics(self, data):
+		global queuePool
+
+		retResponse = ""
+
+		retResponse = queuePool.metrics(self.client_address[0], data)
+
+		return(retResponse)
+
+	def processClear(self, data):
+		global queuePool
+		
+		retResponse = ""
+		
+		try:
+			queueURI = data
+			retResponse = queuePool.clear(self.client_address[0], queueURI)
+		except ValueError:
+			raise DataqError, 101 # Bad syntax in request
+
+		return retResponse
+
+	def processKeepalive(self, data):
+		retResponse = ""
+
+		Log.debug("Session started for %s:%s", self.client_address[0], self.client_address[1])
+
+		self.session = True
+		retResponse = "OK\n"
+
+		return retResponse
+
+	def processBinary(self, data):
+		retResponse = ""
+
+		Log.debug("Binary session started for %s:%s", self.client_address[0], self.client_address[1])
+
+		self.session = True
+		self.binary = True
+		retResponse = "OK\n"
+
+		return retResponse
+
+	def processQuit(self, data):
+		retResponse = ""
+
+		self.quit = True
+
+		return retResponse
+
+	def processAs(self, data):
+		"""
+		Process a request forwarded by another worker on behalf of a client.
+		"""
+		try:
+			host, data = data.split(" ", 1)
+		except ValueError:
+			raise DataqError, 101 # Bad syntax in request
+
+		self.client_address = (host, 0)
+
+		return(self.process(data))
+
+	def processCheck(self, data):
+		"""
+		Process the check of an MPUSH forwarded by another worker before it
+		reads the messages.
+		"""
+		global queuePool
+
+		queueURI, count = self.parseMpush(data)
+
+		queuePool.checkPush(self.client_address[0], queueURI, count)
+
+		return("")
+
+	def processTake(self, data):
+		"""
+		Process a BPOP forwarded by another worker for a client of its event
+		server (see RemoteWait).
+		"""
+		global queuePool
+
+		retResponse = ""
+
+		queueURI, timeout = self.parseBpop(data)
+
+		message, priority = queuePool.take(self.client_address[0], queueURI, timeout)
+		if message != None:
+			expires = "-"
+			if isinstance(message, ExpiringMessage):
+				expires = repr(message.expires)
+			retResponse = str(priority) + " " + expires + " " + message
+
+		return retResponse
+
+	def processReturn(self, data):
+		"""
+		Process the return of a message taken with TAKE that never reached
+		the client.
+		"""
+		global queuePool
+
+		try:
+			queueURI, priority, expires, message = data.split(" ", 3)
+			priority = int(priority)
+			if expires != "-":
+				message = ExpiringMessage(message, float(expires))
+		except ValueError:
+			raise DataqError, 101 # Bad syntax in request
+
+		queuePool.returnMessage(self.client_address[0], queueURI, message, priority)
+
+		return("")
+
+class RequestHandler(Protocol, SocketServer.BaseRequestHandler):
+
+	"""
+	Handle a single incomming connection in its own thread by reading
+	requests, processing them and then transmitting the responses.
+	"""
+	
+	def __init__(self, request, client_address, server):
+		SocketServer.BaseRequestHandler.__init__(self, request, client_address, server)
+
+	def handle(self):
+
+		Log.debug("Connection from %s:%s", self.client_address[0], self.client_address[1])
+
+		self.initProtocol()
+
+		# Messages taken by BPOP that haven't been sent yet:
+		# (queueURI, message, priority)
+		self.taken = []
+
+		while not self.done:
+
+			timeout = None
+			if self.session:
+				timeout = self.server.sessionTimeout
+
+			# Use a socket timeout instead of select(), which can't handle
+			# file descriptors above FD_SETSIZE (i.e. many connections).
+			self.request.settimeout(timeout)
+
+			try:
+				count = self.buffer.receive(self.request)
+			except socket.timeout:
+				Log.debug("Session from %s:%s timed out", self.client_address[0], self.client_address[1])
+				break
+
+			if count == 0:
+				break
+
+			if not self.internal:
+				metrics.received(count)
+
+			# Process every complete request that has been received so far
+			# in order, and send all responses in one go.
+			responses = self.processRequests()
+
+			if len(responses) > 0:
+				try:
+					# The client may have gone while waiting in BPOP.
+					if len(self.taken) > 0 and self.clientGone():
+						raise socket.error, "Connection closed by client"
+					self.request.sendall("".join(responses))
+				except socket.error, e:
+					Log.debug("Couldn't send response to %s:%s: %s", self.client_address[0], self.client_address[1], e)
+					self.returnTaken()
+					break
+				self.taken = []
+
+		self.request.close()
+		Log.debug("Connection closed from %s:%s", self.client_address[0], self.client_address[1])
+
+	def finish(self):
+		"""Nothing"""
+
+	def processBpop(self, data):
+		"""
+		Like Protocol.processBpop, but the message is remembered until it
+		has been sent, so it can be returned if the client is gone.
+		"""
+		global queuePool
+
+		retResponse = ""
+
+		queueURI, timeout = self.parseBpop(data)
+
+		message, priority = queuePool.take(self.client_address[0], queueURI, timeout)
+		if message != None:
+			self.taken.append((queueURI, message, priority))
+			retResponse = message
+
+		return retResponse
+
+	def clientGone(self):
+		"""
+		Check, without blocking, whether the client has closed the
+		connection.
+		"""
+		self.request.setblocking(0)
+		try:
+			try:
+				return(self.request.recv(1, socket.MSG_PEEK) == "")
+			except socket.error, (errNr, errMsg):
+				return(errNr not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR))
+		finally:
+			self.request.setblocking(1)
+
+	def returnTaken(self):
+		"""
+		Put back the messages taken by BPOP that never reached the client.
+		"""
+		global queuePool
+
+		for queueURI, message, priority in self.taken:
+			try:
+				queuePool.returnMessage(self.client_address[0], queueURI, message, priority)
+			except DataqError, e:
+				Log.error("Couldn't return message to %s: %s", queueURI, e)
+		self.taken = []
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+
+	"""
+	Basic socket server. Handles each connection in its own thread.
+	"""
 
-		retResponse = queue.push(message)
+	daemon_threads = True
+	allow_reuse_address = True
+	request_queue_size = 1024
 
-		for spoolEvent in self.spoolEvents:
-			if spoolEvent == "write":
-				self.writeSpool(queueName)
+	def __init__(self, server_address, RequestHandlerClass, sessionTimeout = 300, maxLine = 1048576):
+		if ':' in server_address[0]:
+			self.address_family = socket.AF_INET6
 
-		return(retResponse)
+		SocketServer.TCPServer.__init__(self, server_address, RequestHandlerClass)
 
-	def pop(self, host, queueURI):
-		retResponse = ""
-		queue = None
-		username, password, queueName = self.parseQueueURI(queueURI)
-		
-		if queueName not in self.queues:
-			raise DataqError, 201 # Unknown queue
+		self.sessionTimeout = sessionTimeout
+		self.maxLine = maxLine
 
-		queue = self.queues[queueName]
+	def handle_error(self, request, client_address):
+		# SocketServer handles any exception raised while starting a request
+		# thread, including the SystemExit of the signal handler when the
+		# signal arrives at that moment. Don't swallow the shutdown.
+		if sys.exc_info()[0] == SystemExit:
+			raise
+		SocketServer.TCPServer.handle_error(self, request, client_address)
 
-		self.checkAccess(password, username, host, queue);
+class InternalRequestHandler(RequestHandler):
 
-		retResponse = queue.pop()
+	"""
+	Handle a connection from another worker on the internal socket. Requests
+	are prefixed with the address of the client on whose behalf they are
+	forwarded (AS <host> <request>), so access is checked by the worker that
+	owns the queue.
+	"""
 
-		for spoolEvent in self.spoolEvents:
-			if spoolEvent == "write":
-				self.writeSpool(queueName)
+	internal = True
 
-		return(retResponse)
+	def __init__(self, request, client_address, server):
+		RequestHandler.__init__(self, request, ("worker", 0), server)
 
-	def peek(self, host, queueURI):
-		retResponse = ""
-		queue = None
-		username, password, queueName = self.parseQueueURI(queueURI)
-		
-		if queueName not in self.queues:
-			raise DataqError, 201 # Unknown queue
+class InternalServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
 
-		queue = self.queues[queueName]
+	"""
+	Unix socket server on which a worker receives the requests forwarded by
+	the other workers. Requests on it are trusted to be made on behalf of the
+	client they name (AS), so only the other workers may connect: the socket
+	is only accessible by the user the server runs as, and on Linux the peer
+	has to be a process of that user started by the same parent process.
+	"""
 
-		self.checkAccess(password, username, host, queue);
+	daemon_threads = True
+	request_queue_size = 1024
+	sessionTimeout = None
+	maxLine = 0
 
-		retResponse = queue.peek()
+	# Not defined by the socket module of Python 2.
+	SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
 
-		return(retResponse)
+	def __init__(self, path):
+		if os.path.exists(path):
+			os.unlink(path)
 
-	def stat(self, host, queueURI):
-		retResponse = ""
-		queue = None
-		username, password, queueName = self.parseQueueURI(queueURI)
-		
-		Log.verboseWarn(queueURI)
+		# The daemon clears the umask, so set it while creating the socket.
+		oldUmask = os.umask(077)
+		try:
+			SocketServer.UnixStreamServer.__init__(self, path, InternalRequestHandler)
+		finally:
+			os.umask(oldUmask)
 
-		if queueName == "":
+	def verify_request(self, request, client_address):
+		if not sys.platform.startswith("linux"):
+			return(True)
 
-			self.checkAccess(password, username, host);
+		try:
+			pid, uid, gid = struct.unpack('3i', request.getsockopt(socket.SOL_SOCKET, InternalServer.SO_PEERCRED, struct.calcsize('3i')))
+			f = open("/proc/" + str(pid) + "/stat", "r")
+			try:
+				# The parent pid follows the (parenthesized) name and state.
+				ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+			finally:
+				f.close()
+		except (socket.error, IOError, ValueError, IndexError), e:
+			Log.warning("Refused connection on the internal socket: %s", e)
+			return(False)
 
-			retResponse = ""
+		if uid != os.getuid() or ppid != os.getppid():
+			Log.warning("Refused connection on the internal socket from process %i (uid %i)", pid, uid)
+			return(False)
 
-			for queueName in self.queues:
-				queue = self.queues[queueName]
-				retResponse += "queue:" + queue.name + "\n"
-		else:
-			if queueName not in self.queues:
-				raise DataqError, 201 # Unknown queue
+		return(True)
 
-			queue = self.queues[queueName]
+class MetricsRequestHandler(SocketServer.BaseRequestHandler):
 
-			self.checkAccess(password, username, host, queue);
+	"""
+	Send the metrics as plain text to whoever connects to the metrics port.
+	"""
 
-			retResponse = queue.stat()
+	def handle(self):
+		self.request.sendall(metrics.report())
 
-		return(retResponse)
+class MetricsServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
 
-	def clear(self, host, queueURI):
-		retResponse = ""
-		queue = None
-		username, password, queueName = self.parseQueueURI(queueURI)
-		
-		if queueName not in self.queues:
-			raise DataqError, 201 # Unknown queue
+	"""
+	Listener for scraping the metrics (see the METRICS command) locally, in
+	plain text. It doesn't check the access rules, so it listens on the
+	loopback address by default.
+	"""
 
-		queue = self.queues[queueName]
+	daemon_threads = True
+	allow_reuse_address = True
 
-		self.checkAccess(password, username, host, queue);
+	def __init__(self, server_address):
+		if ':' in server_address[0]:
+			self.address_family = socket.AF_INET6
 
-		retResponse = queue.clear()
+		SocketServer.TCPServer.__init__(self, server_address, MetricsRequestHandler)
 
-		for spoolEvent in self.spoolEvents:
-			if spoolEvent == "write":
-				self.writeSpool(queueName)
+class ConnectionWaiter(Waiter):
 
-		return(retResponse)
+	"""
+	A Connection waiting in BPOP. Instead of blocking, delivering a message
+	makes the event loop resume the connection.
+	"""
 
-	def parseQueueURI(self, queueURI):
-		password = ""
-		username = ""
-		queueName = ""
+	def __init__(self, connection, timeout):
+		Waiter.__init__(self)
+		self.connection = connection
+		self.timeout = timeout
 
-		try:
-			queueName = queueURI
-			authentication, queueName = queueURI.split("@", 1)
-			password = authentication
-			username, password = authentication.split(":", 1)
-		except ValueError:
-			pass
-			
-		return (username, password, queueName)
-		
-	def writeSpool(self, queueName = None):
-		if queueName == None:
-			for queueName in self.queues:
-				queue = self.queues[queueName]
-				queue.writeSpool()
-		else:
-			self.queues[queueName].writeSpool()
+	def deliver(self, message, priority = 0):
+		Waiter.deliver(self, message, priority)
+		self.connection.server.resumeLater(self.connection)
 
-class RequestHandler(SocketServer.BaseRequestHandler):
+class Connection(Protocol):
 
 	"""
-	Handle a single incomming connection by reading a request, processing it,
-	delegating it to the queuePool and then transmitting the resulting data
-	(error, popped message, etc).
+	A client connection handled by the EventServer. All socket operations are
+	non-blocking; the server calls handleRead and handleWrite when the socket
+	is ready.
 	"""
-	
-	def __init__(self, request, client_address, server):
-		SocketServer.BaseRequestHandler.__init__(self, request, client_address, server)
 
-	def handle(self):
+	def __init__(self, server, request, client_address):
+		self.server = server
+		self.request = request
+		self.client_address = client_address
+		self.output = ""
+		self.closed = False
+		self.lastActive = time.time()
 
-		Log.verboseMsg("Connection from " + self.client_address[0] + ":" + str(self.client_address[1]))
+		self.request.setblocking(0)
+		self.initProtocol()
 
-		ready_to_read, ready_to_write, in_error = select.select([self.request], [], [], None)
+		Log.debug("Connection from %s:%s", self.client_address[0], self.client_address[1])
 
-		text = ''
-		done = False
-		while not done:
+	def fileno(self):
+		return(self.request.fileno())
 
-			if len(ready_to_read) == 1 and ready_to_read[0] == self.request:
-				data = self.request.recv(1024)
+	def handleRead(self):
+		try:
+			count = self.buffer.receive(self.request)
+		except socket.error, (errNr, errMsg):
+			if errNr in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+				return
+			count = 0
 
-				if not data:
-					break
-				elif len(data) > 0:
-					text += str(data)
+		if count == 0:
+			self.close()
+			return
 
-					while text.find("\n") != -1:
-						line, text = text.split("\n", 1)
-						line = line.rstrip()
-						
-						Log.verboseMsg(
-							self.client_address[0] + \
-							": Raw command '" + \
-							line + \
-							"'")
+		metrics.received(count)
+		self.lastActive = time.time()
+		self.send(self.processRequests())
 
-						try:
-							response = self.process(line)
-						except DataqError, e:
-							response = str(e) + "\n"
+	def handleWrite(self):
+		self.send([])
 
-						self.request.send(response)
+	def send(self, responses):
+		"""
+		Send as much of the responses (and any output still waiting to be
+		sent) as the socket accepts right now. The rest is sent when the
+		socket becomes writable.
+		"""
+		if len(responses) > 0:
+			self.output += "".join(responses)
 
-						done = True
+		if len(self.output) > 0:
+			try:
+				sent = self.request.send(self.output)
+			except socket.error, (errNr, errMsg):
+				if errNr not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+					self.close()
+					return
+				sent = 0
+			self.output = self.output[sent:]
+
+		if len(self.output) > 0:
+			self.server.wantWrite(self, True)
+		else:
+			self.server.wantWrite(self, False)
+			if self.done and self.waiting == None:
+				self.close()
 
-		self.request.close()
-		Log.verboseMsg("Connection closed from " + self.client_address[0] + ":" + str(self.client_address[1]))
+	def processBpop(self, data):
+		global queuePool
 
-	def finish(self):
-		"""Nothing"""
+		queueURI, timeout = self.parseBpop(data)
 
-	def process(self, data):
+		waiter = ConnectionWaiter(self, timeout)
+		if timeout == 0:
+			return(queuePool.pop(self.client_address[0], queueURI))
 
-		retResponse = ""
-		
-		try:
-			requestType = data
-			requestType, data = data.split(" ", 1)
-		except ValueError:
-			data = ""
-			pass
+		message = queuePool.wait(self.client_address[0], queueURI, waiter)
+		if message != None:
+			return(message)
 
-		if requestType.upper() == "PUSH":
-			retResponse = self.processPush(data)
-		elif requestType.upper() == "POP":
-			retResponse = self.processPop(data)
-		elif requestType.upper() == "PEEK":
-			retResponse = self.processPeek(data)
-		elif requestType.upper() == "STAT":
-			retResponse = self.processStat(data)
-		elif requestType.upper() == "CLEAR":
-			retResponse = self.processClear(data)
+		# Stop processing requests until a message arrives or the timeout
+		# expires; see resume().
+		self.waiting = waiter
+		self.server.addTimeout(time.time() + timeout, waiter)
+
+		return(None)
+
+	def resume(self, timedOut = False):
+		"""
+		Continue after waiting in BPOP: send the message that was delivered
+		(or an empty response if none arrived before the timeout) and process
+		any requests that came in while waiting.
+		"""
+		waiter = self.waiting
+
+		if waiter == None or self.closed:
+			return
+		if waiter.message == None and not timedOut:
+			return
+
+		message = waiter.queue.cancelWait(waiter)
+		if message == None:
+			message = ""
+
+		error = isinstance(message, DataqError)
+		metrics.request(self.command, time.time() - self.started, error)
+
+		if error:
+			response = self.respond(str(message) + "\n", True)
 		else:
-			raise DataqError, 102 # Unknown request type
+			response = self.respond(message)
 
-		return retResponse
-	
-	def processPush(self, data):
-		global queuePool
-		
-		retResponse = ""
-		
-		try:
-			queueURI, data = data.split(" ", 1)
-			retResponse = queuePool.push(self.client_address[0], queueURI, data)
-		except ValueError:
-			raise DataqError, 101 # Bad syntax in request
+		self.waiting = None
+		self.lastActive = time.time()
+		self.send([response] + self.processRequests())
 
-		return retResponse
+	def close(self):
+		if self.closed:
+			return
 
-	def processPop(self, data):
-		global queuePool
-		
-		retResponse = ""
-		
-		try:
-			queueURI = data
-			retResponse = queuePool.pop(self.client_address[0], queueURI)
-		except ValueError:
-			raise DataqError, 101 # Bad syntax in request
+		self.closed = True
 
-		return retResponse
+		if self.waiting != None:
+			# Don't lose a message that was delivered but never sent.
+			message = self.waiting.queue.cancelWait(self.waiting)
+			if message != None:
+				try:
+					self.waiting.queue.returnMessage(self.waiting, message)
+				except DataqError, e:
+					Log.error("Couldn't return message to %s: %s", self.waiting.queue.name, e)
+			self.waiting = None
 
-	def processPeek(self, data):
-		global queuePool
-		
-		retResponse = ""
-		
-		try:
-			queueURI = data
-			retResponse = queuePool.peek(self.client_address[0], queueURI)
-		except ValueError:
-			raise DataqError, 101 # Bad syntax in request
+		self.server.removeConnection(self)
+		self.request.close()
+		Log.debug("Connection closed from %s:%s", self.client_address[0], self.client_address[1])
 
-		return retResponse
+class EventServer:
 
-	def processStat(self, data):
-		global queuePool
+	"""
+	Single-threaded event-loop server. Handles all connections from a single
+	thread with non-blocking sockets, using epoll where available and poll
+	otherwise. Uses far less memory per connection than the threaded Server,
+	so it can handle many more (idle) connections.
+	"""
 
-		retResponse = ""
+	def __init__(self, server_address, sessionTimeout = 300, maxLine = 1048576):
+		self.sessionTimeout = sessionTimeout
+		self.maxLine = maxLine
 
-		queueURI = data
+		family = socket.AF_INET
+		if ':' in server_address[0]:
+			family = socket.AF_INET6
 
-		retResponse = queuePool.stat(self.client_address[0], queueURI)
+		self.socket = socket.socket(family, socket.SOCK_STREAM)
+		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.socket.bind(server_address)
+		self.socket.listen(1024)
+		self.socket.setblocking(0)
 
-		return(retResponse)
+		self.connections = {}
+		self.writing = {}
 
-	def processClear(self, data):
-		global queuePool
-		
-		retResponse = ""
-		
-		try:
-			queueURI = data
-			retResponse = queuePool.clear(self.client_address[0], queueURI)
-		except ValueError:
-			raise DataqError, 101 # Bad syntax in request
+		# Connections that have been delivered a message while waiting in
+		# BPOP, and a heap of (deadline, waiter) for waits that may time out.
+		# Other threads append to resumable, so it's a deque, which can be
+		# appended to and drained from different threads without a lock.
+		self.resumable = deque()
+		self.timeouts = []
+		self.lastIdleCheck = time.time()
 
-		return retResponse
+	def resumeLater(self, connection):
+		self.resumable.append(connection)
 
-class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+		if threading.currentThread() != self.thread:
+			try:
+				os.write(self.wakeupWrite, "x")
+			except OSError:
+				# The pipe is full, so the event loop will wake up anyway.
+				pass
 
-	"""
-	Basic socket server
-	"""
+	def addTimeout(self, deadline, waiter):
+		heapq.heappush(self.timeouts, (deadline, waiter))
+
+	def wantWrite(self, connection, want):
+		fd = connection.fileno()
+
+		if want and fd not in self.writing:
+			self.writing[fd] = True
+			self.poller.modify(fd, select.POLLIN | select.POLLOUT)
+		elif not want and fd in self.writing:
+			del self.writing[fd]
+			self.poller.modify(fd, select.POLLIN)
+
+	def removeConnection(self, connection):
+		fd = connection.fileno()
+
+		if fd in self.connections:
+			del self.connections[fd]
+			if fd in self.writing:
+				del self.writing[fd]
+			self.poller.unregister(fd)
+
+	def serve_forever(self):
+		# The poller and pipe are created here instead of in __init__, so that
+		# worker processes don't share them after forking.
+		if hasattr(select, "epoll"):
+			self.poller = select.epoll()
+			self.pollerTimeoutScale = 1
+		else:
+			self.poller = select.poll()
+			self.pollerTimeoutScale = 1000
 
-	daemon_threads = True
-	allow_reuse_address = True
+		self.poller.register(self.socket.fileno(), select.POLLIN)
 
-	def __init__(self, server_address, RequestHandlerClass):
-		SocketServer.TCPServer.__init__(self, server_address, RequestHandlerClass)
+		# Other threads (a worker's internal server) may deliver messages to
+		# waiting connections. They wake up the event loop through this pipe.
+		self.thread = threading.currentThread()
+		self.wakeupRead, self.wakeupWrite = os.pipe()
+		fcntl.fcntl(self.wakeupWrite, fcntl.F_SETFL, os.O_NONBLOCK)
+		self.poller.register(self.wakeupRead, select.POLLIN)
+
+		while True:
+			timeout = 1.0
+			if len(self.timeouts) > 0:
+				timeout = max(0, min(timeout, self.timeouts[0][0] - time.time()))
+			if len(self.resumable) > 0:
+				timeout = 0
+
+			try:
+				events = self.poller.poll(timeout * self.pollerTimeoutScale)
+			except (select.error, IOError), e:
+				if e.args[0] == errno.EINTR:
+					continue
+				raise
+
+			for fd, event in events:
+				if fd == self.socket.fileno():
+					self.accept()
+					continue
+				if fd == self.wakeupRead:
+					os.read(self.wakeupRead, 4096)
+					continue
+
+				if fd not in self.connections:
+					continue
+				connection = self.connections[fd]
+
+				if event & (select.POLLIN | select.POLLERR | select.POLLHUP):
+					connection.handleRead()
+				if event & select.POLLOUT and not connection.closed:
+					connection.handleWrite()
+
+			self.processTimers()
+
+	def accept(self):
+		while True:
+			try:
+				request, client_address = self.socket.accept()
+			except socket.error, (errNr, errMsg):
+				# EAGAIN: no more pending connections. Other errors (e.g.
+				# running out of file descriptors) are retried on the next
+				# event.
+				return
+
+			connection = Connection(self, request, client_address)
+			self.connections[connection.fileno()] = connection
+			self.poller.register(connection.fileno(), select.POLLIN)
+
+	def processTimers(self):
+		# Only the connections that are already there; resuming a connection
+		# may make it resumable again.
+		for i in range(len(self.resumable)):
+			self.resumable.popleft().resume()
+
+		now = time.time()
+		while len(self.timeouts) > 0 and self.timeouts[0][0] <= now:
+			deadline, waiter = heapq.heappop(self.timeouts)
+			if waiter.connection.waiting == waiter:
+				waiter.connection.resume(True)
+
+		# Close idle connections.
+		if now - self.lastIdleCheck >= 1.0:
+			self.lastIdleCheck = now
+			for connection in self.connections.values():
+				if connection.waiting == None and now - connection.lastActive > self.sessionTimeout:
+					Log.debug("Session from %s:%s timed out", connection.client_address[0], connection.client_address[1])
+					connection.close()
 
 class Daemon:
 
@@ -830,6 +5204,9 @@ class Daemon:
 		if os.path.exists(self.pidfile):
 			raise DaemonError, 101
 
+		# Don't let the child inherit half-written log output.
+		Log.flush()
+
 		try: 
 			pid = os.fork() 
 			if pid > 0:
@@ -855,7 +5232,7 @@ class Daemon:
 		self.logPID(os.getpid())
 
 	def logPID(self, pid):
-		Log.verboseMsg("PID: " + str(pid))
+		Log.info("PID: %i", pid)
 		# Write the daemon PID to the PID file (default /var/run/dataq.pid)
 		try:
 			f = open(self.pidfile, 'w')
@@ -868,7 +5245,7 @@ class Daemon:
 	def cleanup(self):
 
 		# Clean up PID file
-		Log.verboseMsg("Cleaning up daemon process")
+		Log.info("Cleaning up daemon process")
 		try:
 			os.remove(self.pidfile)
 		except IOError, e:
@@ -895,6 +5272,7 @@ class Config:
 	def __init__(self, configFiles, configOverrides):
 
 		self.dataq = {}
+		self.dataq["logFiles"] = []
 		self.queuePool = {}
 		self.queuePool["access"] = []
 
@@ -921,7 +5299,7 @@ class Config:
 		retFinalConfigFile = None
 
 		for configFile in configFiles:
-			Log.verboseMsg("Trying config " + configFile);
+			Log.debug("Trying config %s", configFile);
 			try:
 				f = open(configFile, 'r')
 				f.close()
@@ -932,7 +5310,7 @@ class Config:
 		if not retFinalConfigFile:
 			raise ConfigError, 001 # No usable config file found
 
-		Log.verboseMsg("Using config " + retFinalConfigFile);
+		Log.info("Using config %s", retFinalConfigFile);
 		return(retFinalConfigFile)
 
 	def readConfigFile(self, configFile):
@@ -950,6 +5328,14 @@ class Config:
 					self.dataq["port"] = int(attribute.nodeValue)
 				if attribute.nodeName == "daemon":
 					self.dataq["daemon"] = str2bool(attribute.nodeValue)
+				if attribute.nodeName == "timeout":
+					self.dataq["timeout"] = int(attribute.nodeValue)
+				if attribute.nodeName == "server":
+					self.dataq["server"] = str(attribute.nodeValue)
+				if attribute.nodeName == "workers":
+					self.dataq["workers"] = int(attribute.nodeValue)
+				if attribute.nodeName == "maxline":
+					self.dataq["maxLine"] = int(attribute.nodeValue)
 
 			# <pidfile>
 			pidFileNodes = xpath.Evaluate('pidfile', dataqNode)
@@ -957,6 +5343,36 @@ class Config:
 				if pidFileNode.firstChild != None:
 					self.dataq["pidFile"] = pidFileNode.firstChild.data
 
+			# <log>
+			logNodes = xpath.Evaluate('log', dataqNode)
+			for logNode in logNodes:
+				for attribute in logNode.attributes:
+					if attribute.nodeName == "level":
+						self.dataq["logLevel"] = str(attribute.nodeValue)
+
+				# <file>
+				fileNodes = xpath.Evaluate('file', logNode)
+				for fileNode in fileNodes:
+					if fileNode.firstChild != None:
+						self.dataq["logFiles"].append(fileNode.firstChild.data)
+
+				# <syslog>
+				syslogNodes = xpath.Evaluate('syslog', logNode)
+				for syslogNode in syslogNodes:
+					self.dataq["logSyslog"] = "daemon"
+					for attribute in syslogNode.attributes:
+						if attribute.nodeName == "facility":
+							self.dataq["logSyslog"] = str(attribute.nodeValue)
+
+			# <metrics>
+			metricsNodes = xpath.Evaluate('metrics', dataqNode)
+			for metricsNode in metricsNodes:
+				for attribute in metricsNode.attributes:
+					if attribute.nodeName == "address":
+						self.dataq["metricsAddress"] = str(attribute.nodeValue)
+					if attribute.nodeName == "port":
+						self.dataq["metricsPort"] = int(attribute.nodeValue)
+
 			# <spool>
 			spoolNodes = xpath.Evaluate('spool', dataqNode)
 			for spoolNode in spoolNodes:
@@ -971,6 +5387,21 @@ class Config:
 					if eventNode.firstChild != None:
 						self.queuePool["spoolEvents"].append(eventNode.firstChild.data)
 
+				# <flush>
+				flushNodes = xpath.Evaluate('flush', spoolNode)
+				for flushNode in flushNodes:
+					if flushNode.firstChild != None:
+						self.queuePool["spoolFlush"] = str(flushNode.firstChild.data)
+
+				# <compact>
+				compactNodes = xpath.Evaluate('compact', spoolNode)
+				for compactNode in compactNodes:
+					for attribute in compactNode.attributes:
+						if attribute.nodeName == "ops":
+							self.queuePool["compactOps"] = int(attribute.nodeValue)
+						if attribute.nodeName == "size":
+							self.queuePool["compactSize"] = int(attribute.nodeValue)
+
 				# <spooldir>
 				spoolDirNodes = xpath.Evaluate('spooldir', spoolNode)
 				for spoolDirNode in spoolDirNodes:
@@ -1020,6 +5451,7 @@ class Config:
 				
 				queue = {}
 				queue["access"] = []
+				queue["subscribers"] = []
 
 				#if not "name" in queue:
 				#	raise ConfigError, 999 # Missing queue name
@@ -1039,6 +5471,22 @@ class Config:
 						#if overflow != "deny" and overflow != "pop":
 						#	raise ConfigError, 999 # Wrong type for overflow
 						queue["overflow"] = overflow
+					if attribute.nodeName == "storage":
+						queue["storage"] = str(attribute.nodeValue)
+					if attribute.nodeName == "method":
+						queue["method"] = str(attribute.nodeValue)
+					if attribute.nodeName == "ttl":
+						queue["ttl"] = float(attribute.nodeValue)
+					if attribute.nodeName == "segment":
+						queue["segment"] = int(attribute.nodeValue)
+
+				# <subscriber>
+				subscriberNodes = xpath.Evaluate('subscriber', queueNode)
+				for subscriberNode in subscriberNodes:
+					if subscriberNode.firstChild != None:
+						queue["subscribers"].append(str(subscriberNode.firstChild.data).strip())
+					else:
+						queue["subscribers"].append("")
 
 				# <access>
 				accessNodes = xpath.Evaluate('access', queueNode)
@@ -1089,6 +5537,26 @@ class Config:
 			self.dataq["port"] = 50000
 		if not "daemon" in self.dataq:
 			self.dataq["daemon"] = False
+		if not "timeout" in self.dataq:
+			self.dataq["timeout"] = 300
+		if not "server" in self.dataq:
+			self.dataq["server"] = "threaded"
+		if not "workers" in self.dataq:
+			self.dataq["workers"] = 1
+		if not "maxLine" in self.dataq:
+			self.dataq["maxLine"] = 1048576
+
+		# <log>
+		if not "logLevel" in self.dataq:
+			self.dataq["logLevel"] = "info"
+		if not "logSyslog" in self.dataq:
+			self.dataq["logSyslog"] = None
+
+		# <metrics>
+		if not "metricsAddress" in self.dataq:
+			self.dataq["metricsAddress"] = "127.0.0.1"
+		if not "metricsPort" in self.dataq:
+			self.dataq["metricsPort"] = 0
 
 		# <pidfile>
 		if not "pidFile" in self.dataq:
@@ -1102,6 +5570,16 @@ class Config:
 		if not "spoolEvents" in self.queuePool:
 			self.queuePool["spoolEvents"] = []
 
+		# <flush>
+		if not "spoolFlush" in self.queuePool:
+			self.queuePool["spoolFlush"] = "every-op"
+
+		# <compact>
+		if not "compactOps" in self.queuePool:
+			self.queuePool["compactOps"] = 10000
+		if not "compactSize" in self.queuePool:
+			self.queuePool["compactSize"] = 1048576
+
 		# <access>
 		for access in self.queuePool["access"]:
 			if not "sense" in access:
@@ -1124,6 +5602,14 @@ class Config:
 				queue["size"] = 10
 			if not "overflow" in queue:
 				queue["overflow"] = "deny"
+			if not "storage" in queue:
+				queue["storage"] = "memory"
+			if not "method" in queue:
+				queue["method"] = "singleton"
+			if not "ttl" in queue:
+				queue["ttl"] = 0
+			if not "segment" in queue:
+				queue["segment"] = SegmentStore.segmentSize
 				
 			# <access>
 			for access in queue["access"]:
@@ -1148,10 +5634,34 @@ class Config:
 				self.dataq["daemon"] = configOverrides[key]
 		
 	def verify(self):
+		if self.dataq["server"] != "threaded" and self.dataq["server"] != "event":
+			raise ConfigError, 401 # Wrong value for server
+		if self.dataq["workers"] < 1:
+			raise ConfigError, 402 # Wrong value for workers
+		if self.dataq["maxLine"] < 0:
+			raise ConfigError, 403 # Wrong value for maxline
+
+		if not self.dataq["logLevel"] in Log.levels:
+			raise ConfigError, 501 # Wrong value for log level
+		if self.dataq["logSyslog"] != None:
+			if syslog == None or not hasattr(syslog, "LOG_" + self.dataq["logSyslog"].upper()):
+				raise ConfigError, 502 # Wrong value for syslog facility
+
+		if self.dataq["metricsPort"] < 0 or self.dataq["metricsPort"] + self.dataq["workers"] - 1 > 65535:
+			raise ConfigError, 601 # Wrong value for metrics port
+
 		for spoolEvent in self.queuePool["spoolEvents"]:
 			if spoolEvent != "write" and spoolEvent != "shutdown":
 				raise ConfigError, 301 # Wrong value for spool event
 
+		try:
+			Flusher.parsePolicy(self.queuePool["spoolFlush"])
+		except UserWarning:
+			raise ConfigError, 302 # Wrong value for spool flush policy
+
+		if self.queuePool["compactOps"] < 0 or self.queuePool["compactSize"] < 0:
+			raise ConfigError, 303 # Wrong value for spool compaction threshold
+
 		for access in self.queuePool["access"]:
 			if access["sense"] != "allow" and access["sense"] != "deny":
 				raise ConfigError, 102 # Wrong value for sense
@@ -1159,22 +5669,147 @@ class Config:
 		for queue in self.queues:
 			if not "name" in queue:
 				raise ConfigError, 204 # Queue name required
+			if queue["type"] != "fifo" and queue["type"] != "filo" and queue["type"] != "priority":
+				raise ConfigError, 201 # Wrong value for type
+			if queue["storage"] != "memory" and queue["storage"] != "disk":
+				raise ConfigError, 205 # Wrong value for storage
+			if queue["storage"] == "disk" and queue["type"] == "priority":
+				raise ConfigError, 205 # Wrong value for storage
+			if queue["method"] != "singleton" and queue["method"] != "subscribe":
+				raise ConfigError, 206 # Wrong value for method
+			if queue["method"] == "subscribe":
+				if queue["type"] != "fifo" or queue["storage"] != "memory":
+					raise ConfigError, 206 # Wrong value for method
+				if len(queue["subscribers"]) == 0:
+					raise ConfigError, 207 # Wrong value for subscriber
+			elif len(queue["subscribers"]) > 0:
+				raise ConfigError, 207 # Wrong value for subscriber
+			for subscriber in queue["subscribers"]:
+				if not Subscriber.validName(subscriber) or queue["subscribers"].count(subscriber) > 1:
+					raise ConfigError, 207 # Wrong value for subscriber
+			if queue["ttl"] < 0 or queue["ttl"] != queue["ttl"] or queue["ttl"] == float("inf"):
+				raise ConfigError, 208 # Wrong value for ttl
+			if queue["ttl"] > 0 and queue["storage"] == "disk":
+				raise ConfigError, 208 # Wrong value for ttl
+			if queue["segment"] < 1:
+				raise ConfigError, 209 # Wrong value for segment
 			for access in queue["access"]:
 				if access["sense"] != "allow" and access["sense"] != "deny":
 					raise ConfigError, 102 # Wrong value for sense
 
 
+def createQueuePool(worker = None, workers = 1):
+	"""
+	Create the queue pool and its queues from the configuration. If worker is
+	given, create only the part of the pool owned by that worker.
+	"""
+	global config
+
+	if worker == None:
+		retQueuePool = QueuePool(config.queuePool["spoolDir"], config.queuePool["spoolEvents"], config.queuePool["spoolFlush"], \
+			config.queuePool["compactOps"], config.queuePool["compactSize"])
+	else:
+		retQueuePool = ShardedQueuePool(worker, workers, config.queuePool["spoolDir"], config.queuePool["spoolEvents"], config.queuePool["spoolFlush"], \
+			config.queuePool["compactOps"], config.queuePool["compactSize"])
+
+	for queuePoolAccess in createAccessList(config.queuePool["access"]).rules:
+		retQueuePool.addAccess(queuePoolAccess)
+
+	# Create queues
+	for queue in config.queues:
+
+		newQueue = retQueuePool.createQueue(queue["name"], queue["type"], queue["size"], queue["overflow"], queue["storage"], \
+			queue["method"], queue["subscribers"], queue["ttl"], queue["segment"])
+
+		if newQueue == None:
+			# Owned by another worker
+			continue
+
+		for queueAccess in createAccessList(queue["access"]).rules:
+			newQueue.addAccess(queueAccess)
+
+	return(retQueuePool)
+
+def createAccessList(accessConfigs):
+	"""
+	Create an AccessList from the access rules in the configuration.
+	"""
+	retAccessList = AccessList()
+
+	for access in accessConfigs:
+		retAccessList.add(Access(access["sense"], access["password"], access["username"], \
+			access["host"], access["netmask"]))
+
+	return(retAccessList)
+
+def reloadHandler(signum, frame):
+	"""
+	Reload the access rules from the configuration file.
+	"""
+	global configFiles, configOverrides, queuePool, workerPids
+
+	Log.info("Received signal %i: Reloading access rules.", signum)
+
+	for pid in workerPids:
+		try:
+			os.kill(pid, signal.SIGHUP)
+		except OSError:
+			pass
+
+	if queuePool == None:
+		return
+
+	try:
+		newConfig = Config(configFiles, configOverrides)
+	except IOError:
+		Log.error("No config file found. Keeping the current access rules.")
+		return
+	except ConfigError, e:
+		Log.error("Error in configuration: %s. Keeping the current access rules.", e.getMessage())
+		return
+
+	for queue in newConfig.queues:
+		try:
+			queuePool.getQueue(queue["name"]).setAccess(createAccessList(queue["access"]))
+		except DataqError:
+			# New queue, or owned by another worker.
+			pass
+
+	# Also clears the cached access decisions.
+	queuePool.setAccess(createAccessList(newConfig.queuePool["access"]))
+
 def handler(signum, frame):
-	global config, daemon, queuePool
+	global config, daemon, queuePool, workerPids, workerSockets, isWorker
 	
-	Log.verboseMsg("Received signal %i: Shutting down." % signum)
+	Log.info("Received signal %i: Shutting down.", signum)
 
-	if config.dataq["daemon"]:
+	# Stop the worker processes (if any) and wait until they've written
+	# their spools.
+	for pid in workerPids:
+		try:
+			os.kill(pid, signal.SIGTERM)
+		except OSError:
+			pass
+	for pid in workerPids:
+		try:
+			os.waitpid(pid, 0)
+		except OSError:
+			pass
+	for path in workerSockets:
+		try:
+			os.unlink(path)
+		except OSError:
+			pass
+
+	if config.dataq["daemon"] and not isWorker:
 		daemon.cleanup()
 
-	for spoolEvent in queuePool.spoolEvents:
-		if spoolEvent == "shutdown":
-			queuePool.writeSpool()
+	if queuePool != None:
+		queuePool.flushJournals()
+
+		for spoolEvent in queuePool.spoolEvents:
+			if spoolEvent == "shutdown":
+				queuePool.writeSpool()
 
 	sys.exit(0)
 
@@ -1213,6 +5848,16 @@ if __name__ == "__main__":
 			print "msgserv v0.3. (C) 2005, Ferry Boender"
 			sys.exit(0)
 
+	# Write any queued log messages before exiting. Registered first, so it
+	# runs last.
+	atexit.register(Log.flush)
+	atexit.register(scheduler.stop)
+	atexit.register(sweeper.stop)
+
+	if verbose:
+		Log.addSink(ConsoleLogSink())
+		Log.setLevel(Log.DEBUG)
+
 	try:
 		config = Config(configFiles, configOverrides)
 	except IOError:
@@ -1222,6 +5867,18 @@ if __name__ == "__main__":
 		print "Error in configuration:", e.getMessage()
 		sys.exit(-3)
 
+	# Set up logging
+	try:
+		for path in config.dataq["logFiles"]:
+			Log.addSink(FileLogSink(path))
+	except IOError, e:
+		print "Couldn't open log file " + path + "."
+		sys.exit(-3)
+	if config.dataq["logSyslog"] != None:
+		Log.addSink(SyslogLogSink(config.dataq["logSyslog"]))
+	if not verbose:
+		Log.setLevel(Log.levels[config.dataq["logLevel"]])
+
 
 	# Try to create the spool directory
 	try:
@@ -1231,29 +5888,16 @@ if __name__ == "__main__":
 		print "Couldn't create spool directory."
 		sys.exit(-6);
 
-	# Create queue pool
-	queuePool = QueuePool(config.queuePool["spoolDir"], config.queuePool["spoolEvents"])
-
-	for access in config.queuePool["access"]:
-		queuePoolAccess = Access(access["sense"], access["password"], access["username"], \
-			access["host"], access["netmask"])
-		queuePool.addAccess(queuePoolAccess)
-
-	# Create queues
-	for queue in config.queues:
-
-		newQueue = queuePool.createQueue(queue["name"], queue["type"], queue["size"], queue["overflow"])
+	queuePool = None
+	workerPids = []
+	workerSockets = []
+	isWorker = False
 
-		for access in queue["access"]:
-			queueAccess = Access(access["sense"], access["password"], access["username"], \
-				access["host"], access["netmask"])
-			newQueue.addAccess(queueAccess)
-		
-	Log.verboseMsg("Starting server on address " + config.dataq["address"] + ":" + str(config.dataq["port"]))
+	Log.info("Starting server on address %s:%i", config.dataq["address"], config.dataq["port"])
 
 	# Daemonize process
 	if config.dataq["daemon"]:
-		Log.verboseMsg("Running in daemon mode... Detaching from terminal.")
+		Log.info("Running in daemon mode... Detaching from terminal.")
 		try:
 			daemon = Daemon(config.dataq["pidFile"])
 		except DaemonError, e:
@@ -1265,14 +5909,89 @@ if __name__ == "__main__":
 	# Start catching signals
 	for s in [signal.SIGABRT, signal.SIGINT, signal.SIGQUIT, signal.SIGTERM]:
 		signal.signal(s, handler)
+	signal.signal(signal.SIGHUP, reloadHandler)
 
 	# Start server
 	try:
-		server = Server((config.dataq["address"], config.dataq["port"]), RequestHandler)
-		server.serve_forever()
+		if config.dataq["server"] == "event":
+			server = EventServer((config.dataq["address"], config.dataq["port"]), config.dataq["timeout"], config.dataq["maxLine"])
+		else:
+			server = Server((config.dataq["address"], config.dataq["port"]), RequestHandler, config.dataq["timeout"], config.dataq["maxLine"])
 	except socket.error, (errNr, errMsg):
-		Log.verboseErr("Socket already in use. Aborting...");
+		Log.error("Socket already in use. Aborting...");
 		if config.dataq["daemon"]:
 			daemon.cleanup()
 		sys.exit(-2)
 
+	if config.dataq["workers"] == 1:
+		queuePool = createQueuePool()
+	else:
+		# Fork the worker processes. They all accept connections on the
+		# server's socket, and each owns part of the queues. Requests for
+		# queues of other workers are forwarded over the internal sockets,
+		# which are created before forking so they can be used right away.
+		internalServers = []
+		for worker in range(config.dataq["workers"]):
+			workerSockets.append(ShardedQueuePool.socketPath(config.queuePool["spoolDir"], worker))
+			internalServers.append(InternalServer(workerSockets[-1]))
+
+		Log.flush()
+		for worker in range(config.dataq["workers"]):
+			pid = os.fork()
+			if pid == 0:
+				isWorker = True
+				workerPids = []
+				workerSockets = []
+				break
+			workerPids.append(pid)
+
+		if not isWorker:
+			Log.info("Started %i worker processes", len(workerPids))
+
+			server.socket.close()
+			for internalServer in internalServers:
+				internalServer.socket.close()
+
+			# Wait for the workers to exit. Normally they are stopped by the
+			# signal handler.
+			while len(workerPids) > 0:
+				try:
+					pid, status = os.wait()
+				except OSError, e:
+					if e.errno == errno.EINTR:
+						continue
+					raise
+				Log.error("Worker process %i exited", pid)
+				workerPids.remove(pid)
+
+			if config.dataq["daemon"]:
+				daemon.cleanup()
+			sys.exit(-7)
+
+		for internalServer in internalServers:
+			if internalServer != internalServers[worker]:
+				internalServer.socket.close()
+
+		thread = threading.Thread(target=internalServers[worker].serve_forever)
+		thread.setDaemon(True)
+		thread.start()
+
+		queuePool = createQueuePool(worker, config.dataq["workers"])
+
+	# Start the metrics listener. Every worker has its own metrics, which it
+	# serves on the metrics port plus the number of the worker.
+	if config.dataq["metricsPort"] != 0:
+		metricsPort = config.dataq["metricsPort"]
+		if isWorker:
+			metricsPort += worker
+
+		try:
+			metricsServer = MetricsServer((config.dataq["metricsAddress"], metricsPort))
+
+			thread = threading.Thread(target=metricsServer.serve_forever)
+			thread.setDaemon(True)
+			thread.start()
+		except socket.error, (errNr, errMsg):
+			Log.error("Couldn't start the metrics listener on port %i: %s", metricsPort, errMsg)
+
+	server.serve_forever()
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+#
+# Benchmark many concurrent (mostly idle) connections against the threaded and
+# the event-loop server. Opens a number of KEEPALIVE sessions, then runs
+# PUSH/POP requests round-robin over all of them and reports the throughput
+# and the memory (RSS) used by the server.
+#
+# Usage: connections.py [connections] [requests]
+#
+
+import sys
+import os
+import time
+import socket
+import resource
+import tempfile
+import shutil
+import subprocess
+
+connectionCount = 10000
+requestCount = 20000
+port = 49998
+
+if len(sys.argv) > 1:
+	connectionCount = int(sys.argv[1])
+if len(sys.argv) > 2:
+	requestCount = int(sys.argv[2])
+
+# Every connection uses a file descriptor in both the client and the server.
+soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+try:
+	resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+except ValueError:
+	pass
+soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+if connectionCount + 64 > soft:
+	connectionCount = soft - 64
+	print "Limiting to %i connections (RLIMIT_NOFILE is %i)" % (connectionCount, soft)
+
+dataqPath = os.path.join(os.path.dirname(sys.argv[0]), "..", "..", "src", "dataq.py")
+
+def readResponse(sock):
+	data = ""
+	while data.find("\n") == -1:
+		data += sock.recv(1024)
+	length, body = data.split("\n", 1)
+	while len(body) < int(length):
+		body += sock.recv(1024)
+	return(body)
+
+def rss(pid):
+	for line in open("/proc/%i/status" % (pid)):
+		if line.startswith("VmRSS:"):
+			return(int(line.split()[1]))
+	return(0)
+
+def bench(server):
+	tempDir = tempfile.mkdtemp()
+	configPath = os.path.join(tempDir, "dataq.xml")
+	f = file(configPath, "w")
+	f.write("""<?xml version='1.0' encoding='UTF-8'?>
+<dataq port="%i" server="%s" timeout="600">
+	<spool>
+		<spooldir>%s</spooldir>
+	</spool>
+	<access><host>127.0.0.1</host></access>
+	<queue name='bench' size='1000000' />
+</dataq>
+""" % (port, server, tempDir))
+	f.close()
+
+	devNull = file(os.devnull, "w")
+	process = subprocess.Popen([sys.executable, dataqPath, "-c", configPath], stdout = devNull, stderr = devNull)
+	time.sleep(1)
+
+	try:
+		start = time.time()
+		connections = []
+		for i in range(connectionCount):
+			sock = socket.create_connection(("127.0.0.1", port))
+			sock.sendall("KEEPALIVE\n")
+			readResponse(sock)
+			connections.append(sock)
+		connectDuration = time.time() - start
+
+		start = time.time()
+		for i in range(requestCount):
+			sock = connections[i % len(connections)]
+			if i % 2 == 0:
+				sock.sendall("PUSH bench message\n")
+			else:
+				sock.sendall("POP bench\n")
+			readResponse(sock)
+		duration = time.time() - start
+
+		serverRss = rss(process.pid)
+
+		for sock in connections:
+			sock.close()
+	finally:
+		os.kill(process.pid, 15)
+		process.wait()
+		shutil.rmtree(tempDir)
+
+	print "%10s %12i %12.2f %12.0f %12i" % (server, len(connections), connectDuration, requestCount / duration, serverRss)
+
+print "%10s %12s %12s %12s %12s" % ("server", "connections", "connect (s)", "requests/s", "rss (kB)")
+for server in ["threaded", "event"]:
+	bench(server)
@@ -0,0 +1,35 @@
+#!/usr/bin/python
+#
+# Benchmark draining FIFO queues of increasing depth. The time per POP should
+# stay (roughly) the same regardless of the depth of the queue, so the total
+# drain time grows linearly with the queue depth.
+#
+# Usage: fifodrain.py [depth ...]
+#
+
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), "..", "..", "src"))
+import dataq
+
+dataq.Log.setLevel(dataq.Log.OFF)
+
+depths = [10000, 20000, 40000, 80000, 160000, 320000]
+if len(sys.argv) > 1:
+	depths = [int(depth) for depth in sys.argv[1:]]
+
+print "%10s %12s %12s" % ("depth", "drain (s)", "usec/pop")
+
+for depth in depths:
+	queue = dataq.FifoQueue("bench", depth, "deny", "/nonexistent/")
+	for i in range(depth):
+		queue.push("message %i" % (i))
+
+	start = time.time()
+	while len(queue) > 0:
+		queue.pop()
+	duration = time.time() - start
+
+	print "%10i %12.4f %12.3f" % (depth, duration, duration / depth * 1000000)
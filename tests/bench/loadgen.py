@@ -0,0 +1,352 @@
+#!/usr/bin/python
+#
+# Load generator. Starts dataq with a generated configuration and lets a
+# number of concurrent clients (each in its own process) send a mix of
+# PUSH/POP/PEEK/STAT requests to a number of queues. Reports the throughput,
+# the latency percentiles (in microseconds) overall and per command, and the
+# memory (RSS, in kB) used by the server, as JSON on stdout, so results can
+# be compared between commits. A summary is written to stderr.
+#
+# Usage: loadgen.py [options]
+#
+#   -c clients    Number of concurrent clients. Default: 8
+#   -q queues     Number of queues. Default: 4
+#   -n requests   Number of requests per client. Default: 2000
+#   -m mix        Weights of the commands. Default: push=50,pop=40,peek=5,stat=5
+#   -s size       Message size in bytes, or a range (min-max) from which each
+#                 message's size is picked at random. Default: 64
+#   -f prefill    Number of messages pushed onto each queue before starting.
+#                 Default: 1000
+#   -S spool      Spool mode: none, shutdown, every-op, "every N ms" or
+#                 "every N ops" (the last three journal every write with
+#                 that flush policy). Default: none
+#   -x server     Server type: threaded or event. Default: threaded
+#   -w workers    Number of worker processes. Default: 1
+#   -C            Open a new connection for every request instead of using
+#                 a session (KEEPALIVE) per client.
+#   -p port       Port to run the server on. Default: 49997
+#
+
+import sys
+import os
+import time
+import getopt
+import random
+import socket
+import tempfile
+import shutil
+import subprocess
+import multiprocessing
+import json
+
+dataqPath = os.path.join(os.path.dirname(sys.argv[0]), "..", "..", "src", "dataq.py")
+
+options = {
+	"clients": 8,
+	"queues": 4,
+	"requests": 2000,
+	"mix": "push=50,pop=40,peek=5,stat=5",
+	"size": "64",
+	"prefill": 1000,
+	"spool": "none",
+	"server": "threaded",
+	"workers": 1,
+	"session": True,
+	"port": 49997,
+}
+
+def usage(message):
+	sys.stderr.write(message + "\n")
+	sys.stderr.write("Usage: %s [-c clients] [-q queues] [-n requests] [-m mix] [-s size] [-f prefill] [-S spool] [-x server] [-w workers] [-C] [-p port]\n" % (sys.argv[0]))
+	sys.exit(-1)
+
+def parseMix(mix):
+	"""
+	Parse 'push=50,pop=40' into a list of (cumulative weight, command).
+	"""
+	retMix = []
+	total = 0
+
+	for part in mix.split(","):
+		command, weight = part.split("=")
+		if not command.upper() in ["PUSH", "POP", "PEEK", "STAT"]:
+			raise ValueError, command
+		total += int(weight)
+		retMix.append((total, command.upper()))
+
+	if total <= 0:
+		raise ValueError, mix
+
+	return(retMix)
+
+def parseSize(size):
+	"""
+	Parse '64' or '16-4096' into a (min, max) tuple.
+	"""
+	if "-" in size:
+		minSize, maxSize = size.split("-", 1)
+		return(int(minSize), int(maxSize))
+
+	return(int(size), int(size))
+
+def spoolConfig(spool):
+	"""
+	Return the <spool> contents for a spool mode.
+	"""
+	if spool == "none":
+		return("")
+	if spool == "shutdown":
+		return("<event>shutdown</event>")
+
+	return("<event>write</event><flush>%s</flush>" % (spool))
+
+def rss(pid):
+	"""
+	Return the current and peak RSS in kB of a process and its children.
+	"""
+	pids = [pid]
+	for entry in os.listdir("/proc"):
+		if not entry.isdigit():
+			continue
+		try:
+			stat = open("/proc/%s/stat" % (entry)).read()
+		except IOError:
+			continue
+		if int(stat[stat.rfind(")") + 2:].split()[1]) == pid:
+			pids.append(int(entry))
+
+	current = 0
+	peak = 0
+	for pid in pids:
+		try:
+			for line in open("/proc/%i/status" % (pid)):
+				if line.startswith("VmRSS:"):
+					current += int(line.split()[1])
+				if line.startswith("VmHWM:"):
+					peak += int(line.split()[1])
+		except IOError:
+			pass
+
+	return(current, peak)
+
+def revision():
+	try:
+		process = subprocess.Popen(["git", "rev-parse", "--short", "HEAD"], stdout = subprocess.PIPE, stderr = open(os.devnull, "w"), cwd = os.path.dirname(dataqPath))
+		return(process.communicate()[0].strip())
+	except OSError:
+		return("")
+
+class Client:
+
+	"""
+	A client connection to the server, in session mode or with a new
+	connection for every request.
+	"""
+
+	def __init__(self, port, session):
+		self.port = port
+		self.session = session
+		self.sock = None
+
+		if self.session:
+			self.connect()
+			self.request("KEEPALIVE")
+
+	def connect(self):
+		self.sock = socket.create_connection(("127.0.0.1", self.port))
+		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.file = self.sock.makefile("rb")
+
+	def request(self, request):
+		if not self.session:
+			self.connect()
+
+		self.sock.sendall(request + "\n")
+
+		if self.session:
+			length = int(self.file.readline())
+			response = self.file.read(length)
+		else:
+			response = self.file.read()
+			self.file.close()
+			self.sock.close()
+
+		return(response)
+
+def runClient(clientNr, start, results):
+	"""
+	Send the requests of a single client, once start is set. Puts a
+	dictionary with the latencies per command and the number of errors on
+	results.
+	"""
+	rand = random.Random(clientNr)
+	mix = parseMix(options["mix"])
+	total = mix[-1][0]
+	minSize, maxSize = parseSize(options["size"])
+	payload = "".join([chr(rand.randint(97, 122)) for i in range(maxSize)])
+
+	latencies = {}
+	errors = 0
+
+	client = Client(options["port"], options["session"])
+	start.wait()
+
+	for i in range(options["requests"]):
+		pick = rand.randint(1, total)
+		for weight, command in mix:
+			if pick <= weight:
+				break
+
+		queueName = "bench%i" % (rand.randint(0, options["queues"] - 1))
+		if command == "PUSH":
+			request = "PUSH " + queueName + " " + payload[:rand.randint(minSize, maxSize)]
+		else:
+			request = command + " " + queueName
+
+		requestStart = time.time()
+		response = client.request(request)
+		latency = time.time() - requestStart
+
+		if response.startswith("ERROR"):
+			errors += 1
+		latencies.setdefault(command, []).append(latency)
+
+	results.put({"latencies": latencies, "errors": errors})
+
+def percentiles(latencies):
+	latencies.sort()
+	retPercentiles = {"count": len(latencies)}
+
+	if len(latencies) > 0:
+		for name, fraction in [("p50", 0.5), ("p99", 0.99), ("p999", 0.999)]:
+			retPercentiles[name] = int(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000000)
+		retPercentiles["mean"] = int(sum(latencies) / len(latencies) * 1000000)
+		retPercentiles["max"] = int(latencies[-1] * 1000000)
+
+	return(retPercentiles)
+
+def bench():
+	tempDir = tempfile.mkdtemp()
+	configPath = os.path.join(tempDir, "dataq.xml")
+	queues = "".join(["<queue name='bench%i' size='10000000' />" % (i) for i in range(options["queues"])])
+	f = file(configPath, "w")
+	f.write("""<?xml version='1.0' encoding='UTF-8'?>
+<dataq port="%i" server="%s" workers="%i">
+	<spool>%s<spooldir>%s</spooldir></spool>
+	<access><host>127.0.0.1</host></access>
+	%s
+</dataq>
+""" % (options["port"], options["server"], options["workers"], spoolConfig(options["spool"]), tempDir, queues))
+	f.close()
+
+	devNull = file(os.devnull, "w")
+	process = subprocess.Popen([sys.executable, dataqPath, "-c", configPath], stdout = devNull, stderr = devNull)
+
+	try:
+		# Wait for the server to come up.
+		for i in range(100):
+			try:
+				socket.create_connection(("127.0.0.1", options["port"])).close()
+				break
+			except socket.error:
+				time.sleep(0.1)
+
+		client = Client(options["port"], True)
+		minSize, maxSize = parseSize(options["size"])
+		for i in range(options["queues"]):
+			for j in range(options["prefill"]):
+				client.request("PUSH bench%i %s" % (i, "x" * maxSize))
+
+		start = multiprocessing.Event()
+		results = multiprocessing.Queue()
+		clients = []
+		for i in range(options["clients"]):
+			clientProcess = multiprocessing.Process(target=runClient, args=(i, start, results))
+			clientProcess.start()
+			clients.append(clientProcess)
+
+		# Give the clients time to connect.
+		time.sleep(0.5)
+		startTime = time.time()
+		start.set()
+
+		latencies = {}
+		errors = 0
+		for i in range(options["clients"]):
+			result = results.get()
+			errors += result["errors"]
+			for command in result["latencies"]:
+				latencies.setdefault(command, []).extend(result["latencies"][command])
+		duration = time.time() - startTime
+
+		for clientProcess in clients:
+			clientProcess.join()
+
+		serverRss, serverRssPeak = rss(process.pid)
+	finally:
+		os.kill(process.pid, 15)
+		process.wait()
+		shutil.rmtree(tempDir)
+
+	allLatencies = []
+	for command in latencies:
+		allLatencies.extend(latencies[command])
+	requests = len(allLatencies)
+
+	retResult = {
+		"revision": revision(),
+		"options": options,
+		"duration": round(duration, 3),
+		"requests": requests,
+		"errors": errors,
+		"throughput": round(requests / duration, 1),
+		"latency": percentiles(allLatencies),
+		"commands": {},
+		"rss": serverRss,
+		"rssPeak": serverRssPeak,
+	}
+	for command in latencies:
+		retResult["commands"][command] = percentiles(latencies[command])
+
+	return(retResult)
+
+if __name__ == "__main__":
+	try:
+		params, args = getopt.getopt(sys.argv[1:], 'c:q:n:m:s:f:S:x:w:Cp:')
+	except getopt.error, errMsg:
+		usage(str(errMsg))
+
+	try:
+		for a in params:
+			if a[0] == "-c":
+				options["clients"] = int(a[1])
+			if a[0] == "-q":
+				options["queues"] = int(a[1])
+			if a[0] == "-n":
+				options["requests"] = int(a[1])
+			if a[0] == "-m":
+				options["mix"] = a[1]
+			if a[0] == "-s":
+				options["size"] = a[1]
+			if a[0] == "-f":
+				options["prefill"] = int(a[1])
+			if a[0] == "-S":
+				options["spool"] = a[1]
+			if a[0] == "-x":
+				options["server"] = a[1]
+			if a[0] == "-w":
+				options["workers"] = int(a[1])
+			if a[0] == "-C":
+				options["session"] = False
+			if a[0] == "-p":
+				options["port"] = int(a[1])
+
+		parseMix(options["mix"])
+		parseSize(options["size"])
+	except ValueError, e:
+		usage("Invalid option value: " + str(e))
+
+	result = bench()
+
+	sys.stderr.write("%i requests in %.2f s: %.0f requests/s, %i errors, p50 %i us, p99 %i us, p999 %i us, server RSS %i kB\n" % (result["requests"], result["duration"], result["throughput"], result["errors"], result["latency"].get("p50", 0), result["latency"].get("p99", 0), result["latency"].get("p999", 0), result["rss"]))
+	print json.dumps(result, indent = 1, sort_keys = True)
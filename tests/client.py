@@ -0,0 +1,172 @@
+#!/usr/bin/python
+#
+# Tests for the Python client (src/clients/python). Queue URIs built by the
+# client must be parsed by the server into the same username, password,
+# queue name and options. Requests must only be retried on a new connection
+# if the server closed the connection before sending any response, never
+# after a timeout or a partial response.
+#
+# Usage: client.py
+#
+
+import sys
+import os
+import imp
+import socket
+import struct
+import shutil
+import tempfile
+import threading
+
+src = os.path.join(os.path.dirname(sys.argv[0]), "..", "src")
+server = imp.load_source("dataqserver", os.path.join(src, "dataq.py"))
+client = imp.load_source("dataqclient", os.path.join(src, "clients", "python", "dataq.py"))
+
+server.Log.setLevel(server.Log.OFF)
+
+errors = []
+
+#
+# Queue URIs
+#
+
+spoolDir = tempfile.mkdtemp()
+queuePool = server.QueuePool(spoolDir, [])
+
+uris = [
+	("queue", "", "", None),
+	("queue", "john", "johnspw", None),
+	("queue", "", "johnspw", None),
+	("queue", "", "pa:ss", None),
+	("queue", "john", "pa:ss", None),
+	("queue", "john", "", None),
+	("a@b", "", "", None),
+	("a@b", "", "pa:ss", None),
+	("queue", "", "pa:ss", [("priority", 5), ("ttl", "1.5")]),
+]
+
+for queueName, username, password, options in uris:
+	queueURI = client.buildQueueURI(queueName, username, password, options)
+	parsed = queuePool.parseQueueURI(queueURI)
+	if parsed != (username, password, queueName):
+		errors.append("%r parsed as %r" % (queueURI, parsed))
+
+	parsedOptions = queuePool.parseQueueOptions(queueURI, ["priority", "ttl"])
+	expected = dict([(name, str(value)) for name, value in options or []])
+	if parsedOptions != expected:
+		errors.append("%r has options %r" % (queueURI, parsedOptions))
+
+for queueName, username, password in [("a b", "", ""), ("q?x", "", ""), ("q", "jo:hn", ""), ("q", "", "p@ss")]:
+	try:
+		client.buildQueueURI(queueName, username, password)
+		errors.append("%r, %r, %r accepted" % (queueName, username, password))
+	except ValueError:
+		pass
+
+shutil.rmtree(spoolDir)
+
+#
+# Retries
+#
+
+def response(data):
+	return("+" + struct.pack('>L', len(data)) + data)
+
+def fakeServer(behaviours):
+	"""
+	Start a server that accepts a connection for each of behaviours. It
+	answers the BINARY request of the connection and then, for each request,
+	either answers it ('answer'), closes the connection before answering
+	('close'), sends half a response and closes the connection ('partial')
+	or doesn't answer at all ('silent'). Returns the port and the list of
+	accepted connections.
+	"""
+	listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listener.bind(("127.0.0.1", 0))
+	listener.listen(len(behaviours))
+	accepted = []
+
+	def serve():
+		for behaviour in behaviours:
+			conn, address = listener.accept()
+			accepted.append(conn)
+			file = conn.makefile("rb")
+			file.readline()
+			conn.sendall(response("OK\n"))
+
+			for action in behaviour:
+				if action == "close":
+					break
+				length = struct.unpack('>L', file.read(4))[0]
+				file.read(length)
+				if action == "answer":
+					conn.sendall(response(""))
+				elif action == "partial":
+					conn.sendall(response("")[:3])
+					break
+				elif action == "silent":
+					# Until the client gives up.
+					file.read(1)
+					break
+			file.close()
+			conn.close()
+		listener.close()
+
+	thread = threading.Thread(target=serve)
+	thread.setDaemon(True)
+	thread.start()
+
+	return(listener.getsockname()[1], accepted)
+
+def check(name, behaviours, retried):
+	port, accepted = fakeServer(behaviours)
+	dataq = client.Dataq("127.0.0.1", port, timeout = 1)
+	try:
+		dataq.push("queue", "first")
+	except client.DataqException, e:
+		errors.append("%s: first request failed: %s" % (name, e))
+		return
+
+	try:
+		dataq.push("queue", "second")
+		if not retried:
+			errors.append("%s: request was retried" % (name))
+	except client.DataqException, e:
+		if retried:
+			errors.append("%s: request wasn't retried: %s" % (name, e))
+		elif len(accepted) > 1:
+			errors.append("%s: a new connection was opened" % (name))
+	dataq.close()
+
+# The server closed the idle connection: retry on a new connection.
+check("closed", [["answer", "close"], ["answer"]], True)
+# A partial response or a timeout: the server may have processed the request.
+check("partial", [["answer", "partial"], ["answer"]], False)
+check("timeout", [["answer", "silent"], ["answer"]], False)
+
+# Errors while opening a connection are DataqExceptions.
+listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+listener.bind(("127.0.0.1", 0))
+listener.listen(1)
+def closeAtOnce():
+	conn, address = listener.accept()
+	conn.close()
+thread = threading.Thread(target=closeAtOnce)
+thread.setDaemon(True)
+thread.start()
+try:
+	client.Connection("127.0.0.1", listener.getsockname()[1], 1)
+	errors.append("connection closed by the server accepted")
+except client.DataqException:
+	pass
+except Exception, e:
+	errors.append("connection closed by the server raised %r" % (e))
+listener.close()
+
+if len(errors) > 0:
+	print "Failed."
+	for error in errors:
+		print "  " + error
+	sys.exit(1)
+
+print "Passed."
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+#
+# Stress test for concurrent access to queues. Many threads push to and pop
+# from several queues at the same time. Afterwards, every message that was
+# pushed must have been popped exactly once, and no queue may ever have held
+# more messages than its size allows. Clients blocked in BPOP must be handed
+# messages in the order in which they started waiting.
+#
+# Usage: stress.py [threads per queue] [messages per thread]
+#
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), "..", "src"))
+import dataq
+
+dataq.Log.setLevel(dataq.Log.OFF)
+
+threadCount = 8
+messageCount = 1000
+if len(sys.argv) > 1:
+	threadCount = int(sys.argv[1])
+if len(sys.argv) > 2:
+	messageCount = int(sys.argv[2])
+
+# Switch threads as often as possible to provoke races.
+sys.setcheckinterval(1)
+
+spoolDir = tempfile.mkdtemp()
+
+queuePool = dataq.QueuePool(spoolDir, ["write"])
+queuePool.addAccess(dataq.Access("allow", "", "", "127.0.0.1", ""))
+
+queues = [
+	queuePool.createQueue("fifo1", "fifo", 10, "deny"),
+	queuePool.createQueue("fifo2", "fifo", 50, "deny"),
+	queuePool.createQueue("filo1", "filo", 10, "deny"),
+	queuePool.createQueue("filo2", "filo", 50, "deny"),
+	queuePool.createQueue("priority1", "priority", 10, "deny"),
+]
+overflowQueue = queuePool.createQueue("overflow", "fifo", 10, "pop")
+blockingQueue = queuePool.createQueue("blocking", "fifo", 10, "deny")
+
+pushed = {}
+popped = {}
+errors = []
+done = False
+
+def producer(queueName, threadNr):
+	messages = []
+	for i in range(messageCount):
+		message = "%s-%i-%i" % (queueName, threadNr, i)
+		queueURI = queueName
+		if queueName.startswith("priority"):
+			queueURI += "?priority=%i" % (i % 3)
+		while True:
+			try:
+				if i % 10 == 0:
+					queuePool.mpush("127.0.0.1", queueURI, [message])
+				else:
+					queuePool.push("127.0.0.1", queueURI, message)
+				break
+			except dataq.DataqError, e:
+				if e.getValue() != 203:
+					errors.append("push to %s: %s" % (queueName, e))
+					return
+				time.sleep(0.0001)
+		messages.append(message)
+	pushed[(queueName, threadNr)] = messages
+
+def consumer(queueName, threadNr):
+	messages = []
+	while len(messages) < messageCount:
+		if len(messages) % 10 == 0:
+			result = queuePool.mpop("127.0.0.1", queueName, 2)
+		else:
+			result = [queuePool.pop("127.0.0.1", queueName)]
+		for message in result:
+			if message != "":
+				messages.append(message)
+		if len(result) == 0 or result[0] == "":
+			time.sleep(0.0001)
+	popped[(queueName, threadNr)] = messages
+
+def blockingConsumer(queueName, threadNr):
+	messages = []
+	while len(messages) < messageCount:
+		message = queuePool.bpop("127.0.0.1", queueName, 5)
+		if message == "":
+			errors.append("bpop from %s timed out" % (queueName))
+			break
+		messages.append(message)
+	popped[(queueName, threadNr)] = messages
+
+def overflower(threadNr):
+	for i in range(messageCount):
+		queuePool.push("127.0.0.1", "overflow", "%i-%i" % (threadNr, i))
+
+def watcher():
+	while not done:
+		for queue in queues + [overflowQueue]:
+			if len(queue) > queue.size:
+				errors.append("%s holds %i messages (size %i)" % (queue.name, len(queue), queue.size))
+		time.sleep(0.001)
+
+threads = []
+for queue in queues:
+	for threadNr in range(threadCount):
+		threads.append(threading.Thread(target=producer, args=(queue.name, threadNr)))
+		threads.append(threading.Thread(target=consumer, args=(queue.name, threadNr)))
+for threadNr in range(threadCount):
+	threads.append(threading.Thread(target=overflower, args=(threadNr,)))
+	threads.append(threading.Thread(target=producer, args=(blockingQueue.name, threadNr)))
+	threads.append(threading.Thread(target=blockingConsumer, args=(blockingQueue.name, threadNr)))
+
+watcherThread = threading.Thread(target=watcher)
+watcherThread.start()
+
+start = time.time()
+for thread in threads:
+	thread.start()
+for thread in threads:
+	thread.join()
+duration = time.time() - start
+
+done = True
+watcherThread.join()
+
+for queue in queues + [blockingQueue]:
+	allPushed = []
+	allPopped = []
+	for threadNr in range(threadCount):
+		allPushed += pushed.get((queue.name, threadNr), [])
+		allPopped += popped.get((queue.name, threadNr), [])
+
+	if len(allPopped) != len(dict.fromkeys(allPopped)):
+		errors.append("%s: messages were popped more than once" % (queue.name))
+	if dict.fromkeys(allPushed) != dict.fromkeys(allPopped):
+		errors.append("%s: pushed and popped messages differ" % (queue.name))
+	if len(queue) != 0:
+		errors.append("%s: %i messages left in queue" % (queue.name, len(queue)))
+
+if len(overflowQueue) != overflowQueue.size:
+	errors.append("overflow: holds %i messages instead of %i" % (len(overflowQueue), overflowQueue.size))
+
+# Waiting clients are served first come, first served.
+waiterResults = {}
+def waiter(waiterNr):
+	waiterResults[waiterNr] = blockingQueue.bpop(5)
+
+waiterThreads = []
+for waiterNr in range(5):
+	thread = threading.Thread(target=waiter, args=(waiterNr,))
+	thread.start()
+	waiterThreads.append(thread)
+	while len(blockingQueue.waiters) < waiterNr + 1:
+		time.sleep(0.001)
+blockingQueue.pushMany(["0", "1"])
+for waiterNr in range(2, 5):
+	blockingQueue.push(str(waiterNr))
+for thread in waiterThreads:
+	thread.join()
+for waiterNr in range(5):
+	if waiterResults[waiterNr] != str(waiterNr):
+		errors.append("waiter %i received '%s'" % (waiterNr, waiterResults[waiterNr]))
+
+shutil.rmtree(spoolDir)
+
+if len(errors) > 0:
+	print "Failed."
+	for error in errors:
+		print "  " + error
+	sys.exit(1)
+
+print "Passed. (%i threads, %.2f seconds)" % (len(threads), duration)
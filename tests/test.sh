@@ -6,6 +6,18 @@ else
 	TESTS="test*"
 fi
 
+# Send the requests in a file to the server
+send() {
+	if [ -e $TEST/session ]; then
+		# Send the entire input over a single connection
+		cat $1 | netcat localhost 49999 >> test.out
+	else
+		cat $1 | while read; 
+			do echo $REPLY | netcat localhost 49999 >> test.out; 
+		done
+	fi
+}
+
 for TEST in `ls -1 -d $TESTS| grep -v 'test.sh'`; do
 	# Clean up any previous test run data
 	rm /tmp/spool -r
@@ -20,9 +32,19 @@ for TEST in `ls -1 -d $TESTS| grep -v 'test.sh'`; do
 
 	PID=`cat /tmp/dataq.pid`
 
-	cat $TEST/in | while read; 
-		do echo $REPLY | netcat localhost 49999 >> test.out; 
-	done
+	send $TEST/in
+
+	if [ -e $TEST/in2 ]; then
+		# Restart the server and send the rest of the input
+		kill $PID
+		while kill -0 $PID 2> /dev/null; do sleep 0.1; done
+
+		../src/dataq.py -d -V -c $TEST/dataq.xml >> dataq.out
+		sleep 1
+		PID=`cat /tmp/dataq.pid`
+
+		send $TEST/in2
+	fi
 
 	kill $PID
 
@@ -35,6 +57,11 @@ for TEST in `ls -1 -d $TESTS| grep -v 'test.sh'`; do
 		echo "INPUT" > $TEST/failed.log
 		echo "--------------------------------------------------------------------------" >> $TEST/failed.log
 		cat $TEST/in >> $TEST/failed.log
+		if [ -e $TEST/in2 ]; then
+			echo "INPUT AFTER RESTART" >> $TEST/failed.log
+			echo "--------------------------------------------------------------------------" >> $TEST/failed.log
+			cat $TEST/in2 >> $TEST/failed.log
+		fi
 		echo "EXPECTED CLIENT OUTPUT" >> $TEST/failed.log
 		echo "--------------------------------------------------------------------------" >> $TEST/failed.log
 		cat $TEST/out >> $TEST/failed.log